@@ -0,0 +1,50 @@
+"""Realistic inputs for the benchmarks, built from the cases in
+test/test_rako_deserialisation.py and test/test_marshmallow_models.py.
+"""
+import json
+
+from rakomqtt.simulator import status_frame
+
+
+# the status frames from the deserialisation tests, with the checksum fixed
+# on the legacy level ones
+STATUS_FRAMES = [
+    status_frame(13, 1, 12, 42, 42),
+    status_frame(5, 1, 52, 1, 255),
+    status_frame(13, 1, 12, 16, 16),
+    status_frame(10, 2, 12, 16, 16),
+    status_frame(13, 0, 6),
+    status_frame(17, 0, 49, 0, 2),
+    status_frame(13, 0, 4),
+    status_frame(21, 0, 6),
+    status_frame(21, 0, 0),
+]
+
+COMMAND_MESSAGES = [
+    ('rako/room/13/channel/1/set', json.dumps({"state": "ON", "brightness": 25})),
+    ('rako/room/5/channel/42/set', json.dumps({"state": "ON", "brightness": 25})),
+    ('rako/room/5/channel/42/set', json.dumps({"state": "ON", "brightness": 90})),
+    ('rako/room/5/set', json.dumps({"state": "ON", "brightness": 90})),
+    ('rako/room/5/set', json.dumps({"state": "ON", "brightness": 100})),
+    ('rako/room/9/set', json.dumps({"state": "ON", "brightness": 100})),
+    ('rako/room/9/set', json.dumps({"state": "OFF"})),
+]
+
+MQTT_PAYLOADS = [payload for _, payload in COMMAND_MESSAGES] + [
+    json.dumps({"state": "OFF", "brightness": 25}),
+    json.dumps({"state": "ON"}),
+]
+
+
+def house_burst(rooms=20, channels=6, levels=(0, 64, 128, 192, 255)):
+    """Status frames for a house full of dimmers moving through a few
+    levels, interleaved with room scene changes. Consecutive frames for a
+    topic differ so every one of them is a state change to publish.
+    """
+    frames = []
+    for i, level in enumerate(levels):
+        for room in range(1, rooms + 1):
+            for channel in range(1, channels + 1):
+                frames.append(status_frame(room, channel, 52, 1, level))
+            frames.append(status_frame(room, 0, 49, 0, i % 5))
+    return frames
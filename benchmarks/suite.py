@@ -0,0 +1,206 @@
+"""Benchmarks for the paths that run on every light change.
+
+    python -m benchmarks [--output results.json] [--compare baseline.json]
+
+Results are written as json so runs from different commits on the same
+machine can be compared with --compare.
+"""
+import argparse
+import json
+import platform
+import socket
+import subprocess
+import sys
+import time
+import timeit
+
+from benchmarks.corpus import COMMAND_MESSAGES, MQTT_PAYLOADS, STATUS_FRAMES, house_burst
+from rakomqtt.model import mqtt_payload_schema
+from rakomqtt.RakoBridge import RakoBridge, RakoCommand, RakoStatusDecoder, RakoStatusMessage
+from rakomqtt.state import StateStore
+from rakomqtt.watcher import BatchReceiver, _process_batch
+
+
+REGRESSION_THRESHOLD = 1.10
+
+
+class StubMQTTClient:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+
+def bench_from_byte_list():
+    byte_lists = [list(frame) for frame in STATUS_FRAMES]
+
+    def run():
+        for byte_list in byte_lists:
+            RakoStatusMessage.from_byte_list(byte_list)
+    return run, len(byte_lists)
+
+
+def bench_process_udp_bytes():
+    byte_lists = [list(frame) for frame in STATUS_FRAMES]
+
+    def run():
+        for byte_list in byte_lists:
+            RakoBridge.process_udp_bytes(byte_list)
+    return run, len(byte_lists)
+
+
+def bench_status_decoder():
+    decoder = RakoStatusDecoder()
+
+    def run():
+        for frame in STATUS_FRAMES:
+            decoder.decode(frame)
+    return run, len(STATUS_FRAMES)
+
+
+def bench_from_mqtt():
+    def run():
+        for topic, payload in COMMAND_MESSAGES:
+            RakoCommand.from_mqtt(topic, payload)
+    return run, len(COMMAND_MESSAGES)
+
+
+def bench_from_mqtt_strict():
+    def run():
+        for topic, payload in COMMAND_MESSAGES:
+            RakoCommand.from_mqtt(topic, payload, strict=True)
+    return run, len(COMMAND_MESSAGES)
+
+
+def bench_mqtt_payload_schema_loads():
+    def run():
+        for payload in MQTT_PAYLOADS:
+            mqtt_payload_schema.loads(payload)
+    return run, len(MQTT_PAYLOADS)
+
+
+def bench_watcher_end_to_end():
+    """udp datagrams on a real socket through to MQTTClient.publish"""
+    frames = house_burst()
+    receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver_sock.bind(('127.0.0.1', 0))
+    receiver_sock.setblocking(False)
+    sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver_sock.getsockname()
+    receiver = BatchReceiver(receiver_sock, batch_size=64)
+
+    def run():
+        # a fresh state store each run, otherwise every state is unchanged
+        # and nothing is published
+        mqtt_client = StubMQTTClient()
+        state_store = StateStore()
+        decoder = RakoStatusDecoder()
+        for frame in frames:
+            sender_sock.sendto(frame, address)
+        received = 0
+        while received < len(frames):
+            batch = receiver.receive(timeout=1)
+            if not batch:
+                raise RuntimeError('status frames were dropped')
+            received += len(batch)
+            _process_batch(batch, decoder, state_store, mqtt_client)
+        assert mqtt_client.published == len(frames)
+    return run, len(frames)
+
+
+def bench_startup(mode):
+    """Cold start of a fresh interpreter up to having the mode's code loaded"""
+    def setup():
+        code = f"from rakomqtt.__main__ import load_mode; load_mode('{mode}')"
+
+        def run():
+            subprocess.run([sys.executable, '-c', code], check=True)
+        return run, 1
+    return setup
+
+
+BENCHMARKS = {
+    'RakoStatusMessage.from_byte_list': (bench_from_byte_list, 20000),
+    'RakoBridge.process_udp_bytes': (bench_process_udp_bytes, 10000),
+    'RakoStatusDecoder.decode': (bench_status_decoder, 50000),
+    'RakoCommand.from_mqtt': (bench_from_mqtt, 10000),
+    'RakoCommand.from_mqtt[strict]': (bench_from_mqtt_strict, 2000),
+    'mqtt_payload_schema.loads': (bench_mqtt_payload_schema_loads, 2000),
+    'watcher.end_to_end': (bench_watcher_end_to_end, 5),
+    'startup.watcher': (bench_startup('watcher'), 1),
+    'startup.commander': (bench_startup('commander'), 1),
+    'startup.combined': (bench_startup('combined'), 1),
+}
+
+
+def run_benchmarks(names=None, repeat=5):
+    results = {}
+    for name, (setup, number) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        fn, ops = setup()
+        best = min(timeit.repeat(fn, number=number, repeat=repeat))
+        ns_per_op = best / (number * ops) * 1e9
+        results[name] = dict(ns_per_op=round(ns_per_op, 1), ops_per_sec=round(1e9 / ns_per_op), number=number * ops)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """:return names of the benchmarks which are slower than the baseline by more than threshold"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['ns_per_op'] / baseline['results'][name]['ns_per_op']
+        flag = 'REGRESSION' if ratio > threshold else ''
+        print(f"{name:<36} {ratio:6.2f}x {flag}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rakomqtt hot path benchmarks")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--compare", help="json results from an earlier run to compare against")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("names", nargs='*', help="only run these benchmarks")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.names, args.repeat)
+    report = dict(
+        commit=_git_commit(),
+        timestamp=int(time.time()),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        results=results,
+    )
+
+    for name, result in results.items():
+        print(f"{name:<36} {result['ns_per_op']:12.1f} ns/op {result['ops_per_sec']:12d} ops/s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {baseline.get('commit')}:")
+        if compare(results, baseline):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
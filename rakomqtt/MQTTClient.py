@@ -1,31 +1,225 @@
 import logging
+import random
+import threading
+import time
+from collections import OrderedDict
 
 import paho.mqtt.client as mqtt
 
+from rakomqtt.const import (
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_PENDING,
+    DEFAULT_QOS,
+    DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_RECONNECT_MIN_DELAY,
+)
+from rakomqtt.metrics import (
+    MQTT_CONNECTED,
+    MQTT_PUBLISH_DROPPED,
+    MQTT_PUBLISH_INFLIGHT,
+    MQTT_PUBLISH_PENDING,
+    MQTT_PUBLISH_SUPERSEDED,
+    MQTT_RECONNECT_SECONDS,
+    MQTT_RECONNECTS,
+)
+
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class ReconnectPolicy:
+    """Jittered exponential backoff between reconnect attempts.
+
+    The n'th attempt after a disconnect waits a random time between
+    min_delay and min(min_delay * 2**n, max_delay), so the first retry is
+    quick and clients dropped by the same broker restart don't all come back
+    at the same moment.
+    """
+
+    def __init__(self, min_delay=DEFAULT_RECONNECT_MIN_DELAY, max_delay=DEFAULT_RECONNECT_MAX_DELAY, rng=random.random):
+        if not 0 < min_delay <= max_delay:
+            raise ValueError(f"reconnect delays must satisfy 0 < min ({min_delay}) <= max ({max_delay})")
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._rng = rng
+        self.attempts = 0
+
+    def next_delay(self):
+        ceiling = min(self.min_delay * 2 ** self.attempts, self.max_delay)
+        self.attempts += 1
+        return self.min_delay + self._rng() * (ceiling - self.min_delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
 class MQTTClient:
-    def __init__(self, host, user, pwd):
+    """paho client wrapper whose publishes go through a bounded pipeline.
+
+    At most `max_inflight` messages are handed to paho at once. The rest
+    wait in `_pending`, which holds only the newest message for each topic
+    (a replaced message keeps its place) and at most `max_pending` topics,
+    dropping the oldest beyond that. So if the broker stalls or the
+    connection drops, memory stays flat and only the latest states are
+    sent when it recovers.
+
+    Lost connections are retried following `reconnect_policy`. On every
+    connect `resync()`, if set, gives the {topic: payload} of every known
+    state, which is queued in one go and published retained, so changes
+    missed while disconnected reach the broker.
+    """
+
+    def __init__(
+        self,
+        host,
+        user,
+        pwd,
+        qos=DEFAULT_QOS,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        max_pending=DEFAULT_MAX_PENDING,
+        reconnect_min_delay=DEFAULT_RECONNECT_MIN_DELAY,
+        reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY,
+        resync=None,
+    ):
         self.mqttc = mqtt.Client()
         self.mqttc.enable_logger()
         self.host = host
         self.user = user
         self.pwd = pwd
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.connected = False
+        # called after the client's own handling of a (re)connect
+        self.on_connect = None
+        self.resync = resync
+        self.reconnect_policy = ReconnectPolicy(reconnect_min_delay, reconnect_max_delay)
+        # seconds the connection was down before the latest reconnect, None before any
+        self.outage = None
+        self._disconnected_at = None
+
+        self._pending = OrderedDict()
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.superseded = 0
+        self.dropped = 0
+        MQTT_PUBLISH_PENDING.set_function(lambda: len(self._pending))
+        MQTT_PUBLISH_INFLIGHT.set_function(lambda: self._inflight)
+
+        def on_connect(client, userdata, flags, rc):
+            self.connected = rc == 0
+            MQTT_CONNECTED.set(int(self.connected))
+            if self.connected:
+                self._connected()
+            if self.on_connect:
+                self.on_connect(client, userdata, flags, rc)
+            if self.connected:
+                with self._lock:
+                    # whatever was in flight went with the old connection
+                    self._inflight = 0
+                if self.resync:
+                    self.publish_many(self.resync().items(), retain=True)
+                else:
+                    self._drain()
 
         def on_disconnect(client, userdata, rc):
+            self.connected = False
+            MQTT_CONNECTED.set(0)
             if rc != 0:
-                _LOGGER.info(f"Unexpected MQTT disconnection. rc = {rc}. Will auto-reconnect")
+                delay = self._disconnected()
+                _LOGGER.info(f"Unexpected MQTT disconnection. rc = {rc}. Reconnecting in {delay:.1f}s")
 
+        def on_connect_fail(client, userdata):
+            delay = self._disconnected()
+            _LOGGER.info(f"Couldn't reconnect to MQTT. Retrying in {delay:.1f}s")
+
+        def on_publish(client, userdata, mid):
+            with self._lock:
+                self._inflight = max(self._inflight - 1, 0)
+            self._drain()
+
+        self.mqttc.on_connect = on_connect
         self.mqttc.on_disconnect = on_disconnect
+        self.mqttc.on_publish = on_publish
+        # called after each failed reconnect attempt, needs paho >= 1.6 as pinned in requirements.txt
+        self.mqttc.on_connect_fail = on_connect_fail
         self.mqttc.username_pw_set(self.user, self.pwd)
-        self.mqttc.reconnect_delay_set()
+        self.mqttc.max_inflight_messages_set(max_inflight)
+        self.mqttc.reconnect_delay_set(reconnect_min_delay, reconnect_min_delay)
+
+    def _disconnected(self):
+        """Note when the connection went and set paho's wait before the next attempt
+
+        :return the wait in seconds
+        """
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+        delay = self.reconnect_policy.next_delay()
+        # paho waits exactly min_delay on the next attempt, as setting the delays restarts its own backoff
+        self.mqttc.reconnect_delay_set(delay, delay)
+        return delay
+
+    def _connected(self):
+        self.reconnect_policy.reset()
+        if self._disconnected_at is None:
+            return
+        self.outage = time.monotonic() - self._disconnected_at
+        self._disconnected_at = None
+        MQTT_RECONNECTS.inc()
+        MQTT_RECONNECT_SECONDS.observe(self.outage)
+        _LOGGER.info(f"Reconnected to MQTT after {self.outage:.1f}s")
+
+    def publish(self, topic, payload=None, qos=None, retain=False):
+        """Queue the message, replacing any pending message for the topic,
+        and send what the in-flight limit allows
+        """
+        with self._lock:
+            self._queue(topic, payload, qos, retain)
+        self._drain()
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
-        (rc, message_id) = self.mqttc.publish(topic, payload, qos, retain)
-        _LOGGER.debug(f"published to {topic}: {payload}. response: {(rc, message_id)}")
+    def publish_many(self, messages, qos=None, retain=False):
+        """Queue (topic, payload) pairs together and then send what the
+        in-flight limit allows. A topic that already has a message pending
+        keeps that one, as it's at least as new.
+        """
+        with self._lock:
+            for topic, payload in messages:
+                if topic not in self._pending:
+                    self._queue(topic, payload, qos, retain)
+        self._drain()
+
+    def _queue(self, topic, payload, qos, retain):
+        if topic in self._pending:
+            self.superseded += 1
+            MQTT_PUBLISH_SUPERSEDED.inc()
+        elif len(self._pending) >= self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+            MQTT_PUBLISH_DROPPED.inc()
+        self._pending[topic] = (payload, self.qos if qos is None else qos, retain)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self.connected or not self._pending or self._inflight >= self.max_inflight:
+                    return
+                topic, (payload, qos, retain) = self._pending.popitem(last=False)
+                self._inflight += 1
+
+            (rc, message_id) = self.mqttc.publish(topic, payload, qos, retain)
+            _LOGGER.debug("published to %s: %s. response: %s", topic, payload, (rc, message_id))
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                with self._lock:
+                    self._inflight = max(self._inflight - 1, 0)
+                    # put it back for after the reconnect, unless it's been replaced since
+                    if topic not in self._pending:
+                        self._pending[topic] = (payload, qos, retain)
+                        self._pending.move_to_end(topic, last=False)
+                return
 
     def connect(self):
         self.mqttc.connect(self.host, 1883, 60)
-
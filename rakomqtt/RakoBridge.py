@@ -1,16 +1,24 @@
+import json
 import logging
-import re
 import socket
-import requests
+import sys
+import time
 from enum import Enum
 from dataclasses import dataclass
-from urllib3.exceptions import HTTPError
+from urllib.parse import urlencode, urlsplit
 
-from rakomqtt.model import mqtt_payload_schema
+from rakomqtt.const import CONNECT_TIMEOUT, HTTP_TRANSPORT, READ_TIMEOUT, UDP_TRANSPORT
+from rakomqtt.metrics import COMMAND_HTTP_SECONDS, COMMANDS_FAILED, COMMANDS_SENT, LatencyRecorder
+from rakomqtt.payload import PayloadValidationError, load_mqtt_payload
+from rakomqtt.scenes import DEFAULT_SCENE_MAP
 
 
 _LOGGER = logging.getLogger(__name__)
 DEFAULT_TIMEOUT = 5
+HTTP_POOL_SIZE = 2
+LATENCY_LOG_INTERVAL = 100
+STATUS_CACHE_SIZE = 4096
+DEFAULT_TOPIC_PREFIX = 'rako'
 
 
 class RakoCommandType(Enum):
@@ -47,7 +55,8 @@ class RakoStatusMessage:
     brightness: int = None
 
     @classmethod
-    def from_byte_list(cls, byte_list):
+    def from_byte_list(cls, byte_list, scene_map=DEFAULT_SCENE_MAP):
+        """:param scene_map: scenes.SceneMap giving the brightness of each room's scenes"""
         if chr(byte_list[0]) != 'S':
             raise RakoDeserialisationException(f'Unsupported UDP message type: {chr(byte_list[0])}')
 
@@ -70,26 +79,52 @@ class RakoStatusMessage:
             else:
                 scene = SCENE_COMMAND_TO_NUMBER[command]
 
+            brightness = scene_map.brightness(room, scene)
+            if brightness is None:
+                raise RakoDeserialisationException(f'Room {room} has no scene {scene}')
             return cls(
                 room=room,
                 channel=channel,
                 command=RakoCommandType.SET_SCENE,
                 scene=scene,
-                brightness=cls._scene_brightness(scene),
+                brightness=brightness,
             )
 
-    @staticmethod
-    def _scene_brightness(rako_scene_number):
-        scene_brightness = {
-            # rako_scene_number: brightness
-            1: 255,
-            2: 192,
-            3: 128,
-            4: 64,
-            0: 0,
-        }
 
-        return scene_brightness[rako_scene_number]
+class CommandTopicRouter:
+    """Matches command topics against the two shapes the commander
+    subscribes to, `<prefix>/room/+/set` and `<prefix>/room/+/channel/+/set`,
+    by splitting the topic once rather than running regexes. The prefix
+    may have several levels, e.g. `rako/garage`.
+    """
+
+    def __init__(self, prefix=DEFAULT_TOPIC_PREFIX):
+        self.prefix = prefix
+        self._prefix_levels = prefix.count('/') + 1
+
+    def route(self, topic):
+        """
+        :return (room: int, channel: int or None for a room scene) or None if unrecognised
+        """
+        parts = topic.split('/')
+        if self._prefix_levels > 1:
+            parts[:self._prefix_levels] = ['/'.join(parts[:self._prefix_levels])]
+        if parts[0] != self.prefix or len(parts) < 4 or parts[1] != 'room' or parts[-1] != 'set':
+            return None
+
+        room = parts[2]
+        if not (room.isascii() and room.isdigit()):
+            return None
+        if len(parts) == 4:
+            return int(room), None
+
+        channel = parts[4] if len(parts) == 6 and parts[3] == 'channel' else ''
+        if not (channel.isascii() and channel.isdigit()):
+            return None
+        return int(room), int(channel)
+
+
+_command_topic_router = CommandTopicRouter()
 
 
 @dataclass
@@ -98,78 +133,157 @@ class RakoCommand:
     channel: int
     scene: int = None
     brightness: int = None
+    # send it even if the light is already in that state
+    force: bool = False
 
     @classmethod
-    def from_mqtt(cls, topic, payload_str):
-        m_scene = re.match('^rako/room/([0-9]+)/set$', topic)
-        m_level = re.match('^rako/room/([0-9]+)/channel/([0-9]+)/set$', topic)
-        if m_scene:
-            room_id = int(m_scene.group(1))
-            payload = mqtt_payload_schema.loads(payload_str)
+    def from_mqtt(cls, topic, payload_str, strict=False, router=None, scene_map=None):
+        """
+        :param strict: validate the payload with the marshmallow MqttPayloadSchema
+        :param router: CommandTopicRouter for the topic's prefix, `rako` if not given
+        :param scene_map: scenes.SceneMap picking a room command's scene, the default ladder if not given
+        """
+        route = (router or _command_topic_router).route(topic)
+        if route is None:
+            _LOGGER.debug('Topic unrecognised %s', topic)
+            return
 
+        room_id, channel = route
+        payload = cls._load_payload(payload_str, strict)
+        if channel is None:
             return cls(
                 room=room_id,
                 channel=0,
-                scene=cls._rako_command(payload['brightness']),
+                scene=cls._rako_command(payload['brightness'], room_id, scene_map or DEFAULT_SCENE_MAP),
+                force=payload.get('force') or False,
             )
-        elif m_level:
-            room_id = int(m_level.group(1))
-            channel = int(m_level.group(2))
-            payload = mqtt_payload_schema.loads(payload_str)
-
+        else:
             return cls(
                 room=room_id,
                 channel=channel,
                 brightness=payload['brightness'],
+                force=payload.get('force') or False,
             )
-        else:
-            _LOGGER.debug(f"Topic unrecognised ${topic}")
-            return
 
     @staticmethod
-    def _rako_command(brightness):
+    def _load_payload(payload_str, strict):
+        if strict:
+            from marshmallow import ValidationError
+            from rakomqtt.model import mqtt_payload_schema
+            try:
+                return mqtt_payload_schema.loads(payload_str)
+            except ValidationError as ex:
+                raise PayloadValidationError(ex.messages) from ex
+            except KeyError as ex:
+                # post_load needs a state when there's no brightness
+                raise PayloadValidationError({'state': ['Missing data for required field.']}) from ex
+        return load_mqtt_payload(payload_str)
+
+    @staticmethod
+    def _rako_command(brightness, room=None, scene_map=DEFAULT_SCENE_MAP):
         """Return the rako scene of the light. This directly corresponds
         to the value of the button on the app and is accessed through the
         brightness
 
         :param brightness: int representing brightness 0-255
         """
-
-        scene_windows = {
-            # rako_scene: (brightness_high, brightness_low)
-            1: dict(low=224, high=256),  # expect 255 (100%)
-            2: dict(low=160, high=224),  # expect 192 (75%)
-            3: dict(low=96, high=160),  # expect 128 (50%)
-            4: dict(low=1, high=96),  # expect 64 (25%)
-            0: dict(low=0, high=1),  # expect 0 (0%)
-        }
-
-        scene = [k for k, v in scene_windows.items() if v['low'] <= brightness < v['high']]
-        return scene[0]
+        return scene_map.scene(room, brightness)
 
 
 class RakoBridge:
     # for devices http://192.168.0.10/rako.xml
     port = 9761
 
-    def __init__(self, host=None):
-        self.host = host if host else self.find_bridge()
+    def __init__(
+        self,
+        host=None,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        keep_alive=True,
+        transport=HTTP_TRANSPORT,
+        udp_repeat=1,
+        udp_spacing=0.0,
+        pool_size=HTTP_POOL_SIZE,
+    ):
+        """
+        :param transport: send commands over HTTP_TRANSPORT (rako.cgi) or UDP_TRANSPORT (binary frames)
+        :param udp_repeat: with UDP_TRANSPORT, send each command frame this many times
+        :param udp_spacing: seconds between udp frames sent back to back
+        :param pool_size: keep-alive connections kept open to the bridge, for commands sent in parallel
+        """
+        self._timeout = (connect_timeout, read_timeout)
+        self._keep_alive = keep_alive
+        self._pool_size = pool_size
+        self.transport = transport
+        self._udp_options = dict(repeat=udp_repeat, spacing=udp_spacing)
+        # clients are created on the first command, so requests/asyncio
+        # aren't imported by processes which never send one
+        self._session = None
+        # idle AsyncHttpConnections
+        self._async_connections = []
+        self._udp_transport = None
+        self.command_latency = LatencyRecorder()
+        self.set_host(host if host else self.find_bridge())
+
+    def set_host(self, host):
+        """Point at a (re)discovered bridge"""
+        self.host = host
         self._url = 'http://{}/rako.cgi'.format(self.host)
 
+    @staticmethod
+    def _create_session(pool_size=HTTP_POOL_SIZE):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # a single small pool of keep-alive connections to the bridge. idle
+        # connections are reused and ones the bridge has closed are discarded
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        return session
+
     @classmethod
     def find_bridge(cls):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sock.settimeout(DEFAULT_TIMEOUT)
+        host = cls.discover()
+        if host:
+            return host
+        else:
+            _LOGGER.error('Cannot find a rakobrige')
+            exit(1)
+
+    @classmethod
+    def discover(cls):
+        """:return the ip of the first bridge to answer a discovery broadcast, or None"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.settimeout(DEFAULT_TIMEOUT)
+            resp = cls.poll_for_bridge_response(sock)
 
-        resp = cls.poll_for_bridge_response(sock)
         if resp:
             _, (host, _) = resp
             _LOGGER.debug(f'found rako bridge at {host}')
             return host
-        else:
-            _LOGGER.error('Cannot find a rakobrige')
-            exit(1)
+
+    @classmethod
+    def discover_all(cls, timeout=DEFAULT_TIMEOUT):
+        """:return the ips of every bridge which answers a discovery broadcast within timeout"""
+        hosts = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(('', 0))
+            _LOGGER.debug("Broadcasting to find every rako bridge...")
+            sock.sendto(b'D', ('255.255.255.255', cls.port))
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    _, (host, _) = sock.recvfrom(256)
+                except socket.timeout:
+                    break
+                if host not in hosts:
+                    _LOGGER.debug(f'found rako bridge at {host}')
+                    hosts.append(host)
+        return hosts
 
     @classmethod
     def poll_for_bridge_response(cls, sock):
@@ -187,25 +301,146 @@ class RakoBridge:
                 _LOGGER.debug(f"No rako bridge found on try #{i}")
                 i = i + 1
 
-    def post_command(self, rako_command: RakoCommand):
+    @staticmethod
+    def command_params(rako_command: RakoCommand):
         if rako_command.scene is not None:
-            payload = {
+            return {
                 'room': rako_command.room,
                 'ch': rako_command.channel,
                 'sc': rako_command.scene,
             }
         else:
-            payload = {
+            return {
                 'room': rako_command.room,
                 'ch': rako_command.channel,
                 'lev': rako_command.brightness,
             }
 
+    def post_command(self, rako_command: RakoCommand):
+        """Send the command to the bridge.
+
+        :return True if the bridge accepted the command
+        """
+        if self.transport == UDP_TRANSPORT:
+            return self._udp_result(self._udp().send(rako_command))
+
+        import requests
+
+        payload = self.command_params(rako_command)
+        _LOGGER.debug('payload %s', payload)
+
+        for attempt in (1, 2):
+            start = time.monotonic()
+            try:
+                self._send(payload)
+            except requests.Timeout:
+                _LOGGER.error(f"Timed out sending command to {self._url}. Is resource/endpoint offline?")
+            except requests.ConnectionError:
+                if attempt == 1 and self._keep_alive:
+                    # the bridge closes idle sockets on its own schedule. the
+                    # dead connection has been dropped from the pool so retry
+                    # once on a fresh one
+                    _LOGGER.debug('Connection to bridge dropped, reconnecting')
+                    continue
+                _LOGGER.error(f"Can't turn on {self._url}. Is resource/endpoint offline?")
+            except requests.RequestException as ex:
+                _LOGGER.error(f"Bridge rejected command to {self._url}: {ex}")
+            else:
+                self._record_latency(time.monotonic() - start)
+                COMMANDS_SENT.inc()
+                return True
+            COMMANDS_FAILED.inc()
+            return False
+
+    def _send(self, payload):
+        if self._keep_alive:
+            if self._session is None:
+                self._session = self._create_session(self._pool_size)
+            response = self._session.post(self._url, params=payload, timeout=self._timeout)
+        else:
+            import requests
+            response = requests.post(self._url, params=payload, timeout=self._timeout)
+        response.raise_for_status()
+
+    async def post_command_async(self, rako_command: RakoCommand):
+        """post_command for the asyncio engine, over a keep-alive connection
+        to the bridge. Commands sent in parallel each get their own, up to
+        pool_size are kept open between commands.
+
+        :return True if the bridge accepted the command
+        """
+        if self.transport == UDP_TRANSPORT:
+            return self._udp_result(await self._udp().send_async(rako_command))
+
+        payload = self.command_params(rako_command)
+        _LOGGER.debug('payload %s', payload)
+        target = '/rako.cgi?' + urlencode(payload)
+
+        connection = self._take_async_connection()
         try:
-            _LOGGER.debug('payload {}'.format(payload))
-            requests.post(self._url, params=payload, timeout=DEFAULT_TIMEOUT)
-        except HTTPError:
-            _LOGGER.error(f"Can't turn on {self._url}. Is resource/endpoint offline?")
+            return await self._post_async(connection, target)
+        finally:
+            if len(self._async_connections) < self._pool_size:
+                self._async_connections.append(connection)
+            else:
+                connection.close()
+
+    def _take_async_connection(self):
+        from rakomqtt.async_http import AsyncHttpConnection
+
+        url = urlsplit(self._url)
+        address = (url.hostname, url.port or 80)
+        while self._async_connections:
+            connection = self._async_connections.pop()
+            if (connection.host, connection.port) == address:
+                return connection
+            # the bridge has been rediscovered somewhere else
+            connection.close()
+        return AsyncHttpConnection(*address, *self._timeout)
+
+    async def _post_async(self, connection, target):
+        import asyncio
+        from rakomqtt.async_http import HttpStatusError
+
+        for attempt in (1, 2):
+            reused = connection.connected
+            start = time.monotonic()
+            try:
+                await connection.request('POST', target)
+            except asyncio.TimeoutError:
+                _LOGGER.error(f"Timed out sending command to {self._url}. Is resource/endpoint offline?")
+            except (ConnectionError, OSError):
+                if attempt == 1 and reused:
+                    _LOGGER.debug('Connection to bridge dropped, reconnecting')
+                    continue
+                _LOGGER.error(f"Can't turn on {self._url}. Is resource/endpoint offline?")
+            except HttpStatusError as ex:
+                _LOGGER.error(f"Bridge rejected command to {self._url}: {ex}")
+            else:
+                self._record_latency(time.monotonic() - start)
+                COMMANDS_SENT.inc()
+                return True
+            COMMANDS_FAILED.inc()
+            return False
+
+    def _udp(self):
+        from rakomqtt.udp_commands import UdpCommandTransport
+
+        host = urlsplit(self._url).hostname
+        if self._udp_transport is None or self._udp_transport.address[0] != host:
+            self._udp_transport = UdpCommandTransport(host, self.port, **self._udp_options)
+        return self._udp_transport
+
+    @staticmethod
+    def _udp_result(sent):
+        (COMMANDS_SENT if sent else COMMANDS_FAILED).inc()
+        return sent
+
+    def _record_latency(self, seconds):
+        self.command_latency.observe(seconds)
+        COMMAND_HTTP_SECONDS.observe(seconds)
+        if self.command_latency.count % LATENCY_LOG_INTERVAL == 0:
+            _LOGGER.info(f"Bridge command latency: {self.command_latency.summary()}")
 
     @property
     def found_bridge(self):
@@ -218,12 +453,12 @@ class RakoBridge:
         :param byte_list: List(Int)
         :return (topic: str, mqtt_payload: dict)
         """
-        _LOGGER.debug(f'received byte_list: {byte_list}')
+        _LOGGER.debug('received byte_list: %s', byte_list)
 
         try:
             rako_status_message = RakoStatusMessage.from_byte_list(byte_list)
         except (RakoDeserialisationException, ValueError, IndexError) as ex:
-            _LOGGER.debug(f'unhandled bytestring: {ex}')
+            _LOGGER.debug('unhandled bytestring: %s', ex)
             return
 
         topic = cls.create_topic(rako_status_message)
@@ -232,16 +467,113 @@ class RakoBridge:
         return topic, payload
 
     @staticmethod
-    def create_topic(rako_status_message: RakoStatusMessage):
+    def create_topic(rako_status_message: RakoStatusMessage, prefix=DEFAULT_TOPIC_PREFIX):
         if rako_status_message.command == RakoCommandType.SET_LEVEL:
-            return f"rako/room/{rako_status_message.room}/channel/{rako_status_message.channel}"
+            return f"{prefix}/room/{rako_status_message.room}/channel/{rako_status_message.channel}"
         else:
-            return f"rako/room/{rako_status_message.room}"
+            return f"{prefix}/room/{rako_status_message.room}"
 
     @staticmethod
     def create_payload(rako_status_message: RakoStatusMessage):
         return dict(state=('ON' if rako_status_message.brightness else 'OFF'), brightness=rako_status_message.brightness)
 
 
+def status_checksum_ok(frame):
+    """Status frames end with a CRC which makes the bytes after the
+    bytes-to-follow byte sum to 0 (mod 256)
+    """
+    return sum(frame[2:]) & 0xFF == 0
+
+
+class RakoStatusDecoder:
+    """Turns raw status frames from the bridge into (topic, payload) pairs
+    ready to publish.
+
+    There are only so many distinct frames a bridge sends, so each decoded
+    frame is cached against its raw bytes. A repeat frame costs a single
+    dict lookup and returns the same interned topic and pre-serialised json
+    payload bytes. The cache holds at most `cache_size` frames, the oldest
+    are evicted first.
+
+    Given a topology.Topology, a room scene frame also decodes to the level
+    of each of the room's channels, from the scene levels in rako.xml.
+    """
+
+    def __init__(
+        self,
+        cache_size=STATUS_CACHE_SIZE,
+        verify_checksum=True,
+        topology=None,
+        topic_prefix=DEFAULT_TOPIC_PREFIX,
+        scene_map=None,
+    ):
+        """:param scene_map: scenes.SceneMap giving the brightness of each room's scenes"""
+        self._cache = {}
+        self._cache_size = cache_size
+        self._verify_checksum = verify_checksum
+        self.topology = topology
+        self.topic_prefix = topic_prefix
+        self.scene_map = scene_map or DEFAULT_SCENE_MAP
+
+    def decode(self, frame):
+        """
+        :param frame: bytes, bytearray or memoryview of a single udp datagram
+        :return (topic: str, mqtt_payload: bytes) or None if it isn't a valid status frame
+        """
+        states = self.decode_states(frame)
+        return states[0] if states else None
+
+    def decode_states(self, frame):
+        """
+        :return tuple of (topic, mqtt_payload) for the frame's own state
+        followed by any channel states derived from it, empty if it isn't a
+        valid status frame
+        """
+        if type(frame) is not bytes:
+            # writable buffers (bytearray, memoryview) aren't hashable
+            frame = bytes(frame)
+        try:
+            return self._cache[frame]
+        except KeyError:
+            pass
+
+        states = self._decode(frame)
+        if states:
+            if len(self._cache) >= self._cache_size:
+                del self._cache[next(iter(self._cache))]
+            self._cache[frame] = states
+        return states
+
+    def _decode(self, frame):
+        if len(frame) < 7 or frame[1] + 2 != len(frame):
+            _LOGGER.debug('unhandled bytestring, bad length: %r', frame)
+            return ()
+        if self._verify_checksum and not status_checksum_ok(frame):
+            _LOGGER.debug('unhandled bytestring, bad checksum: %r', frame)
+            return ()
+
+        try:
+            rako_status_message = RakoStatusMessage.from_byte_list(frame, self.scene_map)
+        except (RakoDeserialisationException, ValueError, IndexError, KeyError) as ex:
+            _LOGGER.debug('unhandled bytestring: %s', ex)
+            return ()
+
+        topic = sys.intern(RakoBridge.create_topic(rako_status_message, self.topic_prefix))
+        payload = json.dumps(RakoBridge.create_payload(rako_status_message)).encode()
+        return ((topic, payload),) + self._derived_states(rako_status_message)
+
+    def _derived_states(self, rako_status_message):
+        if self.topology is None or rako_status_message.command != RakoCommandType.SET_SCENE:
+            return ()
+        room = rako_status_message.room
+        return tuple(
+            (
+                sys.intern(f"{self.topic_prefix}/room/{room}/channel/{channel}"),
+                json.dumps(dict(state='ON' if level else 'OFF', brightness=level)).encode(),
+            )
+            for channel, level in self.topology.scene_levels(room, rako_status_message.channel, rako_status_message.scene)
+        )
+
+
 if __name__ == '__main__':
     print(RakoBridge().host)
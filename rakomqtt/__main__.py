@@ -3,14 +3,66 @@ import argparse
 import logging
 import sys
 
-from rakomqtt.commander import run_commander
-from rakomqtt.const import __version__, REQUIRED_PYTHON_VER
-from rakomqtt.watcher import run_watcher
+from rakomqtt.const import (
+    __version__,
+    CONNECT_TIMEOUT,
+    DEFAULT_COMMAND_RATE,
+    DEFAULT_COMPACTION_WINDOW,
+    DEFAULT_CONFIRM_RETRIES,
+    DEFAULT_CONFIRM_TIMEOUT,
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_PENDING,
+    DEFAULT_QOS,
+    DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_RECONNECT_MIN_DELAY,
+    DEFAULT_UDP_BATCH_SIZE,
+    DEFAULT_UDP_RCVBUF,
+    HTTP_TRANSPORT,
+    READ_TIMEOUT,
+    REQUIRED_PYTHON_VER,
+    UDP_TRANSPORT,
+)
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def parse_bridge_spec(value):
+    """bridges.parse_bridge_spec, imported only when --bridge is given"""
+    from rakomqtt.bridges import parse_bridge_spec
+
+    return parse_bridge_spec(value)
+
+
+def bridge_specs(args):
+    """The --bridge BridgeSpecs, or with --discover-bridges those of every bridge which answers"""
+    if args.bridges or not args.discover_bridges:
+        return args.bridges
+    from rakomqtt.bridges import discover_bridge_specs
+
+    return discover_bridge_specs()
+
+
+def load_scene_map(path):
+    """The --scene-config SceneMap, None without one. Exits if it can't be loaded"""
+    if not path:
+        return None
+    from rakomqtt.scenes import SceneMap
+    try:
+        return SceneMap.load(path)
+    except (OSError, ValueError, AttributeError) as ex:
+        _LOGGER.error(f"Can't load --scene-config {path}: {ex}")
+        exit(1)
+
+
+def frame_recorder(path):
+    """The --record FrameRecorder, None without one"""
+    if not path:
+        return None
+    from rakomqtt.recorder import FrameRecorder
+    return FrameRecorder(path)
+
+
 def validate_python() -> None:
     """Validate that the right Python version is running."""
     if sys.version_info[:3] < REQUIRED_PYTHON_VER:
@@ -36,7 +88,7 @@ def get_args() -> argparse.Namespace:
         "--mode",
         dest='mode',
         type=str,
-        choices=['watcher', 'commander'],
+        choices=['watcher', 'commander', 'combined', 'replay'],
         required=True,
         help="which mode to start rakomqtt in",
     )
@@ -44,31 +96,241 @@ def get_args() -> argparse.Namespace:
     parser.add_argument(
         "--rako-bridge-host",
         type=str,
-        help="host name/ip of the rako bridge (Required for commander)",
+        help="host name/ip of the rako bridge (Required for commander, discovered if not given otherwise)",
+    )
+
+    parser.add_argument(
+        "--bridge",
+        dest='bridges',
+        type=parse_bridge_spec,
+        action='append',
+        metavar='PREFIX=HOST',
+        help="serve this rako bridge, with its topics under PREFIX (e.g. rako/garage=192.168.1.20). "
+             "Repeat for each bridge to serve several from one process",
+    )
+
+    parser.add_argument(
+        "--discover-bridges",
+        action="store_true",
+        help="serve every rako bridge which answers discovery, with topics under rako/<bridge ip>",
+    )
+
+    parser.add_argument(
+        "--http-connect-timeout",
+        type=float,
+        default=CONNECT_TIMEOUT,
+        help="seconds to wait for a connection to the rako bridge",
+    )
+
+    parser.add_argument(
+        "--http-read-timeout",
+        type=float,
+        default=READ_TIMEOUT,
+        help="seconds to wait for the rako bridge to answer a command",
+    )
+
+    parser.add_argument(
+        "--no-http-keep-alive",
+        dest='http_keep_alive',
+        action="store_false",
+        help="open a new connection to the rako bridge for every command",
+    )
+
+    parser.add_argument(
+        "--command-transport",
+        type=str,
+        choices=[HTTP_TRANSPORT, UDP_TRANSPORT],
+        default=HTTP_TRANSPORT,
+        help="send commands to the rako bridge with http rako.cgi or as udp frames (faster, but unacknowledged)",
+    )
+
+    parser.add_argument(
+        "--udp-command-repeat",
+        type=int,
+        default=1,
+        help="with the udp command transport, send each command this many times",
+    )
+
+    parser.add_argument(
+        "--udp-command-spacing",
+        type=float,
+        default=0.0,
+        help="seconds between repeated udp command frames",
+    )
+
+    parser.add_argument(
+        "--command-rate",
+        type=float,
+        help=f"maximum commands per second sent to the rako bridge (0 for no limit, "
+             f"default {DEFAULT_COMMAND_RATE}, or no limit with --adaptive-concurrency)",
+    )
+
+    parser.add_argument(
+        "--compaction-window",
+        type=float,
+        default=DEFAULT_COMPACTION_WINDOW,
+        help="seconds to hold a command so commands setting every channel of a room to one level can be sent "
+             "as a single room command (0 to disable, needs the topology)",
+    )
+
+    parser.add_argument(
+        "--strict-payload-validation",
+        dest='strict_payloads',
+        action="store_true",
+        help="validate command payloads with marshmallow rather than the built in validator",
+    )
+
+    parser.add_argument(
+        "--no-topology",
+        dest='use_topology',
+        action="store_false",
+        help="don't load the rooms and channels from the rako bridge's rako.xml (used to reject commands "
+             "for unknown rooms/channels and to publish channel levels for room scenes)",
+    )
+
+    parser.add_argument(
+        "--udp-rcvbuf",
+        type=int,
+        default=DEFAULT_UDP_RCVBUF,
+        help="size in bytes of the watcher's udp receive buffer",
+    )
+
+    parser.add_argument(
+        "--udp-batch-size",
+        type=int,
+        default=DEFAULT_UDP_BATCH_SIZE,
+        help="maximum number of udp status frames the watcher reads per wakeup",
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve prometheus metrics on this port (the commander uses the next port up, "
+             "so it can run alongside the watcher)",
     )
 
     parser.add_argument(
         "--mqtt-host",
         type=str,
-        required=True,
         help="host name/ip of the mqtt server",
     )
 
     parser.add_argument(
         "--mqtt-user",
         type=str,
-        required=True,
         help="username to use when logging into the mqtt server",
     )
 
     parser.add_argument(
         "--mqtt-password",
         type=str,
-        required=True,
         help="password to use when logging into the mqtt server",
     )
 
+    parser.add_argument(
+        "--mqtt-qos",
+        type=int,
+        choices=[0, 1, 2],
+        default=DEFAULT_QOS,
+        help="qos of the state messages published",
+    )
+
+    parser.add_argument(
+        "--mqtt-max-inflight",
+        type=int,
+        default=DEFAULT_MAX_INFLIGHT,
+        help="maximum state messages handed to the mqtt broker but not yet acknowledged",
+    )
+
+    parser.add_argument(
+        "--mqtt-max-pending",
+        type=int,
+        default=DEFAULT_MAX_PENDING,
+        help="maximum topics with a state message waiting to be published, the oldest are dropped beyond this",
+    )
+
+    parser.add_argument(
+        "--mqtt-reconnect-min-delay",
+        type=float,
+        default=DEFAULT_RECONNECT_MIN_DELAY,
+        help="seconds before the first attempt to reconnect to the mqtt broker",
+    )
+
+    parser.add_argument(
+        "--mqtt-reconnect-max-delay",
+        type=float,
+        default=DEFAULT_RECONNECT_MAX_DELAY,
+        help="most seconds between attempts to reconnect to the mqtt broker, "
+             "the jittered wait doubles up to this with each failed attempt",
+    )
+
+    parser.add_argument(
+        "--adaptive-concurrency",
+        metavar='MAX',
+        type=int,
+        default=0,
+        help="send up to MAX commands to the bridge at once, as many as it keeps up with "
+             "(0 to send one at a time, see rakomqtt/dispatch.py)",
+    )
+
+    parser.add_argument(
+        "--confirm-timeout",
+        type=float,
+        default=DEFAULT_CONFIRM_TIMEOUT,
+        help="seconds to wait for the bridge's status frame confirming a command before sending it again "
+             "(0 to not wait for confirmations)",
+    )
+
+    parser.add_argument(
+        "--confirm-retries",
+        type=int,
+        default=DEFAULT_CONFIRM_RETRIES,
+        help="times to send a command the bridge hasn't confirmed again",
+    )
+
+    parser.add_argument(
+        "--no-skip-redundant",
+        dest='skip_redundant',
+        action='store_false',
+        help="send every command, even for a light the watcher says is already in that state",
+    )
+
+    parser.add_argument(
+        "--scene-config",
+        metavar='PATH',
+        help="json file of the brightness of each room's scenes, see rakomqtt/scenes.py",
+    )
+
+    parser.add_argument(
+        "--record",
+        metavar='PATH',
+        help="append the udp status frames and mqtt command messages received to this binary log",
+    )
+
+    parser.add_argument(
+        "--replay",
+        dest='replay_path',
+        metavar='PATH',
+        help="the log to replay in replay mode",
+    )
+
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="replay at this multiple of the recorded speed (0 for as fast as possible)",
+    )
+
     arguments = parser.parse_args()
+    if arguments.mode == 'replay':
+        if not arguments.replay_path:
+            parser.error("--replay is required in replay mode")
+    elif not (arguments.mqtt_host and arguments.mqtt_user and arguments.mqtt_password):
+        parser.error("--mqtt-host, --mqtt-user and --mqtt-password are required")
+    if not 0 < arguments.mqtt_reconnect_min_delay <= arguments.mqtt_reconnect_max_delay:
+        parser.error("--mqtt-reconnect-min-delay must be above 0 and at most --mqtt-reconnect-max-delay")
+    if arguments.adaptive_concurrency < 0:
+        parser.error("--adaptive-concurrency can't be negative")
     return arguments
 
 
@@ -84,6 +346,22 @@ def setup_logging(rakomqtt_mode, debug: bool = False) -> None:
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
+def load_mode(rakomqtt_mode):
+    """Import only the modules the mode needs and return its run function"""
+    if rakomqtt_mode == "watcher":
+        from rakomqtt.watcher import run_watcher
+        return run_watcher
+    elif rakomqtt_mode == "commander":
+        from rakomqtt.commander import run_commander
+        return run_commander
+    elif rakomqtt_mode == "combined":
+        from rakomqtt.combined import run_combined
+        return run_combined
+    elif rakomqtt_mode == "replay":
+        from rakomqtt.recorder import run_replay
+        return run_replay
+
+
 def run():
     validate_python()
 
@@ -92,13 +370,96 @@ def run():
     setup_logging(args.mode, args.debug)
 
     _LOGGER.debug(f'Running the rakomqtt {args.mode}')
+    if args.metrics_port is not None:
+        from rakomqtt.metrics import start_metrics_server
+
+        start_metrics_server(args.metrics_port + 1 if args.mode == "commander" else args.metrics_port)
+
+    run_mode = load_mode(args.mode)
+    if args.mode == "replay":
+        run_mode(args.replay_path, replay_speed=args.replay_speed, strict_payloads=args.strict_payloads)
+        return
+
+    bridges = bridge_specs(args)
+    scene_map = load_scene_map(args.scene_config)
+    recorder = frame_recorder(args.record)
+
     if args.mode == "watcher":
-        run_watcher(args.mqtt_host, args.mqtt_user, args.mqtt_password)
+        run_mode(
+            args.mqtt_host,
+            args.mqtt_user,
+            args.mqtt_password,
+            udp_rcvbuf=args.udp_rcvbuf,
+            udp_batch_size=args.udp_batch_size,
+            rako_bridge_host=args.rako_bridge_host,
+            use_topology=args.use_topology,
+            bridges=bridges,
+            recorder=recorder,
+            mqtt_qos=args.mqtt_qos,
+            mqtt_max_inflight=args.mqtt_max_inflight,
+            mqtt_max_pending=args.mqtt_max_pending,
+            mqtt_reconnect_min_delay=args.mqtt_reconnect_min_delay,
+            mqtt_reconnect_max_delay=args.mqtt_reconnect_max_delay,
+            scene_map=scene_map,
+        )
     elif args.mode == "commander":
-        if not args.rako_bridge_host:
-            _LOGGER.error("--rako-bridge-host must be supplied for the commander")
+        if not (args.rako_bridge_host or bridges):
+            _LOGGER.error("--rako-bridge-host (or --bridge) must be supplied for the commander")
             exit(1)
-        run_commander(args.rako_bridge_host, args.mqtt_host, args.mqtt_user, args.mqtt_password)
+        run_mode(
+            args.rako_bridge_host,
+            args.mqtt_host,
+            args.mqtt_user,
+            args.mqtt_password,
+            http_connect_timeout=args.http_connect_timeout,
+            http_read_timeout=args.http_read_timeout,
+            http_keep_alive=args.http_keep_alive,
+            command_transport=args.command_transport,
+            udp_command_repeat=args.udp_command_repeat,
+            udp_command_spacing=args.udp_command_spacing,
+            command_rate=args.command_rate,
+            strict_payloads=args.strict_payloads,
+            use_topology=args.use_topology,
+            compaction_window=args.compaction_window,
+            confirm_timeout=args.confirm_timeout,
+            confirm_retries=args.confirm_retries,
+            skip_redundant=args.skip_redundant,
+            adaptive_concurrency=args.adaptive_concurrency,
+            bridges=bridges,
+            recorder=recorder,
+            mqtt_reconnect_min_delay=args.mqtt_reconnect_min_delay,
+            mqtt_reconnect_max_delay=args.mqtt_reconnect_max_delay,
+            scene_map=scene_map,
+        )
+    elif args.mode == "combined":
+        run_mode(
+            args.rako_bridge_host,
+            args.mqtt_host,
+            args.mqtt_user,
+            args.mqtt_password,
+            http_connect_timeout=args.http_connect_timeout,
+            http_read_timeout=args.http_read_timeout,
+            command_transport=args.command_transport,
+            udp_command_repeat=args.udp_command_repeat,
+            udp_command_spacing=args.udp_command_spacing,
+            command_rate=args.command_rate,
+            udp_rcvbuf=args.udp_rcvbuf,
+            strict_payloads=args.strict_payloads,
+            use_topology=args.use_topology,
+            compaction_window=args.compaction_window,
+            confirm_timeout=args.confirm_timeout,
+            confirm_retries=args.confirm_retries,
+            skip_redundant=args.skip_redundant,
+            adaptive_concurrency=args.adaptive_concurrency,
+            bridges=bridges,
+            recorder=recorder,
+            mqtt_qos=args.mqtt_qos,
+            mqtt_max_inflight=args.mqtt_max_inflight,
+            mqtt_max_pending=args.mqtt_max_pending,
+            mqtt_reconnect_min_delay=args.mqtt_reconnect_min_delay,
+            mqtt_reconnect_max_delay=args.mqtt_reconnect_max_delay,
+            scene_map=scene_map,
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class HttpStatusError(Exception):
+    pass
+
+
+class AsyncHttpConnection:
+    """A single keep-alive HTTP/1.1 connection driven by asyncio streams.
+
+    Just enough of HTTP for talking to the rako bridge: bodiless requests and
+    responses framed by Content-Length, chunked encoding or connection close.
+    Requests are sent one at a time. The connection is opened lazily and
+    reopened after the server closes it.
+    """
+
+    def __init__(self, host, port=80, connect_timeout=None, read_timeout=None):
+        self.host = host
+        self.port = port
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def request(self, method, target):
+        """
+        :return (status: int, body: bytes)
+        :raise HttpStatusError for a non 2xx response, ConnectionError or
+            asyncio.TimeoutError when the connection fails
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+
+            request = (
+                f"{method} {target} HTTP/1.1\r\n"
+                f"Host: {self.host}\r\n"
+                "Content-Length: 0\r\n"
+                "\r\n"
+            )
+            try:
+                self._writer.write(request.encode('latin-1'))
+                await self._writer.drain()
+                status, body, keep_alive = await asyncio.wait_for(self._read_response(), self._read_timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as ex:
+                self.close()
+                if isinstance(ex, asyncio.TimeoutError):
+                    raise
+                raise ConnectionError(f"connection to {self.host}:{self.port} lost: {ex!r}") from ex
+
+            if not keep_alive:
+                self.close()
+
+        if not 200 <= status < 300:
+            raise HttpStatusError(f"{status} response from {self.host}:{self.port}{target}")
+        return status, body
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            self._connect_timeout,
+        )
+        _LOGGER.debug('opened connection to %s:%s', self.host, self.port)
+
+    async def _read_response(self):
+        status_line = await self._reader.readuntil(b'\r\n')
+        version, status = status_line.split(b' ', 2)[:2]
+
+        headers = {}
+        while True:
+            line = await self._reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = headers.get('connection') != 'close' and version != b'HTTP/1.0'
+        if 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            body = await self._read_chunked()
+        else:
+            body = await self._reader.read()
+            keep_alive = False
+
+        return int(status), body, keep_alive
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self._reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            chunk = await self._reader.readexactly(size + 2)
+            if size == 0:
+                return b''.join(chunks)
+            chunks.append(chunk[:-2])
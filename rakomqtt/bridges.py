@@ -0,0 +1,170 @@
+"""Serving several rako bridges from one process.
+
+Each bridge gets its own topic prefix (`rako` when there's only one, so the
+topics are the same as they've always been), its own RakoBridge and so its
+own connection pool, its own command queue and worker, and its own status
+decoder. Status frames are handed to the decoder of the bridge they came
+from by their source address.
+"""
+import logging
+import socket
+import sys
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from rakomqtt.discovery import verify_in_background
+from rakomqtt.RakoBridge import DEFAULT_TOPIC_PREFIX, CommandTopicRouter, RakoBridge, RakoStatusDecoder
+from rakomqtt.scenes import DEFAULT_SCENE_MAP
+from rakomqtt.topology import load_topology
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass
+class BridgeSpec:
+    host: str
+    topic_prefix: str = DEFAULT_TOPIC_PREFIX
+
+
+def parse_bridge_spec(value):
+    """:param value: `PREFIX=HOST`, or just `HOST` for the default topic prefix"""
+    prefix, _, host = value.rpartition('=')
+    prefix = prefix.strip('/')
+    if not host or '/room/' in f'{prefix}/' or '+' in prefix or '#' in prefix:
+        raise ValueError(f"Invalid rako bridge {value!r}, expected PREFIX=HOST")
+    return BridgeSpec(host, prefix or DEFAULT_TOPIC_PREFIX)
+
+
+def discover_bridge_specs():
+    """Every bridge which answers discovery, each with a `rako/<ip>` topic
+    prefix. Exits if there are none, like RakoBridge.find_bridge
+    """
+    hosts = RakoBridge.discover_all()
+    if not hosts:
+        _LOGGER.error('Cannot find a rakobrige')
+        sys.exit(1)
+    _LOGGER.info(f"Found rako bridges at {', '.join(hosts)}")
+    return [BridgeSpec(host, f'{DEFAULT_TOPIC_PREFIX}/{host}') for host in hosts]
+
+
+def command_subscriptions(topic_prefixes, states=False):
+    """:param states: also subscribe to the room and channel states the watcher publishes"""
+    subscriptions = [
+        subscription
+        for prefix in topic_prefixes
+        for subscription in ((f"{prefix}/room/+/set", 1), (f"{prefix}/room/+/channel/+/set", 1))
+    ]
+    if states:
+        subscriptions += [
+            subscription
+            for prefix in topic_prefixes
+            for subscription in ((f"{prefix}/room/+", 0), (f"{prefix}/room/+/channel/+", 0))
+        ]
+    return subscriptions
+
+
+def connect_bridges(specs, use_topology=True, scene_map=None, **rako_bridge_options):
+    """:return Bridges with a RakoBridge, created with rako_bridge_options, for each BridgeSpec
+
+    :param scene_map: scenes.SceneMap for every bridge, completed from each one's topology
+    """
+    scene_map = scene_map or DEFAULT_SCENE_MAP
+    bridges = []
+    for spec in specs:
+        rako_bridge = RakoBridge(spec.host, **rako_bridge_options)
+        verify_in_background(rako_bridge)
+        topology = load_topology(rako_bridge.host) if use_topology else None
+        bridges.append(Bridge(spec, rako_bridge, topology, scene_map.for_topology(topology)))
+    return Bridges(bridges)
+
+
+def bridge_ip(host):
+    """:return the ip of a bridge host, which may be host:port like the simulator's"""
+    return socket.gethostbyname(urlsplit('//' + host).hostname)
+
+
+def status_demultiplexer(specs, use_topology=True, scene_map=None):
+    """A StatusDemultiplexer for the watcher, which only needs each bridge's address, topology and scenes"""
+    scene_map = scene_map or DEFAULT_SCENE_MAP
+    decoders = {}
+    for spec in specs:
+        topology = load_topology(spec.host) if use_topology else None
+        decoders[bridge_ip(spec.host)] = RakoStatusDecoder(
+            topology=topology, topic_prefix=spec.topic_prefix, scene_map=scene_map.for_topology(topology)
+        )
+    return StatusDemultiplexer(decoders)
+
+
+class Bridge:
+    """A rako bridge this process serves"""
+
+    def __init__(self, spec, rako_bridge, topology=None, scene_map=None):
+        self.topic_prefix = spec.topic_prefix
+        self.rako_bridge = rako_bridge
+        self.topology = topology
+        self.scene_map = scene_map or DEFAULT_SCENE_MAP
+        self.router = CommandTopicRouter(spec.topic_prefix)
+        self.command_queue = None
+        # confirmation.CommandConfirmations of the commands sent, if they're confirmed
+        self.confirmations = None
+        # state.ConfirmedStates of its lights, if redundant commands are skipped
+        self.states = None
+        # dispatch.CommandDispatcher, if commands are sent several at once
+        self.dispatcher = None
+
+    def status_decoder(self):
+        return RakoStatusDecoder(topology=self.topology, topic_prefix=self.topic_prefix, scene_map=self.scene_map)
+
+
+class Bridges:
+    def __init__(self, bridges):
+        self._by_prefix = {bridge.topic_prefix: bridge for bridge in bridges}
+        if len(self._by_prefix) != len(bridges):
+            raise ValueError('Each rako bridge needs its own topic prefix')
+        self._bridges = bridges
+        self._by_ip = None
+
+    def __iter__(self):
+        return iter(self._bridges)
+
+    def __len__(self):
+        return len(self._bridges)
+
+    def subscriptions(self, states=False):
+        return command_subscriptions(self._by_prefix, states)
+
+    def for_topic(self, topic):
+        """:return the Bridge a command topic is for, or None"""
+        return self._by_prefix.get(topic.partition('/room/')[0])
+
+    def for_address(self, address):
+        """:return the Bridge status frames from the (ip, port) address came
+        from, or None. With a single bridge that's every address, as in StatusDemultiplexer
+        """
+        if len(self._bridges) == 1:
+            return self._bridges[0]
+        if self._by_ip is None:
+            self._by_ip = {bridge_ip(bridge.rako_bridge.host): bridge for bridge in self._bridges}
+        return self._by_ip.get(address[0])
+
+    def status_demultiplexer(self):
+        return StatusDemultiplexer({
+            bridge_ip(bridge.rako_bridge.host): bridge.status_decoder() for bridge in self._bridges
+        })
+
+
+class StatusDemultiplexer:
+    """Picks the status decoder for a frame by the address it came from.
+    With a single bridge its decoder takes every frame, as it did before
+    there could be more than one.
+    """
+
+    def __init__(self, decoders):
+        """:param decoders: {bridge ip: RakoStatusDecoder}"""
+        self._decoders = decoders
+        self._default = next(iter(decoders.values())) if len(decoders) == 1 else None
+
+    def decoder(self, address):
+        """:return the decoder for frames from the (ip, port) address, or None if it isn't a known bridge"""
+        return self._decoders.get(address[0], self._default)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+
+import paho.mqtt.client as mqtt
+
+from rakomqtt.bridges import BridgeSpec, connect_bridges
+from rakomqtt.command_queue import DEFAULT_COMPACTION_WINDOW
+from rakomqtt.commander import command_subscriber, create_command_queues, parse_command, update_state
+from rakomqtt.confirmation import DEFAULT_CONFIRM_RETRIES, DEFAULT_CONFIRM_TIMEOUT
+from rakomqtt.discovery import find_bridge_host
+from rakomqtt.metrics import FRAMES_RECEIVED, FRAMES_REJECTED
+from rakomqtt.MQTTClient import (
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_PENDING,
+    DEFAULT_QOS,
+    DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_RECONNECT_MIN_DELAY,
+    MQTTClient,
+)
+from rakomqtt.RakoBridge import CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_TRANSPORT, READ_TIMEOUT, RakoBridge
+from rakomqtt.state import StateStore
+from rakomqtt.watcher import DEFAULT_UDP_RCVBUF, _connect_udp_socket, process_frame
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def run_combined(
+    rako_bridge_host,
+    mqtt_host,
+    mqtt_user,
+    mqtt_password,
+    http_connect_timeout=CONNECT_TIMEOUT,
+    http_read_timeout=READ_TIMEOUT,
+    command_transport=HTTP_TRANSPORT,
+    udp_command_repeat=1,
+    udp_command_spacing=0.0,
+    command_rate=None,
+    udp_rcvbuf=DEFAULT_UDP_RCVBUF,
+    strict_payloads=False,
+    use_topology=True,
+    compaction_window=DEFAULT_COMPACTION_WINDOW,
+    bridges=None,
+    recorder=None,
+    mqtt_qos=DEFAULT_QOS,
+    mqtt_max_inflight=DEFAULT_MAX_INFLIGHT,
+    mqtt_max_pending=DEFAULT_MAX_PENDING,
+    mqtt_reconnect_min_delay=DEFAULT_RECONNECT_MIN_DELAY,
+    mqtt_reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY,
+    scene_map=None,
+    confirm_timeout=DEFAULT_CONFIRM_TIMEOUT,
+    confirm_retries=DEFAULT_CONFIRM_RETRIES,
+    skip_redundant=True,
+    adaptive_concurrency=0,
+):
+    """Run the watcher and the commander in one process on one asyncio loop,
+    sharing a single mqtt connection.
+
+    Status frames arrive on an asyncio datagram endpoint and commands go to
+    the bridge over an asyncio keep-alive http connection (or udp). Only paho's
+    network loop runs on its own thread.
+
+    :param bridges: BridgeSpecs of several bridges to serve, instead of rako_bridge_host
+    :param recorder: recorder.FrameRecorder to record the status frames and command messages received to
+    :param mqtt_qos, mqtt_max_inflight, mqtt_max_pending: see MQTTClient
+    :param mqtt_reconnect_min_delay, mqtt_reconnect_max_delay: see MQTTClient.ReconnectPolicy
+    :param scene_map: scenes.SceneMap of the brightness of each room's scenes
+    :param command_rate, confirm_timeout, confirm_retries, skip_redundant, adaptive_concurrency: see run_commander
+    """
+    bridges = connect_bridges(
+        bridges or [BridgeSpec(rako_bridge_host or find_bridge_host())],
+        use_topology,
+        scene_map,
+        connect_timeout=http_connect_timeout,
+        read_timeout=http_read_timeout,
+        transport=command_transport,
+        udp_repeat=udp_command_repeat,
+        udp_spacing=udp_command_spacing,
+        pool_size=max(adaptive_concurrency, HTTP_POOL_SIZE),
+    )
+    mqttc = MQTTClient(
+        mqtt_host,
+        mqtt_user,
+        mqtt_password,
+        qos=mqtt_qos,
+        max_inflight=mqtt_max_inflight,
+        max_pending=mqtt_max_pending,
+        reconnect_min_delay=mqtt_reconnect_min_delay,
+        reconnect_max_delay=mqtt_reconnect_max_delay,
+    )
+    queue_options = dict(
+        command_rate=command_rate,
+        compaction_window=compaction_window,
+        confirm_timeout=confirm_timeout,
+        confirm_retries=confirm_retries,
+        skip_redundant=skip_redundant,
+        adaptive_concurrency=adaptive_concurrency,
+    )
+    asyncio.run(_run(bridges, mqttc, udp_rcvbuf, strict_payloads, recorder, queue_options))
+
+
+class StatusProtocol(asyncio.DatagramProtocol):
+    def __init__(self, mqtt_client, state_store, demultiplexer, recorder=None, bridges=None):
+        """:param bridges: Bridges whose commands the frames confirm"""
+        self._demultiplexer = demultiplexer
+        self._recorder = recorder
+        self._mqtt_client = mqtt_client
+        self._state_store = state_store
+        self._bridges = bridges
+
+    def datagram_received(self, data, addr):
+        FRAMES_RECEIVED.inc()
+        received_at = time.monotonic()
+        if self._recorder:
+            self._recorder.record_status(data, addr, received_at)
+        decoder = self._demultiplexer.decoder(addr)
+        if decoder is None:
+            FRAMES_REJECTED.inc()
+            return
+        process_frame(data, decoder, self._state_store, self._mqtt_client, received_at)
+        bridge = self._bridges.for_address(addr) if self._bridges else None
+        if bridge is not None and bridge.confirmations is not None:
+            bridge.confirmations.observe(data, received_at)
+
+    def error_received(self, exc):
+        _LOGGER.warning(f"udp socket error: {exc}")
+
+
+async def _run(bridges, mqttc, udp_rcvbuf, strict_payloads, recorder=None, queue_options=None):
+    """:param queue_options: create_command_queues options"""
+    loop = asyncio.get_running_loop()
+    create_command_queues(bridges, asynchronous=True, **(queue_options or {}))
+
+    # called on paho's network thread, so hand the command over to the loop
+    def on_message(client, userdata, msg: mqtt.MQTTMessage):
+        bridge = bridges.for_topic(msg.topic)
+        if not msg.topic.endswith('/set'):
+            update_state(bridge, msg)
+            return
+        if recorder:
+            recorder.record_command(msg.topic, msg.payload)
+        rako_command = bridge and parse_command(msg, strict_payloads, bridge.topology, bridge.router, bridge.scene_map)
+
+        if rako_command:
+            loop.call_soon_threadsafe(bridge.command_queue.put, rako_command)
+
+    state_store = StateStore()
+    mqttc.resync = state_store.snapshot
+    skip_redundant = any(bridge.states is not None for bridge in bridges)
+    mqttc.on_connect = command_subscriber(
+        bridges.subscriptions(states=skip_redundant), mqttc, lambda: sum(bridge.command_queue.depth for bridge in bridges)
+    )
+    mqttc.mqttc.on_message = on_message
+    mqttc.connect()
+    mqttc.mqttc.loop_start()
+
+    udp_sock = _connect_udp_socket(RakoBridge.port, udp_rcvbuf)
+    demultiplexer = bridges.status_demultiplexer()
+    await loop.create_datagram_endpoint(
+        lambda: StatusProtocol(mqttc, state_store, demultiplexer, recorder, bridges), sock=udp_sock
+    )
+
+    await asyncio.gather(*(bridge.command_queue.run() for bridge in bridges))
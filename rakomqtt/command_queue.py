@@ -0,0 +1,435 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from rakomqtt.const import DEFAULT_COMMAND_RATE, DEFAULT_COMPACTION_WINDOW
+from rakomqtt.metrics import COMMANDS_COMPACTED, ROOM_QUEUE_WAIT
+from rakomqtt.RakoBridge import RakoCommand
+from rakomqtt.scenes import DEFAULT_SCENE_MAP
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CommandCompactor:
+    """Merges pending level commands which set every channel of a room to
+    the same level into one channel 0 command for the room, a scene if the
+    level is one of the room's scene brightnesses (see scenes.SceneMap).
+    Home assistant groups send a command per channel, and the bridge is
+    liable to drop some of a burst like that. Channel commands queued before
+    a command for their whole room are dropped, it undoes them anyway.
+    """
+
+    def __init__(self, topology, scene_map=None):
+        self._topology = topology
+        self._scene_map = scene_map or DEFAULT_SCENE_MAP
+        self.compacted = 0
+
+    def compact(self, pending):
+        """Compact the {(room, channel): RakoCommand} OrderedDict in place.
+        A room command takes the place of the first command it replaces.
+        """
+        superseded = self._superseded(pending)
+        for key in superseded:
+            del pending[key]
+        removed = len(superseded)
+
+        room_commands = self._room_commands(pending)
+        if room_commands:
+            compacted = OrderedDict()
+            for (room, channel), rako_command in pending.items():
+                if room not in room_commands:
+                    compacted[(room, channel)] = rako_command
+                elif (room, 0) not in compacted:
+                    compacted[(room, 0)] = room_commands[room]
+            removed += len(pending) - len(compacted)
+            pending.clear()
+            pending.update(compacted)
+        if not removed:
+            return
+        self.compacted += removed
+        COMMANDS_COMPACTED.inc(removed)
+        _LOGGER.debug('compacted %d commands, %s superseded, into %s', removed, superseded, list(room_commands.values()))
+
+    @staticmethod
+    def _superseded(pending):
+        """:return the keys of the channel commands queued before a command for their whole room"""
+        room_commands = set()
+        superseded = []
+        for room, channel in reversed(pending):
+            if channel == 0:
+                room_commands.add(room)
+            elif room in room_commands:
+                superseded.append((room, channel))
+        return superseded
+
+    def _room_commands(self, pending):
+        channel_levels = {}
+        for (room, channel), rako_command in pending.items():
+            if channel and rako_command.scene is None:
+                channel_levels.setdefault(room, {})[channel] = rako_command.brightness
+
+        room_commands = {}
+        for room, levels in channel_levels.items():
+            channels = self._topology.rooms[room].channels if room in self._topology.rooms else {}
+            if len(channels) < 2 or not levels.keys() >= channels.keys():
+                continue
+            room_levels = {levels[channel] for channel in channels}
+            if len(room_levels) != 1:
+                continue
+            level = room_levels.pop()
+            force = any(pending[(room, channel)].force for channel in channels)
+            scene = self._scene_map.ladder(room).exact_scene(level)
+            if scene is not None:
+                room_commands[room] = RakoCommand(room, 0, scene=scene, force=force)
+            else:
+                room_commands[room] = RakoCommand(room, 0, brightness=level, force=force)
+        return room_commands
+
+
+class RoomScheduler:
+    """Picks which pending command to send next, so one busy room can't
+    hold up the others.
+
+    Room scenes (from `rako/room/+/set`) go before channel levels. Within
+    each, rooms take turns in rounds: a room which has had its turn waits
+    until every other room with a command waiting has had one too, and
+    otherwise rooms go in the order of their oldest pending command. A
+    room's levels go in the order they were queued. A command for a quiet
+    room waits for at most one command from each busy room, however many a
+    slider is sending.
+
+    Rooms with a command still in flight (see dispatch.CommandDispatcher)
+    are passed over.
+    """
+
+    def __init__(self):
+        # rooms which have had their turn this round
+        self._served = set()
+
+    def pick(self, pending, busy_rooms=()):
+        """:return the key of the command in the {(room, channel): RakoCommand} OrderedDict
+        to send next, None if every room with one is busy
+        """
+        # room: the key of its oldest pending command, and of its scene, oldest first
+        oldest = {}
+        scenes = {}
+        for key, rako_command in pending.items():
+            if key[0] in busy_rooms:
+                continue
+            oldest.setdefault(key[0], key)
+            if rako_command.scene is not None:
+                scenes.setdefault(key[0], key)
+        if not oldest:
+            return None
+
+        served = self._served
+        candidates = scenes or oldest
+        room = min(candidates, key=lambda room: room in served)
+        key = candidates[room]
+        served.add(room)
+        if all(other[0] in served for other in pending if other != key):
+            # everyone waiting has had a turn
+            served.clear()
+        return key
+
+
+class CommandQueue:
+    """Hands RakoCommands from the mqtt network thread to a worker thread
+    which sends them to the bridge.
+
+    Only the newest pending command for each (room, channel) is kept, so a
+    burst of intermediate levels from a brightness slider collapses into the
+    final one. A replaced command keeps its place in the queue, unless a
+    command for its room was queued after the one it replaces, then it goes
+    behind that, as it's newer (it keeps the first one's wait). Which room
+    goes next is up to the RoomScheduler. A room command (channel 0) drops
+    the commands for the room's channels queued before it, as it would undo
+    them anyway, e.g. when a scene goes ahead of them. The worker sends at
+    most `rate` commands per second (0 means as fast as possible).
+
+    With a CommandCompactor the first command of a burst is held for
+    `compaction_window` seconds, so the rest of the burst can arrive and be
+    compacted with it.
+
+    With confirmation.CommandConfirmations every command sent is tracked
+    until the bridge confirms it, and put back in the queue when it isn't
+    confirmed in time, unless a newer command which would undo it, for its
+    (room, channel) or its whole room, is already waiting.
+
+    With state.ConfirmedStates a command which wouldn't change its light is
+    dropped when its turn comes rather than sent.
+
+    With a dispatch.CommandDispatcher commands are sent from a pool of
+    threads, as many at once as the dispatcher allows, rather than one after
+    another. `send` then returns False if the bridge didn't accept the
+    command.
+    """
+
+    def __init__(
+        self,
+        send,
+        rate=DEFAULT_COMMAND_RATE,
+        compactor=None,
+        compaction_window=DEFAULT_COMPACTION_WINDOW,
+        confirmations=None,
+        states=None,
+        dispatcher=None,
+    ):
+        self._send = send
+        self._interval = 1 / rate if rate else 0
+        self._compactor = compactor
+        self._compaction_window = compaction_window if compactor else 0
+        self._confirmations = confirmations
+        self._states = states
+        self._dispatcher = dispatcher
+        self._executor = None
+        self._pending = OrderedDict()
+        # (room, channel): when its pending command was first queued
+        self._queued_at = {}
+        self._scheduler = RoomScheduler()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._next_send = 0
+        self._hold_until = 0
+        self.superseded = 0
+
+    def start(self):
+        if self._dispatcher is not None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(self._dispatcher.max_in_flight, thread_name_prefix='CommandDispatch')
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='CommandQueue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown()
+
+    def put(self, rako_command):
+        with self._cond:
+            self._store(rako_command)
+            self._cond.notify()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def _store(self, rako_command):
+        if not self._pending and self._compaction_window:
+            self._hold_until = time.monotonic() + self._compaction_window
+        key = (rako_command.room, rako_command.channel)
+        if key in self._pending:
+            self.superseded += 1
+            keys = list(self._pending)
+            if any(other[0] == key[0] for other in keys[keys.index(key) + 1:]):
+                # it's newer than the room's commands queued since the one it replaces
+                self._pending.move_to_end(key)
+        else:
+            self._queued_at[key] = time.monotonic()
+        self._pending[key] = rako_command
+
+    def _requeue_unconfirmed(self):
+        """Put back the commands due a retry. Call holding _cond"""
+        if self._confirmations is None:
+            return
+        expired = self._confirmations.expired()
+        if expired and self._dispatcher is not None:
+            # the bridge dropped them, most likely as too many were sent at once
+            self._dispatcher.limit.congested()
+        for rako_command in expired:
+            if self._overtaken(rako_command):
+                self._confirmations.forget(rako_command)
+            else:
+                self._store(rako_command)
+
+    def _overtaken(self, rako_command):
+        """:return True if a pending command sets the light a sent one did, so resending it is pointless"""
+        room, channel = rako_command.room, rako_command.channel
+        return any(
+            pending_room == room and (pending_channel in (0, channel) or channel == 0)
+            for pending_room, pending_channel in self._pending
+        )
+
+    def _retry_timeout(self):
+        """:return seconds until a command is due a retry, None if none is"""
+        deadline = self._confirmations.next_deadline() if self._confirmations is not None else None
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    def _dispatchable(self):
+        """:return True if there's a command which can be sent now. Call holding _cond"""
+        if self._dispatcher is None:
+            return bool(self._pending)
+        busy_rooms = self._dispatcher.busy_rooms
+        return self._dispatcher.can_send() and any(room not in busy_rooms for room, _ in self._pending)
+
+    def _redundant(self, rako_command):
+        return self._states is not None and self._states.redundant(rako_command)
+
+    def _sent(self, rako_command):
+        # tracked even if the send failed, so it's retried like a dropped one
+        if self._confirmations is not None:
+            self._confirmations.sent(rako_command)
+        if self._states is not None:
+            self._states.sent(rako_command)
+
+    def _take(self):
+        with self._cond:
+            if not self._pending:
+                return None
+            if self._compactor:
+                self._compactor.compact(self._pending)
+            key = self._scheduler.pick(self._pending, self._dispatcher.busy_rooms if self._dispatcher else ())
+            if key is None:
+                return None
+            if key[1] == 0:
+                self._drop_channels_before(key)
+            rako_command = self._pending.pop(key)
+            ROOM_QUEUE_WAIT.labels(key[0]).observe(time.monotonic() - self._first_queued(key))
+            return rako_command
+
+    def _drop_channels_before(self, key):
+        """Drop the channel commands for the room queued before its room command. Call holding _cond"""
+        for other in list(self._pending):
+            if other == key:
+                return
+            if other[0] == key[0]:
+                del self._pending[other]
+                self.superseded += 1
+
+    def _first_queued(self, key):
+        queued_at = self._queued_at.pop(key, None)
+        # the commands the compactor replaced with a room command, or dropped as it superseded them
+        replaced = [other for other in self._queued_at if other[0] == key[0] and other not in self._pending]
+        replaced_at = [self._queued_at.pop(other) for other in replaced]
+        if queued_at is not None:
+            return queued_at
+        # a room command the compactor made, it's waited as long as the first command it replaced
+        return min(replaced_at, default=time.monotonic())
+
+    def _pacing_delay(self):
+        return max(self._next_send, self._hold_until) - time.monotonic()
+
+    def _run(self):
+        while self._wait_for_command():
+            # pace before taking the command so anything that arrives in the
+            # meantime still replaces it (or is compacted with it)
+            delay = self._pacing_delay()
+            if delay > 0:
+                time.sleep(delay)
+
+            rako_command = self._take()
+            if rako_command is None or self._redundant(rako_command):
+                continue
+
+            if self._executor is not None:
+                started = self._dispatcher.started(rako_command)
+                self._executor.submit(self._send_dispatched, rako_command, started)
+            else:
+                self._send_command(rako_command)
+            self._next_send = time.monotonic() + self._interval
+
+    def _send_command(self, rako_command):
+        """:return False if the command wasn't sent"""
+        try:
+            return self._send(rako_command)
+        except Exception:
+            _LOGGER.exception(f"Failed to send {rako_command}")
+            return False
+        finally:
+            self._sent(rako_command)
+
+    def _send_dispatched(self, rako_command, started):
+        ok = self._send_command(rako_command) is not False
+        with self._cond:
+            self._dispatcher.finished(rako_command, started, ok)
+            self._cond.notify()
+
+    def _wait_for_command(self):
+        with self._cond:
+            self._requeue_unconfirmed()
+            while self._running and not self._dispatchable():
+                self._cond.wait(self._retry_timeout())
+                self._requeue_unconfirmed()
+            return self._running
+
+
+class AsyncCommandQueue(CommandQueue):
+    """CommandQueue for the asyncio engine. put() must be called from the
+    event loop thread and `send` is a coroutine function.
+    """
+
+    def __init__(
+        self,
+        send,
+        rate=DEFAULT_COMMAND_RATE,
+        compactor=None,
+        compaction_window=DEFAULT_COMPACTION_WINDOW,
+        confirmations=None,
+        states=None,
+        dispatcher=None,
+    ):
+        import asyncio
+
+        super().__init__(send, rate, compactor, compaction_window, confirmations, states, dispatcher)
+        self._wakeup = asyncio.Event()
+        # the dispatched sends, referenced until they finish
+        self._sending = set()
+
+    def put(self, rako_command):
+        with self._cond:
+            self._store(rako_command)
+        self._wakeup.set()
+
+    async def run(self):
+        import asyncio
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._retry_timeout())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            with self._cond:
+                self._requeue_unconfirmed()
+            while self._dispatchable():
+                delay = self._pacing_delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                rako_command = self._take()
+                if rako_command is None:
+                    break
+                if self._redundant(rako_command):
+                    continue
+
+                if self._dispatcher is not None:
+                    started = self._dispatcher.started(rako_command)
+                    task = asyncio.ensure_future(self._send_dispatched_async(rako_command, started))
+                    self._sending.add(task)
+                    task.add_done_callback(self._sending.discard)
+                else:
+                    await self._send_command_async(rako_command)
+                self._next_send = time.monotonic() + self._interval
+
+    async def _send_command_async(self, rako_command):
+        try:
+            return await self._send(rako_command)
+        except Exception:
+            _LOGGER.exception(f"Failed to send {rako_command}")
+            return False
+        finally:
+            self._sent(rako_command)
+
+    async def _send_dispatched_async(self, rako_command, started):
+        ok = await self._send_command_async(rako_command) is not False
+        self._dispatcher.finished(rako_command, started, ok)
+        self._wakeup.set()
@@ -1,15 +1,40 @@
 import logging
+import threading
+
 import paho.mqtt.client as mqtt
 
-from rakomqtt.MQTTClient import MQTTClient
-from rakomqtt.RakoBridge import RakoBridge, RakoCommand
+from rakomqtt.bridges import BridgeSpec, connect_bridges
+from rakomqtt.command_queue import (
+    DEFAULT_COMMAND_RATE,
+    DEFAULT_COMPACTION_WINDOW,
+    AsyncCommandQueue,
+    CommandCompactor,
+    CommandQueue,
+)
+from rakomqtt.confirmation import DEFAULT_CONFIRM_RETRIES, DEFAULT_CONFIRM_TIMEOUT, CommandConfirmations
+from rakomqtt.dispatch import CommandDispatcher
+from rakomqtt.metrics import COMMAND_QUEUE_DEPTH, COMMANDS_RECEIVED, COMMANDS_REJECTED
+from rakomqtt.MQTTClient import DEFAULT_RECONNECT_MAX_DELAY, DEFAULT_RECONNECT_MIN_DELAY, MQTTClient
+from rakomqtt.RakoBridge import (
+    CONNECT_TIMEOUT,
+    HTTP_POOL_SIZE,
+    HTTP_TRANSPORT,
+    READ_TIMEOUT,
+    RakoBridge,
+    RakoCommand,
+)
+from rakomqtt.state import ConfirmedStates
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
-def run_commander(rako_bridge_host, mqtt_host, mqtt_user, mqtt_password):
-    rako_bridge = RakoBridge(rako_bridge_host)
+def command_subscriber(subscriptions, mqtt_client=None, buffered=None):
+    """:return an on_connect callback which subscribes to the command topics
+
+    :param mqtt_client: the MQTTClient, to report on commands after a reconnect
+    :param buffered: returns the number of commands waiting to be sent to the bridges
+    """
 
     # The callback for when the client receives a CONNACK response from the server.
     def on_connect(client, userdata, flags, rc):
@@ -17,24 +42,209 @@ def run_commander(rako_bridge_host, mqtt_host, mqtt_user, mqtt_password):
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        result, mid = client.subscribe([
-            ("rako/room/+/set", 1),
-            ("rako/room/+/channel/+/set", 1),
-        ])
+        result, mid = client.subscribe(subscriptions)
         if result != mqtt.MQTT_ERR_SUCCESS:
             _LOGGER.error("Couldn't subscribe to mqtt topics. Commander ain't gonna work")
 
+        if rc == 0 and mqtt_client is not None and mqtt_client.outage is not None:
+            report_offline_commands(mqtt_client.outage, buffered() if buffered else 0)
+
+    return on_connect
+
+
+def report_offline_commands(outage, buffered):
+    """Log what became of commands while the mqtt connection was down. The
+    subscriptions don't outlive the connection (it's a clean session), so the
+    broker dropped any command published in that time.
+
+    :param buffered: commands received before the outage still waiting for the bridge
+    """
+    _LOGGER.warning(
+        f"Command topics were unsubscribed for {outage:.1f}s, commands published then were missed. "
+        f"{buffered} commands received before are still waiting for the bridge"
+    )
+
+
+def update_state(bridge, msg: mqtt.MQTTMessage):
+    """Record a state message from the watcher, for the bridge the topic is under"""
+    if bridge is not None and bridge.states is not None:
+        bridge.states.update(msg.topic, msg.payload)
+
+
+def parse_command(msg: mqtt.MQTTMessage, strict=False, topology=None, router=None, scene_map=None):
+    """
+    :param topology: if given, commands for rooms/channels not in it are rejected
+    :param router: CommandTopicRouter for the bridge's topic prefix
+    :param scene_map: scenes.SceneMap picking the scene of room commands
+    :return the RakoCommand for a command message, or None if it's not one
+    """
+    COMMANDS_RECEIVED.inc()
+    try:
+        rako_command = RakoCommand.from_mqtt(
+            msg.topic, msg.payload.decode("utf-8"), strict=strict, router=router, scene_map=scene_map
+        )
+    except ValueError as ex:
+        COMMANDS_REJECTED.inc()
+        _LOGGER.warning(f"Ignoring invalid command on {msg.topic}: {ex}")
+        return None
+
+    if rako_command and topology is not None and not topology.has_channel(rako_command.room, rako_command.channel):
+        COMMANDS_REJECTED.inc()
+        _LOGGER.warning(f"Ignoring command on {msg.topic}: the rako bridge has no such room/channel")
+        return None
+    return rako_command
+
+
+def create_command_queues(
+    bridges,
+    asynchronous=False,
+    command_rate=None,
+    compaction_window=DEFAULT_COMPACTION_WINDOW,
+    confirm_timeout=DEFAULT_CONFIRM_TIMEOUT,
+    confirm_retries=DEFAULT_CONFIRM_RETRIES,
+    skip_redundant=True,
+    adaptive_concurrency=0,
+):
+    """Give each Bridge a command queue, and what it needs to confirm, skip
+    and dispatch its commands. See run_commander for the options.
+
+    :param asynchronous: AsyncCommandQueues sending with post_command_async,
+    for the combined mode. Call it from the event loop
+    """
+    if command_rate is None:
+        # with adaptive concurrency the dispatcher's limit paces the commands
+        command_rate = 0 if adaptive_concurrency else DEFAULT_COMMAND_RATE
+    for bridge in bridges:
+        # without the topology there's no knowing when every channel of a room has a command
+        compactor = CommandCompactor(bridge.topology, bridge.scene_map) if bridge.topology and compaction_window else None
+        if confirm_timeout:
+            bridge.confirmations = CommandConfirmations(confirm_timeout, confirm_retries, bridge.scene_map)
+        if skip_redundant:
+            bridge.states = ConfirmedStates(bridge.topic_prefix, bridge.scene_map, bridge.topology)
+        if adaptive_concurrency:
+            bridge.dispatcher = CommandDispatcher(adaptive_concurrency, bridge.topic_prefix)
+        queue_class, send = (
+            (AsyncCommandQueue, bridge.rako_bridge.post_command_async)
+            if asynchronous
+            else (CommandQueue, bridge.rako_bridge.post_command)
+        )
+        bridge.command_queue = queue_class(
+            send,
+            rate=command_rate,
+            compactor=compactor,
+            compaction_window=compaction_window,
+            confirmations=bridge.confirmations,
+            states=bridge.states,
+            dispatcher=bridge.dispatcher,
+        )
+
+    COMMAND_QUEUE_DEPTH.set_function(lambda: sum(bridge.command_queue.depth for bridge in bridges))
+
+
+def run_commander(
+    rako_bridge_host,
+    mqtt_host,
+    mqtt_user,
+    mqtt_password,
+    http_connect_timeout=CONNECT_TIMEOUT,
+    http_read_timeout=READ_TIMEOUT,
+    http_keep_alive=True,
+    command_transport=HTTP_TRANSPORT,
+    udp_command_repeat=1,
+    udp_command_spacing=0.0,
+    command_rate=None,
+    strict_payloads=False,
+    use_topology=True,
+    compaction_window=DEFAULT_COMPACTION_WINDOW,
+    bridges=None,
+    recorder=None,
+    mqtt_reconnect_min_delay=DEFAULT_RECONNECT_MIN_DELAY,
+    mqtt_reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY,
+    scene_map=None,
+    confirm_timeout=DEFAULT_CONFIRM_TIMEOUT,
+    confirm_retries=DEFAULT_CONFIRM_RETRIES,
+    skip_redundant=True,
+    adaptive_concurrency=0,
+):
+    """
+    :param bridges: BridgeSpecs of several bridges to serve, instead of rako_bridge_host
+    :param recorder: recorder.FrameRecorder to record every command message received to
+    :param command_rate: most commands per second sent to a bridge, 0 for no
+    limit. By default DEFAULT_COMMAND_RATE, or no limit with adaptive_concurrency
+    :param mqtt_reconnect_min_delay, mqtt_reconnect_max_delay: see MQTTClient.ReconnectPolicy
+    :param scene_map: scenes.SceneMap of the brightness of each room's scenes
+    :param confirm_timeout: seconds to wait for a status frame confirming a
+    command before sending it again, 0 to not listen for them
+    :param confirm_retries: times to send an unconfirmed command again
+    :param skip_redundant: follow the states the watcher publishes and don't
+    send commands which wouldn't change them, unless they're forced
+    :param adaptive_concurrency: most commands in flight to a bridge at once,
+    see dispatch.CommandDispatcher. 0 sends them one at a time
+    """
+    bridges = connect_bridges(
+        bridges or [BridgeSpec(rako_bridge_host)],
+        use_topology,
+        scene_map,
+        connect_timeout=http_connect_timeout,
+        read_timeout=http_read_timeout,
+        keep_alive=http_keep_alive,
+        transport=command_transport,
+        udp_repeat=udp_command_repeat,
+        udp_spacing=udp_command_spacing,
+        pool_size=max(adaptive_concurrency, HTTP_POOL_SIZE),
+    )
+    create_command_queues(
+        bridges,
+        command_rate=command_rate,
+        compaction_window=compaction_window,
+        confirm_timeout=confirm_timeout,
+        confirm_retries=confirm_retries,
+        skip_redundant=skip_redundant,
+        adaptive_concurrency=adaptive_concurrency,
+    )
+
     # The callback for when a PUBLISH message is received from the server.
     def on_message(client, userdata, msg: mqtt.MQTTMessage):
-        rako_command = RakoCommand.from_mqtt(msg.topic, str(msg.payload.decode("utf-8")))
+        bridge = bridges.for_topic(msg.topic)
+        if not msg.topic.endswith('/set'):
+            update_state(bridge, msg)
+            return
+        if recorder:
+            recorder.record_command(msg.topic, msg.payload)
+        rako_command = bridge and parse_command(msg, strict_payloads, bridge.topology, bridge.router, bridge.scene_map)
 
         if rako_command:
-            rako_bridge.post_command(rako_command)
+            bridge.command_queue.put(rako_command)
 
-    mqttc = MQTTClient(mqtt_host, mqtt_user, mqtt_password)
-    mqttc.mqttc.on_connect = on_connect
+    mqttc = MQTTClient(
+        mqtt_host,
+        mqtt_user,
+        mqtt_password,
+        reconnect_min_delay=mqtt_reconnect_min_delay,
+        reconnect_max_delay=mqtt_reconnect_max_delay,
+    )
+    mqttc.on_connect = command_subscriber(
+        bridges.subscriptions(states=skip_redundant), mqttc, lambda: sum(bridge.command_queue.depth for bridge in bridges)
+    )
     mqttc.mqttc.on_message = on_message
     mqttc.connect()
+    for bridge in bridges:
+        bridge.command_queue.start()
+    if confirm_timeout:
+        threading.Thread(target=confirm_commands, args=(bridges,), name='CommandConfirmations', daemon=True).start()
     mqttc.mqttc.loop_forever()
 
 
+def confirm_commands(bridges):
+    """Listen for the bridges' status frames, alongside the watcher, and
+    confirm the commands they show were carried out
+    """
+    from rakomqtt.watcher import BatchReceiver, _connect_udp_socket
+
+    receiver = BatchReceiver(_connect_udp_socket(RakoBridge.port))
+    while True:
+        batch = receiver.receive()
+        for frame, address in zip(batch, receiver.addresses):
+            bridge = bridges.for_address(address)
+            if bridge is not None and bridge.confirmations is not None:
+                bridge.confirmations.observe(frame)
@@ -0,0 +1,149 @@
+"""Confirming commands by the status frames the bridge broadcasts.
+
+The bridge broadcasts a status frame whenever a scene or level is set, so a
+command it has carried out shows up as a matching frame from the room and
+channel. Each command sent is outstanding until that frame arrives. One
+that isn't confirmed within `timeout` seconds (the bridge rejected it, or
+dropped it, or the udp frame was lost) is sent again, waiting twice as long
+each time, up to `retries` times. A room command (channel 0) sets every
+channel of the room, so sending one stops waiting for the room's channel
+commands sent before it, as resending them would undo it.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from rakomqtt.const import DEFAULT_CONFIRM_RETRIES, DEFAULT_CONFIRM_TIMEOUT
+from rakomqtt.metrics import COMMAND_CONFIRM_SECONDS, COMMANDS_CONFIRMED, COMMANDS_RETRIED, COMMANDS_UNCONFIRMED
+from rakomqtt.RakoBridge import RakoCommandType, RakoDeserialisationException, RakoStatusMessage, status_checksum_ok
+from rakomqtt.scenes import DEFAULT_SCENE_MAP
+
+
+_LOGGER = logging.getLogger(__name__)
+_AWAITING_RESEND = float('inf')
+
+
+@dataclass
+class _Outstanding:
+    rako_command: object
+    first_sent: float
+    deadline: float
+    attempts: int = 0
+
+
+class CommandConfirmations:
+    """The commands sent to one bridge which haven't been confirmed yet,
+    the newest for each (room, channel). Called from the command queue and
+    from whatever receives the status frames, so it's thread safe.
+    """
+
+    def __init__(self, timeout=DEFAULT_CONFIRM_TIMEOUT, retries=DEFAULT_CONFIRM_RETRIES, scene_map=None):
+        self.timeout = timeout
+        self.retries = retries
+        self._scene_map = scene_map or DEFAULT_SCENE_MAP
+        self._outstanding = {}
+        self._lock = threading.Lock()
+        self.confirmed = 0
+        self.retried = 0
+        self.unconfirmed = 0
+
+    def __len__(self):
+        return len(self._outstanding)
+
+    def sent(self, rako_command, now=None):
+        """Note the command has been sent. Sending a (room, channel) a
+        different command stops waiting for the one before, and sending a
+        room command for the room's channel commands.
+        """
+        now = time.monotonic() if now is None else now
+        key = (rako_command.room, rako_command.channel)
+        with self._lock:
+            outstanding = self._outstanding.get(key)
+            if outstanding is not None and outstanding.rako_command == rako_command:
+                outstanding.deadline = now + self.timeout * 2 ** outstanding.attempts
+            else:
+                self._outstanding[key] = _Outstanding(rako_command, now, now + self.timeout)
+            if rako_command.channel == 0:
+                for other in [other for other in self._outstanding if other[0] == rako_command.room and other[1]]:
+                    del self._outstanding[other]
+
+    def forget(self, rako_command):
+        """Stop waiting for a command which won't be sent again, e.g. as a newer one undoes it"""
+        key = (rako_command.room, rako_command.channel)
+        with self._lock:
+            outstanding = self._outstanding.get(key)
+            if outstanding is not None and outstanding.rako_command == rako_command:
+                del self._outstanding[key]
+
+    def observe(self, frame, now=None):
+        """Confirm the outstanding command a status frame shows was carried out, if any
+
+        :return True if the frame confirmed a command
+        """
+        if not self._outstanding:
+            return False
+        if len(frame) < 7 or frame[1] + 2 != len(frame) or not status_checksum_ok(frame):
+            return False
+        try:
+            status = RakoStatusMessage.from_byte_list(frame, self._scene_map)
+        except (RakoDeserialisationException, ValueError, IndexError, KeyError):
+            return False
+
+        now = time.monotonic() if now is None else now
+        key = (status.room, status.channel)
+        with self._lock:
+            outstanding = self._outstanding.get(key)
+            if outstanding is None or not self.matches(outstanding.rako_command, status):
+                return False
+            del self._outstanding[key]
+            self.confirmed += 1
+        COMMANDS_CONFIRMED.inc()
+        COMMAND_CONFIRM_SECONDS.observe(now - outstanding.first_sent)
+        return True
+
+    @staticmethod
+    def matches(rako_command, status):
+        """:return True if the RakoStatusMessage shows the RakoCommand was carried out"""
+        if status.command == RakoCommandType.SET_SCENE:
+            if rako_command.scene is not None:
+                return status.scene == rako_command.scene
+            return status.scene == 0 and rako_command.brightness == 0
+        if rako_command.scene is not None:
+            return rako_command.scene == 0 and status.brightness == 0
+        return status.brightness == rako_command.brightness
+
+    def next_deadline(self):
+        """:return the monotonic time the next command is due a retry, or None"""
+        with self._lock:
+            deadline = min((outstanding.deadline for outstanding in self._outstanding.values()), default=None)
+        return None if deadline == _AWAITING_RESEND else deadline
+
+    def expired(self, now=None):
+        """:return the commands past their deadline which should be sent
+        again. The ones out of retries are given up on.
+        """
+        now = time.monotonic() if now is None else now
+        retry = []
+        with self._lock:
+            for key, outstanding in list(self._outstanding.items()):
+                if outstanding.deadline > now:
+                    continue
+                if outstanding.attempts < self.retries:
+                    outstanding.attempts += 1
+                    # until the queue gets round to sending it again
+                    outstanding.deadline = _AWAITING_RESEND
+                    retry.append(outstanding.rako_command)
+                else:
+                    del self._outstanding[key]
+                    self.unconfirmed += 1
+                    COMMANDS_UNCONFIRMED.inc()
+                    _LOGGER.warning(
+                        f"The bridge never confirmed {outstanding.rako_command}, "
+                        f"sent {outstanding.attempts + 1} times over {now - outstanding.first_sent:.1f}s"
+                    )
+        self.retried += len(retry)
+        COMMANDS_RETRIED.inc(len(retry))
+        for rako_command in retry:
+            _LOGGER.info(f"No status frame confirming {rako_command}, sending it again")
+        return retry
@@ -5,3 +5,27 @@ PATCH_VERSION = "0.dev0"
 __short_version__ = f"{MAJOR_VERSION}.{MINOR_VERSION}"
 __version__ = f"{__short_version__}.{PATCH_VERSION}"
 REQUIRED_PYTHON_VER = (3, 7, 0)
+
+# Defaults of the command line options, here so parsing them doesn't import
+# the modules they're for (and paho) before the mode is picked.
+
+# RakoBridge
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+HTTP_TRANSPORT = 'http'
+UDP_TRANSPORT = 'udp'
+# command_queue
+DEFAULT_COMMAND_RATE = 10
+DEFAULT_COMPACTION_WINDOW = 0.05
+# confirmation
+DEFAULT_CONFIRM_TIMEOUT = 1.0
+DEFAULT_CONFIRM_RETRIES = 2
+# MQTTClient
+DEFAULT_QOS = 0
+DEFAULT_MAX_INFLIGHT = 20
+DEFAULT_MAX_PENDING = 4096
+DEFAULT_RECONNECT_MIN_DELAY = 0.5
+DEFAULT_RECONNECT_MAX_DELAY = 30.0
+# watcher
+DEFAULT_UDP_RCVBUF = 1024 * 1024
+DEFAULT_UDP_BATCH_SIZE = 64
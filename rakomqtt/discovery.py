@@ -0,0 +1,116 @@
+"""Remembering where the rako bridge is between restarts.
+
+Discovery broadcasts up to three times with a 5s timeout, so a restart can
+take 15s before the lights respond. Instead the last discovered host is
+kept in a small json cache file (RAKOMQTT_DISCOVERY_CACHE, set it empty to
+disable) and used straight away while it's younger than
+DISCOVERY_CACHE_TTL. The long running process then checks the cached host
+still answers in the background, and only rediscovers if it doesn't. A
+host which answers is cached afresh, so the ttl runs from when it last did.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from rakomqtt.RakoBridge import RakoBridge
+
+
+_LOGGER = logging.getLogger(__name__)
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+VERIFY_TIMEOUT = 2
+DEFAULT_DISCOVERY_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'rakomqtt', 'bridge.json'
+)
+
+
+class DiscoveryCache:
+    def __init__(self, path=None, ttl=DISCOVERY_CACHE_TTL):
+        self.path = os.environ.get('RAKOMQTT_DISCOVERY_CACHE', DEFAULT_DISCOVERY_CACHE) if path is None else path
+        self.ttl = ttl
+
+    def load(self):
+        """:return the cached host if there is one younger than the ttl"""
+        if not self.path:
+            return None
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            if time.time() - cached['discovered_at'] < self.ttl:
+                return cached['host']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save(self, host):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(host=host, discovered_at=time.time()), f)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            _LOGGER.warning(f"Couldn't write the discovery cache {self.path}: {ex}")
+
+
+def find_bridge_host(cache=None):
+    """The cached bridge host, or discover one and cache it. Exits if no
+    bridge can be found, like RakoBridge.find_bridge
+    """
+    cache = cache if cache is not None else DiscoveryCache()
+    host = cache.load()
+    if host:
+        _LOGGER.debug(f'using cached rako bridge {host}')
+        return host
+
+    host = RakoBridge.find_bridge()
+    cache.save(host)
+    return host
+
+
+def bridge_answers(host, timeout=VERIFY_TIMEOUT):
+    """Ask the host directly whether it's a rako bridge"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(b'D', (host, RakoBridge.port))
+            _, (address, _) = sock.recvfrom(256)
+            return address == socket.gethostbyname(host)
+        except OSError:
+            return False
+
+
+def verify_in_background(rako_bridge, cache=None):
+    """If the bridge's host came from the cache, check it still answers on a
+    background thread and rediscover (and switch the bridge over) if not.
+    """
+    cache = cache if cache is not None else DiscoveryCache()
+    if rako_bridge.host != cache.load():
+        return None
+
+    def verify():
+        if bridge_answers(rako_bridge.host):
+            _LOGGER.debug(f'cached rako bridge {rako_bridge.host} verified')
+            cache.save(rako_bridge.host)
+            return
+        _LOGGER.info(f"Cached rako bridge {rako_bridge.host} didn't answer, rediscovering")
+        host = RakoBridge.discover()
+        if host:
+            cache.save(host)
+            if host != rako_bridge.host:
+                _LOGGER.info(f"Switching to rediscovered rako bridge {host}")
+                rako_bridge.set_host(host)
+        else:
+            _LOGGER.error('Cannot find a rakobrige, carrying on with the cached one')
+
+    thread = threading.Thread(target=verify, name='verify-bridge', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    print(find_bridge_host())
@@ -0,0 +1,157 @@
+"""Sending several commands to a bridge at once, as many as it keeps up with.
+
+By default the command queue sends one command at a time, waiting for the
+bridge to answer each before sending the next. With `--adaptive-concurrency
+MAX` a CommandDispatcher lets up to `limit` commands be in flight at once,
+never two for the same room so a room's commands still arrive in order.
+
+The limit is worked out as it goes, additive increase multiplicative
+decrease (AIMD) like tcp's congestion window. It starts at 1 and each
+command the bridge answers while the limit is in use raises it by 1/limit,
+so by about 1 per limit's worth of commands. A command which fails, times
+out, takes much longer than the quickest recent ones (the bridge is queueing
+them) or isn't confirmed by a status frame cuts it by half. Commands already
+in flight when it was cut don't cut it again.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from rakomqtt.metrics import DISPATCH_IN_FLIGHT, DISPATCH_LIMIT, DISPATCH_THROUGHPUT
+
+
+_LOGGER = logging.getLogger(__name__)
+DEFAULT_BACKOFF = 0.5
+DEFAULT_LATENCY_TOLERANCE = 2.0
+# seconds allowed on top of the tolerance, so jitter in a quick bridge's answers isn't congestion
+LATENCY_SLACK = 0.05
+THROUGHPUT_WINDOW = 10.0
+
+
+class AIMDLimit:
+    """How many commands may be in flight, see the top of this module"""
+
+    def __init__(
+        self,
+        max_limit,
+        min_limit=1,
+        backoff=DEFAULT_BACKOFF,
+        latency_tolerance=DEFAULT_LATENCY_TOLERANCE,
+        window=100,
+    ):
+        """
+        :param backoff: the limit is multiplied by this on congestion
+        :param latency_tolerance: a command taking longer than this many times
+        the quickest of the last `window` is a sign of congestion
+        """
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError(f"The concurrency limit must be from 1 up to the most, not {min_limit}-{max_limit}")
+        if not 0 < backoff < 1:
+            raise ValueError(f"backoff must be between 0 and 1, not {backoff}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(min_limit)
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = float('-inf')
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return int(self._limit)
+
+    def succeeded(self, latency, started, in_flight):
+        """A command was answered after latency seconds
+
+        :param started: monotonic time the command was sent
+        :param in_flight: commands in flight when it was answered, counting itself
+        """
+        with self._lock:
+            self._latencies.append(latency)
+            if latency > min(self._latencies) * self.latency_tolerance + LATENCY_SLACK:
+                self._decrease(started, started + latency)
+            elif in_flight >= self.current:
+                # only raise the limit when it's what holds commands back
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+
+    def failed(self, started, now=None):
+        """A command sent at monotonic time started failed or timed out"""
+        with self._lock:
+            self._decrease(started, time.monotonic() if now is None else now)
+
+    def congested(self, now=None):
+        """Something other than an answer shows the bridge is overwhelmed, e.g. a dropped command"""
+        now = time.monotonic() if now is None else now
+        self.failed(now, now)
+
+    def _decrease(self, started, now):
+        if started < self._last_decrease:
+            return
+        self._limit = max(self._limit * self.backoff, self.min_limit)
+        self._last_decrease = now
+        _LOGGER.debug(f"The bridge is congested, {self.current} commands in flight at most")
+
+
+class Throughput:
+    """Commands finished per second over the last `window` seconds"""
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self._window = window
+        self._finished = deque()
+        self._lock = threading.Lock()
+
+    def add(self, now):
+        with self._lock:
+            self._finished.append(now)
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._finished and self._finished[0] <= now - self._window:
+                self._finished.popleft()
+            return len(self._finished) / self._window
+
+
+class CommandDispatcher:
+    """Tracks the commands a CommandQueue has in flight to one bridge"""
+
+    def __init__(self, max_in_flight, label='', limit=None):
+        """:param label: the bridge, to label its metrics by"""
+        self.limit = limit or AIMDLimit(max_in_flight)
+        self.in_flight = 0
+        # rooms with a command in flight
+        self.busy_rooms = set()
+        self.throughput = Throughput()
+        self._lock = threading.Lock()
+        DISPATCH_LIMIT.labels(label).set_function(lambda: self.limit.current)
+        DISPATCH_IN_FLIGHT.labels(label).set_function(lambda: self.in_flight)
+        DISPATCH_THROUGHPUT.labels(label).set_function(self.throughput.rate)
+
+    @property
+    def max_in_flight(self):
+        return self.limit.max_limit
+
+    def can_send(self):
+        return self.in_flight < self.limit.current
+
+    def started(self, rako_command):
+        """:return the monotonic time the command was sent, to hand to finished()"""
+        with self._lock:
+            self.in_flight += 1
+            self.busy_rooms.add(rako_command.room)
+        return time.monotonic()
+
+    def finished(self, rako_command, started, ok, now=None):
+        """:param ok: the bridge accepted the command"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self.busy_rooms.discard(rako_command.room)
+        self.throughput.add(now)
+        if ok:
+            self.limit.succeeded(now - started, started, in_flight)
+        else:
+            self.limit.failed(started, now)
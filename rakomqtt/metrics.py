@@ -0,0 +1,271 @@
+"""Counters, gauges and histograms for watching rakomqtt at runtime.
+
+Every metric lives in REGISTRY. Updating one is always cheap. They are only
+rendered, in the Prometheus text format, when start_metrics_server() has
+been called and something scrapes /metrics. http.server is only imported
+then too.
+"""
+import bisect
+import logging
+import threading
+from collections import deque
+
+
+_LOGGER = logging.getLogger(__name__)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class LatencyRecorder:
+    """Keeps a bounded window of the most recent latency samples (seconds)
+    so percentiles can be reported without the memory growing over time.
+    """
+
+    def __init__(self, window=1024):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        return dict(count=self.count, p50=self.percentile(50), p99=self.percentile(99))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), labelvalues=()):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = labelnames
+        self._labelvalues = labelvalues
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """:return the child metric for these label values, e.g. ROOM_QUEUE_WAIT.labels(room)"""
+        labelvalues = tuple(str(value) for value in labelvalues)
+        try:
+            return self._children[labelvalues]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(labelvalues, self._child(labelvalues))
+
+    def _child(self, labelvalues):
+        return type(self)(self.name, self.documentation, self._labelnames, labelvalues)
+
+    def _label_str(self, extra=()):
+        pairs = list(zip(self._labelnames, self._labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        metrics = list(self._children.values()) if self._labelnames else [self]
+        for metric in metrics:
+            lines.extend(metric._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _samples(self):
+        return [f"{self.name}{self._label_str()} {self.value}"]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0
+        self._function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function() whenever the gauge is rendered"""
+        self._function = function
+
+    def get(self):
+        return self._function() if self._function else self.value
+
+    def _samples(self):
+        return [f"{self.name}{self._label_str()} {self.get()}"]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self, labelvalues):
+        return Histogram(self.name, self.documentation, self._labelnames, labelvalues, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self._counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._label_str([('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_str()} {self.sum}")
+        lines.append(f"{self.name}_count{self._label_str()} {self.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FRAMES_RECEIVED = REGISTRY.counter('rakomqtt_frames_received_total', 'UDP status frames received from the bridge')
+FRAMES_DECODED = REGISTRY.counter('rakomqtt_frames_decoded_total', 'Status frames decoded to a room/channel state')
+FRAMES_REJECTED = REGISTRY.counter('rakomqtt_frames_rejected_total', 'UDP datagrams which were not valid status frames')
+FRAMES_PUBLISHED = REGISTRY.counter('rakomqtt_frames_published_total', 'State changes published to mqtt')
+FRAMES_SUPPRESSED = REGISTRY.counter('rakomqtt_frames_suppressed_total', 'Decoded frames not published as unchanged')
+UDP_TO_PUBLISH_SECONDS = REGISTRY.histogram(
+    'rakomqtt_udp_to_publish_seconds', 'Time from receiving a status frame to publishing it'
+)
+
+COMMANDS_RECEIVED = REGISTRY.counter('rakomqtt_commands_received_total', 'Command messages received from mqtt')
+COMMANDS_REJECTED = REGISTRY.counter('rakomqtt_commands_rejected_total', 'Command messages with an invalid payload')
+COMMANDS_COMPACTED = REGISTRY.counter(
+    'rakomqtt_commands_compacted_total', 'Channel commands merged into a room command rather than sent'
+)
+COMMANDS_SENT = REGISTRY.counter('rakomqtt_commands_sent_total', 'Commands accepted by the bridge')
+COMMANDS_SKIPPED = REGISTRY.counter(
+    'rakomqtt_commands_skipped_total', 'Commands not sent as the light was already in that state'
+)
+COMMANDS_FAILED = REGISTRY.counter('rakomqtt_commands_failed_total', 'Commands which could not be sent to the bridge')
+COMMAND_HTTP_SECONDS = REGISTRY.histogram(
+    'rakomqtt_command_http_seconds', 'Time for the bridge to answer a rako.cgi command'
+)
+COMMAND_QUEUE_DEPTH = REGISTRY.gauge('rakomqtt_command_queue_depth', 'Commands waiting to be sent to the bridge')
+ROOM_QUEUE_WAIT = REGISTRY.histogram(
+    'rakomqtt_room_queue_wait_seconds', 'Time a command waits in the queue to be sent, by room', labelnames=('room',)
+)
+COMMANDS_CONFIRMED = REGISTRY.counter(
+    'rakomqtt_commands_confirmed_total', 'Commands the bridge broadcast a matching status frame for'
+)
+COMMANDS_RETRIED = REGISTRY.counter('rakomqtt_commands_retried_total', 'Commands sent again as they were not confirmed')
+COMMANDS_UNCONFIRMED = REGISTRY.counter(
+    'rakomqtt_commands_unconfirmed_total', 'Commands given up on, never confirmed after every retry'
+)
+COMMAND_CONFIRM_SECONDS = REGISTRY.histogram(
+    'rakomqtt_command_confirm_seconds', 'Time from first sending a command to the status frame confirming it'
+)
+DISPATCH_LIMIT = REGISTRY.gauge(
+    'rakomqtt_dispatch_limit', 'Commands allowed in flight to the bridge at once', labelnames=('bridge',)
+)
+DISPATCH_IN_FLIGHT = REGISTRY.gauge(
+    'rakomqtt_dispatch_in_flight', 'Commands sent to the bridge, not yet answered', labelnames=('bridge',)
+)
+DISPATCH_THROUGHPUT = REGISTRY.gauge(
+    'rakomqtt_dispatch_throughput', 'Commands the bridge answered per second, over the last 10s', labelnames=('bridge',)
+)
+
+MQTT_CONNECTED = REGISTRY.gauge('rakomqtt_mqtt_connected', '1 when connected to the mqtt broker')
+MQTT_RECONNECTS = REGISTRY.counter('rakomqtt_mqtt_reconnects_total', 'Connections to the mqtt broker regained')
+MQTT_RECONNECT_SECONDS = REGISTRY.histogram(
+    'rakomqtt_mqtt_reconnect_seconds',
+    'Time from losing the mqtt connection to regaining it',
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+MQTT_PUBLISH_PENDING = REGISTRY.gauge('rakomqtt_mqtt_publish_pending', 'Messages waiting to be handed to the mqtt client')
+MQTT_PUBLISH_INFLIGHT = REGISTRY.gauge('rakomqtt_mqtt_publish_inflight', 'Messages handed to the mqtt client, not yet sent')
+MQTT_PUBLISH_SUPERSEDED = REGISTRY.counter(
+    'rakomqtt_mqtt_publish_superseded_total', 'Pending messages replaced by a newer one for the same topic'
+)
+MQTT_PUBLISH_DROPPED = REGISTRY.counter(
+    'rakomqtt_mqtt_publish_dropped_total', 'Pending messages dropped because too many topics were pending'
+)
+
+
+def _metrics_request_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def start_metrics_server(port, host='', registry=REGISTRY):
+    """Serve the metrics on http://host:port/metrics from a daemon thread"""
+    from http.server import ThreadingHTTPServer
+
+    httpd = ThreadingHTTPServer((host, port), _metrics_request_handler())
+    httpd.registry = registry
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    _LOGGER.info(f"Serving metrics on http://{host or '0.0.0.0'}:{httpd.server_address[1]}/metrics")
+    return httpd
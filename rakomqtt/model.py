@@ -4,6 +4,8 @@ from marshmallow import Schema, fields, post_load, validate
 class MqttPayloadSchema(Schema):
     state = fields.Str(validate=validate.OneOf(choices=('ON', 'OFF')))
     brightness = fields.Int(validate=validate.Range(min=0, max=255))
+    # send the command even if the light is already in that state
+    force = fields.Bool(truthy={True}, falsy={False})
 
     @post_load
     def post_load(self, item, many, **kwargs):
@@ -0,0 +1,101 @@
+"""Fast validation of home assistant mqtt json light payloads.
+
+load_mqtt_payload accepts and rejects the same payloads as
+model.MqttPayloadSchema, without the cost of a full marshmallow load.
+"""
+import json
+
+
+PAYLOAD_FIELDS = frozenset(('state', 'brightness', 'force'))
+STATES = ('ON', 'OFF')
+DEFAULT_BRIGHTNESS = {'ON': 255, 'OFF': 0}
+# `force` is a json boolean, compared the way marshmallow's Boolean(truthy=, falsy=) does
+FORCE_TRUTHY = frozenset((True,))
+FORCE_FALSY = frozenset((False,))
+
+
+class PayloadValidationError(ValueError):
+    def __init__(self, messages):
+        super().__init__(messages)
+        self.messages = messages
+
+
+def load_mqtt_payload(payload_str):
+    """
+    :param payload_str: json string e.g. '{"state": "ON", "brightness": 25}'
+    :return dict with `brightness` filled in from `state` when missing
+    :raise PayloadValidationError (or json.JSONDecodeError)
+    """
+    item = json.loads(payload_str)
+    if type(item) is not dict:
+        raise PayloadValidationError({'_schema': ['Invalid input type.']})
+
+    errors = {}
+    for key in item.keys() - PAYLOAD_FIELDS:
+        errors[key] = ['Unknown field.']
+
+    state = _load_state(item, errors)
+
+    brightness = item.get('brightness')
+    if 'brightness' in item:
+        brightness = _load_brightness(brightness, errors)
+
+    _load_force(item, errors)
+
+    if not errors and brightness is None and state is None:
+        errors['state'] = ['Missing data for required field.']
+    if errors:
+        raise PayloadValidationError(errors)
+
+    if brightness is None:
+        item['brightness'] = DEFAULT_BRIGHTNESS[state]
+    else:
+        item['brightness'] = brightness
+    return item
+
+
+def _load_state(item, errors):
+    state = item.get('state')
+    if 'state' not in item:
+        return state
+    if state is None:
+        errors['state'] = ['Field may not be null.']
+    elif type(state) is not str:
+        errors['state'] = ['Not a valid string.']
+    elif state not in STATES:
+        errors['state'] = ['Must be one of: ON, OFF.']
+    return state
+
+
+def _load_force(item, errors):
+    """Replace an optional `force` with True or False"""
+    if 'force' not in item:
+        return
+    value = item['force']
+    try:
+        item['force'] = True if value in FORCE_TRUTHY else False if value in FORCE_FALSY else None
+    except TypeError:
+        # unhashable, e.g. a list
+        item['force'] = None
+    if item['force'] is None:
+        errors['force'] = ['Field may not be null.'] if value is None else ['Not a valid boolean.']
+
+
+def _load_brightness(value, errors):
+    if value is None:
+        errors['brightness'] = ['Field may not be null.']
+        return None
+    if value is True or value is False:
+        errors['brightness'] = ['Not a valid integer.']
+        return None
+
+    try:
+        brightness = int(value)
+    except (TypeError, ValueError, OverflowError):
+        errors['brightness'] = ['Not a valid integer.']
+        return None
+
+    if not 0 <= brightness <= 255:
+        errors['brightness'] = ['Must be greater than or equal to 0 and less than or equal to 255.']
+        return None
+    return brightness
@@ -0,0 +1,154 @@
+"""Recording what reaches rakomqtt, and replaying it.
+
+`--record PATH` appends every udp status frame the watcher receives and
+every mqtt command message the commander receives to a binary log. The log
+starts with MAGIC, then each record is
+
+    timestamp (f64, time.monotonic())  kind (u8)  length (u32)  body
+
+little endian. A KIND_STATUS body is the sender's ipv4 address (4 bytes)
+then the frame, a KIND_COMMAND body is the topic's length (u16), the utf-8
+topic then the payload. Each record is appended with a single write to a
+file opened O_APPEND, so the watcher and commander started by start.sh can
+record to the same file.
+
+`--mode replay --replay PATH` feeds a log back through the status decoder
+and the command parser, at the recorded speed or as fast as possible. The
+log is memory mapped, so a big capture isn't read into memory.
+"""
+import logging
+import mmap
+import os
+import socket
+import struct
+import time
+
+
+_LOGGER = logging.getLogger(__name__)
+MAGIC = b'RAKOREC1'
+KIND_STATUS = 1
+KIND_COMMAND = 2
+_RECORD_HEADER = struct.Struct('<dBI')
+_TOPIC_LENGTH = struct.Struct('<H')
+_NO_ADDRESS = bytes(4)
+
+
+class FrameRecorder:
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size == 0:
+            os.write(self._fd, MAGIC)
+
+    def record_status(self, frame, address=None, timestamp=None):
+        """:param address: (ip, port) the frame came from"""
+        ip = socket.inet_aton(address[0]) if address else _NO_ADDRESS
+        self._write(KIND_STATUS, ip + bytes(frame), timestamp)
+
+    def record_command(self, topic, payload, timestamp=None):
+        topic = topic.encode()
+        self._write(KIND_COMMAND, _TOPIC_LENGTH.pack(len(topic)) + topic + payload, timestamp)
+
+    def _write(self, kind, body, timestamp=None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        try:
+            os.write(self._fd, _RECORD_HEADER.pack(timestamp, kind, len(body)) + body)
+        except OSError as ex:
+            _LOGGER.error(f"Couldn't record to {self.path}: {ex}")
+
+    def close(self):
+        os.close(self._fd)
+
+
+def read_records(path):
+    """Yield (timestamp, kind, body) for each record in the log. A record cut
+    short, by the recording process being killed mid write, ends the log.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError(f"{path} isn't a rakomqtt recording")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            if log[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} isn't a rakomqtt recording")
+            offset = len(MAGIC)
+            while offset + _RECORD_HEADER.size <= size:
+                timestamp, kind, length = _RECORD_HEADER.unpack_from(log, offset)
+                offset += _RECORD_HEADER.size
+                if offset + length > size:
+                    _LOGGER.warning(f"{path} ends with a truncated record")
+                    return
+                yield timestamp, kind, log[offset:offset + length]
+                offset += length
+
+
+def decode_status(body):
+    """:return ((ip, 0) or None, frame) from a KIND_STATUS record body"""
+    ip, frame = body[:4], body[4:]
+    return (socket.inet_ntoa(ip), 0) if ip != _NO_ADDRESS else None, frame
+
+
+def decode_command(body):
+    """:return (topic, payload) from a KIND_COMMAND record body"""
+    (topic_length,) = _TOPIC_LENGTH.unpack_from(body)
+    topic_end = _TOPIC_LENGTH.size + topic_length
+    return body[_TOPIC_LENGTH.size:topic_end].decode(), body[topic_end:]
+
+
+class _CountingMQTTClient:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+
+def replay(path, speed=1.0, strict_payloads=False):
+    """Feed a recording through the status decoder and the command parser.
+    Nothing is published or sent to a bridge.
+
+    :param speed: multiple of the recorded speed, 0 for as fast as possible
+    :return dict of counts
+    """
+    # only replaying needs the watcher and commander, recording doesn't
+    import paho.mqtt.client as mqtt
+
+    from rakomqtt.commander import parse_command
+    from rakomqtt.RakoBridge import RakoStatusDecoder
+    from rakomqtt.state import StateStore
+    from rakomqtt.watcher import process_frame
+
+    decoder = RakoStatusDecoder()
+    state_store = StateStore()
+    mqtt_client = _CountingMQTTClient()
+    stats = dict(status_frames=0, commands=0, commands_parsed=0)
+    first_timestamp = None
+    started = time.monotonic()
+
+    for timestamp, kind, body in read_records(path):
+        if speed:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        if kind == KIND_STATUS:
+            _, frame = decode_status(body)
+            stats['status_frames'] += 1
+            process_frame(frame, decoder, state_store, mqtt_client, time.monotonic())
+        elif kind == KIND_COMMAND:
+            topic, payload = decode_command(body)
+            msg = mqtt.MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            stats['commands'] += 1
+            if parse_command(msg, strict_payloads):
+                stats['commands_parsed'] += 1
+
+    stats.update(states_published=mqtt_client.published, seconds=round(time.monotonic() - started, 3))
+    return stats
+
+
+def run_replay(replay_path, replay_speed=1.0, strict_payloads=False):
+    stats = replay(replay_path, replay_speed, strict_payloads)
+    _LOGGER.info(f"Replayed {replay_path}: {stats}")
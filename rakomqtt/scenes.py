@@ -0,0 +1,133 @@
+"""Which brightness stands for each room scene.
+
+A room's state is published with the brightness of its scene, and a room
+command's brightness picks the scene. By default scenes 1-4 are brightness
+255, 192, 128 and 64 in every room. `--scene-config PATH` takes a json file
+to change that, e.g.
+
+    {"default": [255, 192, 128, 64], "rooms": {"42": [255, 170, 85]}, "rako_xml": true}
+
+`rooms` gives the ladder of particular rooms and `rako_xml` gives every other
+room in the bridge's topology a ladder worked out from rako.xml (see
+SceneMap.for_topology).
+
+Each ladder is compiled once into two 256 entry tables, so turning a scene
+into a brightness when decoding a status frame, or a brightness into a
+scene when encoding a command, is a single index.
+"""
+import json
+import logging
+
+
+_LOGGER = logging.getLogger(__name__)
+# the brightness of scenes 1, 2, 3 and 4
+DEFAULT_SCENE_BRIGHTNESS = (255, 192, 128, 64)
+
+
+class SceneLadder:
+    """
+    scene_to_brightness[scene] is the brightness of the scene, None if the
+    room doesn't use it. brightness_to_scene[brightness] is the scene whose
+    brightness is nearest, the brighter one on a tie, 0 (off) only for 0.
+    """
+
+    def __init__(self, brightnesses):
+        """:param brightnesses: brightnesses[scene - 1] is the brightness of the scene, 0 or None if unused"""
+        brightnesses = list(brightnesses)
+        if len(brightnesses) > 255:
+            raise ValueError(f"A room can't have {len(brightnesses)} scenes")
+        scenes = [(scene, brightness) for scene, brightness in enumerate(brightnesses, start=1) if brightness]
+        for scene, brightness in scenes:
+            if not (isinstance(brightness, int) and 0 < brightness <= 255):
+                raise ValueError(f"Scene {scene} brightness must be 0-255, not {brightness!r}")
+        if not scenes:
+            raise ValueError("A room needs at least one scene with a brightness")
+
+        self.brightnesses = tuple(brightnesses)
+        scene_to_brightness = [None] * 256
+        scene_to_brightness[0] = 0
+        for scene, brightness in scenes:
+            scene_to_brightness[scene] = brightness
+        self.scene_to_brightness = tuple(scene_to_brightness)
+        self.brightness_to_scene = bytes([0]) + bytes(
+            min(scenes, key=lambda s: (abs(s[1] - level), -s[1], s[0]))[0] for level in range(1, 256)
+        )
+
+    def exact_scene(self, brightness):
+        """:return the scene with exactly this brightness, or None"""
+        scene = self.brightness_to_scene[brightness]
+        return scene if self.scene_to_brightness[scene] == brightness else None
+
+    def __eq__(self, other):
+        return isinstance(other, SceneLadder) and self.scene_to_brightness == other.scene_to_brightness
+
+    def __repr__(self):
+        return f"SceneLadder({list(self.brightnesses)})"
+
+
+class SceneMap:
+    def __init__(self, rooms=None, default=DEFAULT_SCENE_BRIGHTNESS, from_topology=False):
+        """
+        :param rooms: {room_id: brightnesses} of rooms which don't use the default ladder
+        :param default: brightnesses of every other room's scenes
+        :param from_topology: see for_topology
+        """
+        self.default = default if isinstance(default, SceneLadder) else SceneLadder(default)
+        self.rooms = {
+            room: ladder if isinstance(ladder, SceneLadder) else SceneLadder(ladder)
+            for room, ladder in (rooms or {}).items()
+        }
+        self.from_topology = from_topology
+
+    def ladder(self, room):
+        return self.rooms.get(room, self.default)
+
+    def brightness(self, room, scene):
+        """:return the brightness of the room's scene, None if the room doesn't use it"""
+        return self.rooms.get(room, self.default).scene_to_brightness[scene]
+
+    def scene(self, room, brightness):
+        """:return the room's scene nearest the brightness (0-255)"""
+        return self.rooms.get(room, self.default).brightness_to_scene[brightness]
+
+    def for_topology(self, topology):
+        """With from_topology, a SceneMap which also has a ladder for each
+        room in the topology without one already. A scene's brightness is
+        the mean level it sets the room's channels to, a scene which turns
+        every channel off is unused. Otherwise this SceneMap.
+        """
+        if not self.from_topology or topology is None:
+            return self
+        rooms = dict(self.rooms)
+        for room_id, room in topology.rooms.items():
+            if room_id in rooms or not room.channels:
+                continue
+            scene_count = max(len(channel.levels) for channel in room.channels.values())
+            brightnesses = [
+                round(sum(levels) / len(levels))
+                for levels in (
+                    [channel.level(scene) or 0 for channel in room.channels.values()]
+                    for scene in range(1, scene_count + 1)
+                )
+            ]
+            if any(brightnesses):
+                rooms[room_id] = SceneLadder(brightnesses)
+        _LOGGER.debug(f"Scene ladders from rako.xml: {rooms}")
+        return SceneMap(rooms, self.default)
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(
+            rooms={int(room): brightnesses for room, brightnesses in config.get('rooms', {}).items()},
+            default=config.get('default', DEFAULT_SCENE_BRIGHTNESS),
+            from_topology=bool(config.get('rako_xml', False)),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load the scene config json file described at the top of this module"""
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+DEFAULT_SCENE_MAP = SceneMap()
@@ -0,0 +1,273 @@
+"""A stand-in for an RA-BRIDGE, for load and latency testing on one machine.
+
+    python -m rakomqtt.simulator --http-port 8080 --status-rate 50
+    python -m rakomqtt --mode commander --rako-bridge-host 127.0.0.1:8080 ...
+
+It answers the 'D' discovery broadcast, serves rako.cgi and rako.xml over
+http and broadcasts status frames in the format RakoStatusMessage parses:
+one for every command it applies, plus random level changes at
+--status-rate. Response latency and the way the bridge drops commands are
+tunable.
+
+Discovery replies only carry an ip address, so a simulator on a port other
+than 80 must be given to rakomqtt explicitly with --rako-bridge-host.
+"""
+import argparse
+import logging
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from rakomqtt.RakoBridge import RakoBridge, RakoCommandType
+
+
+_LOGGER = logging.getLogger(__name__)
+SCENE_LEVELS = (0, 255, 192, 128, 64)
+
+
+def status_frame(room, channel, command, *data):
+    """Encode a status frame as the bridge broadcasts it.
+
+    :param command: RakoCommandType value
+    """
+    body = [room >> 8, room & 0xFF, channel, command, *data]
+    frame = [ord('S'), len(body) + 1] + body
+    # the status CRC doesn't include the bytes-to-follow byte
+    return bytes(frame + [(256 - sum(body)) % 256])
+
+
+class BridgeSimulator:
+    def __init__(
+        self,
+        rooms=10,
+        channels=4,
+        latency=0.0,
+        latency_jitter=0.0,
+        drop_rate=0.0,
+        max_command_rate=0,
+        status_target=('255.255.255.255', RakoBridge.port),
+        seed=None,
+    ):
+        """
+        :param latency: seconds before rako.cgi responds, plus up to latency_jitter more
+        :param drop_rate: fraction of commands answered with "Success!" but never applied
+        :param max_command_rate: commands per second above which commands are dropped (0 for no limit)
+        """
+        self.rooms = rooms
+        self.channels = channels
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.drop_rate = drop_rate
+        self.max_command_rate = max_command_rate
+        self.status_target = status_target
+        self.levels = {(room, channel): 0 for room in range(1, rooms + 1) for channel in range(1, channels + 1)}
+        self.received = 0
+        self.applied = 0
+        self.dropped = 0
+        self.frames_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_command = 0
+        self._status_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._status_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def handle_command(self, params):
+        """Apply a rako.cgi command. Returns whether the request was valid,
+        which isn't the same as the command being applied.
+        """
+        try:
+            room = int(params['room'])
+            channel = int(params['ch'])
+            scene = int(params['sc']) if 'sc' in params else None
+            level = int(params['lev']) if scene is None else None
+        except (KeyError, ValueError):
+            return False
+
+        with self._lock:
+            self.received += 1
+            now = time.monotonic()
+            too_fast = self.max_command_rate and now - self._last_command < 1 / self.max_command_rate
+            self._last_command = now
+            if too_fast or self._random.random() < self.drop_rate:
+                self.dropped += 1
+                return True
+            self.applied += 1
+
+        if scene is not None:
+            self._set_levels(room, channel, SCENE_LEVELS[scene] if scene < len(SCENE_LEVELS) else 0)
+            self.send_status(status_frame(room, channel, RakoCommandType.SET_SCENE.value, 0, scene))
+        else:
+            self._set_levels(room, channel, level)
+            self.send_status(status_frame(room, channel, RakoCommandType.SET_LEVEL.value, 0, level))
+        return True
+
+    def _set_levels(self, room, channel, level):
+        with self._lock:
+            for (r, c) in self.levels:
+                if r == room and channel in (0, c):
+                    self.levels[(r, c)] = level
+
+    def send_status(self, frame):
+        self._status_sock.sendto(frame, self.status_target)
+        self.frames_sent += 1
+
+    def random_status_frame(self):
+        room = self._random.randint(1, self.rooms)
+        channel = self._random.randint(1, self.channels)
+        level = self._random.randint(0, 255)
+        self._set_levels(room, channel, level)
+        return status_frame(room, channel, RakoCommandType.SET_LEVEL.value, 0, level)
+
+    def response_delay(self):
+        return self.latency + self._random.random() * self.latency_jitter
+
+    def rako_xml(self):
+        rooms = []
+        for room in range(1, self.rooms + 1):
+            channels = ''.join(
+                f'<Channel id="{channel}"><type>Default</type><Name>Channel {channel}</Name>'
+                f'<Levels>FFBF7F3F000000000000000000000000</Levels></Channel>'
+                for channel in range(1, self.channels + 1)
+            )
+            rooms.append(
+                f'<Room id="{room}"><Type>Lights</Type><Title>Room {room}</Title><mode>4+OFF</mode>{channels}</Room>'
+            )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?><rako><info><version>2.4.0 RA</version>'
+            '<hostName>RAKOSIMULATOR</hostName></info>'
+            f'<rooms>{"".join(rooms)}</rooms></rako>'
+        )
+
+    def stats(self):
+        return dict(received=self.received, applied=self.applied, dropped=self.dropped, frames_sent=self.frames_sent)
+
+
+class _SimulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        simulator = self.server.simulator
+        if url.path == '/rako.cgi':
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            valid = simulator.handle_command(params)
+            time.sleep(simulator.response_delay())
+            self._respond(200 if valid else 400, b'Success!' if valid else b'Error', 'text/html')
+        elif url.path == '/rako.xml':
+            self._respond(200, simulator.rako_xml().encode(), 'text/xml')
+        else:
+            self._respond(404, b'Not found', 'text/html')
+
+    do_POST = do_GET
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format, *args)
+
+
+def udp_command_params(frame):
+    """The rako.cgi params equivalent to a binary 'R' command frame, or None
+    if it isn't a valid scene/level command
+    """
+    if len(frame) != 9 or frame[0] != ord('R') or frame[1] != 7 or sum(frame[1:]) & 0xFF:
+        return None
+    room, channel, command, value = frame[2] << 8 | frame[3], frame[4], frame[5], frame[7]
+    if command == RakoCommandType.SET_SCENE.value:
+        return dict(room=room, ch=channel, sc=value)
+    if command == RakoCommandType.SET_LEVEL.value:
+        return dict(room=room, ch=channel, lev=value)
+    return None
+
+
+def _answer_udp(simulator, udp_port, discovery=True):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', udp_port))
+    while True:
+        data, address = sock.recvfrom(256)
+        if data == b'D' and discovery:
+            _LOGGER.info(f"Answering discovery from {address}")
+            sock.sendto(b'RAKOSIMULATOR\r\n00:00:00:00:00:00\r\n', address)
+        elif data[:1] == b'R':
+            params = udp_command_params(data)
+            ok = params is not None and simulator.handle_command(params)
+            sock.sendto(b'AOK' if ok else b'AERROR', address)
+
+
+def _emit_status(simulator, rate):
+    while True:
+        time.sleep(1 / rate)
+        simulator.send_status(simulator.random_status_frame())
+
+
+def _log_stats(simulator, interval=10):
+    while True:
+        time.sleep(interval)
+        _LOGGER.info(f"simulator stats: {simulator.stats()}")
+
+
+def serve(simulator, http_address=('', 8080), udp_port=RakoBridge.port, status_rate=0, discovery=True):
+    httpd = ThreadingHTTPServer(http_address, _SimulatorRequestHandler)
+    httpd.simulator = simulator
+
+    threads = [(_log_stats, (simulator,))]
+    threads.append((_answer_udp, (simulator, udp_port, discovery)))
+    if status_rate:
+        threads.append((_emit_status, (simulator, status_rate)))
+    for target, args in threads:
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    _LOGGER.info(f"Simulating a rako bridge on http://{http_address[0] or '0.0.0.0'}:{httpd.server_address[1]}")
+    httpd.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rakomqtt: rako bridge simulator")
+    parser.add_argument("--http-host", default='', help="address to serve rako.cgi/rako.xml on")
+    parser.add_argument("--http-port", type=int, default=8080)
+    parser.add_argument(
+        "--udp-port", type=int, default=RakoBridge.port, help="port for discovery, udp commands and status frames"
+    )
+    parser.add_argument("--no-discovery", dest='discovery', action='store_false', help="don't answer discovery")
+    parser.add_argument("--status-target", default='255.255.255.255', help="address to send status frames to")
+    parser.add_argument("--status-rate", type=float, default=0, help="random status frames per second")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0, help="seconds before rako.cgi responds")
+    parser.add_argument("--latency-jitter", type=float, default=0, help="up to this many extra seconds of latency")
+    parser.add_argument("--drop-rate", type=float, default=0, help="fraction of commands silently dropped")
+    parser.add_argument(
+        "--max-command-rate", type=float, default=0, help="drop commands arriving faster than this per second"
+    )
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s [simulator] %(message)s",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    simulator = BridgeSimulator(
+        rooms=args.rooms,
+        channels=args.channels,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        drop_rate=args.drop_rate,
+        max_command_rate=args.max_command_rate,
+        status_target=(args.status_target, args.udp_port),
+        seed=args.seed,
+    )
+    serve(simulator, (args.http_host, args.http_port), args.udp_port, args.status_rate, args.discovery)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import json
+import logging
+import threading
+
+from rakomqtt.metrics import COMMANDS_SKIPPED
+from rakomqtt.RakoBridge import DEFAULT_TOPIC_PREFIX, RakoBridge, RakoCommandType, RakoStatusMessage
+from rakomqtt.scenes import DEFAULT_SCENE_MAP
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class StateStore:
+    """The last published state of every room and channel topic.
+
+    The payload is the json encoding of the (state, brightness) pair, so two
+    payloads for a topic are equal exactly when that pair is unchanged.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+        self.changed = 0
+        self.suppressed = 0
+
+    def update(self, topic, payload):
+        """Record the payload for the topic.
+
+        :return True if it differs from the current state and should be published
+        """
+        with self._lock:
+            if self._states.get(topic) == payload:
+                self.suppressed += 1
+                return False
+            self._states[topic] = payload
+            self.changed += 1
+            return True
+
+    def get(self, topic):
+        return self._states.get(topic)
+
+    def snapshot(self):
+        """:return {topic: payload} copy of every known state"""
+        with self._lock:
+            return dict(self._states)
+
+    def __len__(self):
+        return len(self._states)
+
+
+class ConfirmedStates:
+    """The state of each room and channel of a bridge as the watcher last
+    published it, so the commander can skip a command which wouldn't change
+    anything. Keyed by state topic, as RakoBridge.create_topic makes them.
+
+    Sending a command forgets the states of its room, as a channel level
+    changes the room's scene and a room scene changes the channels' levels,
+    until the watcher publishes them again. A room scene or level replaces
+    the states of the room's channels, with the levels the scene sets them
+    to when there's a topology. A channel state which isn't the level the
+    room's scene or level sets it to (a keypad, the app) forgets the room's
+    state, as it no longer holds.
+    """
+
+    def __init__(self, topic_prefix=DEFAULT_TOPIC_PREFIX, scene_map=None, topology=None):
+        """:param topology: topology.Topology giving the levels each room scene sets its channels to"""
+        self.topic_prefix = topic_prefix
+        self._scene_map = scene_map or DEFAULT_SCENE_MAP
+        self._topology = topology
+        # room: {topic: brightness}
+        self._rooms = {}
+        self._lock = threading.Lock()
+        self.skipped = 0
+
+    def update(self, topic, payload):
+        """Record a state message the watcher published"""
+        parts = topic[len(self.topic_prefix) + 1:].split('/')
+        try:
+            room = int(parts[1])
+            channel = int(parts[3]) if len(parts) > 2 else 0
+            brightness = json.loads(payload)['brightness']
+            if type(brightness) is not int or not 0 <= brightness <= 255:
+                raise ValueError(brightness)
+        except (ValueError, IndexError, KeyError, TypeError):
+            _LOGGER.debug('Ignoring state %s: %r', topic, payload)
+            return
+        with self._lock:
+            if channel == 0:
+                self._rooms[room] = self._room_states(room, topic, brightness)
+                return
+            states = self._rooms.setdefault(room, {})
+            for room_topic in (self._room_topic(room), self._channel_topic(room, 0)):
+                # e.g. the levels derived from a room scene match it, a keypad's don't
+                if room_topic in states and self._room_states(room, room_topic, states[room_topic]).get(topic) != brightness:
+                    del states[room_topic]
+            states[topic] = brightness
+
+    def redundant(self, rako_command):
+        """:return True if the RakoCommand would leave its light as it is, unless it's forced"""
+        if rako_command.force:
+            return False
+        with self._lock:
+            brightness = self._rooms.get(rako_command.room, {}).get(self._topic(rako_command))
+        if brightness is None:
+            return False
+        if rako_command.scene is not None:
+            redundant = self._scene_map.ladder(rako_command.room).exact_scene(brightness) == rako_command.scene
+        else:
+            redundant = brightness == rako_command.brightness
+        if redundant:
+            self.skipped += 1
+            COMMANDS_SKIPPED.inc()
+            _LOGGER.debug('Skipping %s, the light is already in that state', rako_command)
+        return redundant
+
+    def sent(self, rako_command):
+        with self._lock:
+            self._rooms.pop(rako_command.room, None)
+
+    def _room_states(self, room, topic, brightness):
+        """:return {topic: brightness} of a room state and the channel levels it implies"""
+        states = {topic: brightness}
+        if self._topology is None:
+            return states
+        if topic == self._room_topic(room):
+            scene = self._scene_map.ladder(room).exact_scene(brightness)
+            levels = self._topology.scene_levels(room, 0, scene) if scene is not None else []
+        else:
+            levels = [(channel, brightness) for channel, _ in self._topology.scene_levels(room, 0, 0)]
+        for channel, level in levels:
+            states[self._channel_topic(room, channel)] = level
+        return states
+
+    def _room_topic(self, room):
+        return RakoBridge.create_topic(RakoStatusMessage(room, 0, RakoCommandType.SET_SCENE), self.topic_prefix)
+
+    def _channel_topic(self, room, channel):
+        return RakoBridge.create_topic(RakoStatusMessage(room, channel, RakoCommandType.SET_LEVEL), self.topic_prefix)
+
+    def _topic(self, rako_command):
+        command = RakoCommandType.SET_SCENE if rako_command.scene is not None else RakoCommandType.SET_LEVEL
+        return RakoBridge.create_topic(
+            RakoStatusMessage(rako_command.room, rako_command.channel, command), self.topic_prefix
+        )
@@ -0,0 +1,200 @@
+"""Which rooms and channels the installation has, from the bridge's rako.xml.
+
+rako.xml lists every room, its channels and, per channel, the level each
+scene sets it to. It's fetched once and the index is kept in a small json
+cache file (RAKOMQTT_TOPOLOGY_CACHE, set it empty to disable) so restarts
+don't need the bridge to answer. With it the commander can reject commands
+for rooms and channels which don't exist, and the watcher can work out the
+level of every channel in a room from a single room scene frame.
+"""
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from rakomqtt.discovery import DEFAULT_DISCOVERY_CACHE
+from rakomqtt.RakoBridge import CONNECT_TIMEOUT, READ_TIMEOUT
+
+
+_LOGGER = logging.getLogger(__name__)
+TOPOLOGY_CACHE_TTL = 24 * 60 * 60
+DEFAULT_TOPOLOGY_CACHE = os.path.join(os.path.dirname(DEFAULT_DISCOVERY_CACHE), 'topology.json')
+# room 0 is the whole house, it's never in rako.xml
+WHOLE_HOUSE = 0
+
+
+@dataclass
+class Channel:
+    channel_id: int
+    name: str = None
+    # levels[scene - 1] is the level (0-255) scene sets the channel to
+    levels: tuple = ()
+
+    def level(self, scene):
+        """:return the level the scene sets the channel to, 0 for scene 0 (off), None if it's not in rako.xml"""
+        if scene == 0:
+            return 0
+        if 0 < scene <= len(self.levels):
+            return self.levels[scene - 1]
+        return None
+
+
+@dataclass
+class Room:
+    room_id: int
+    title: str = None
+    channels: dict = field(default_factory=dict)
+
+
+class Topology:
+    def __init__(self, rooms):
+        """:param rooms: {room_id: Room}"""
+        self.rooms = rooms
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def has_channel(self, room_id, channel_id):
+        """Channel 0 is the whole room, so it exists in every room, and room 0 always exists"""
+        if room_id == WHOLE_HOUSE:
+            return True
+        room = self.rooms.get(room_id)
+        return room is not None and (channel_id == 0 or channel_id in room.channels)
+
+    def scene_levels(self, room_id, channel_id, scene):
+        """
+        :return [(channel_id, level)] for the channels a scene sets, every
+        channel in the room when channel_id is 0. Empty if the room is unknown.
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            return []
+        channels = room.channels.values() if channel_id == 0 else [room.channels.get(channel_id)]
+        return [
+            (channel.channel_id, channel.level(scene))
+            for channel in channels
+            if channel is not None and channel.level(scene) is not None
+        ]
+
+    @classmethod
+    def from_xml(cls, text):
+        """Parse rako.xml, as described in "XML" in accessing-the-rako-bridge.pdf"""
+        import xml.etree.ElementTree as ElementTree
+
+        rooms = {}
+        for room_el in ElementTree.fromstring(text).iter('Room'):
+            room = Room(int(room_el.get('id')), room_el.findtext('Title'))
+            for channel_el in room_el.iter('Channel'):
+                levels = bytes.fromhex((channel_el.findtext('Levels') or '').strip())
+                channel = Channel(int(channel_el.get('id')), channel_el.findtext('Name'), tuple(levels))
+                room.channels[channel.channel_id] = channel
+            rooms[room.room_id] = room
+        return cls(rooms)
+
+    def to_dict(self):
+        return {
+            str(room.room_id): dict(
+                title=room.title,
+                channels={
+                    str(channel.channel_id): dict(name=channel.name, levels=list(channel.levels))
+                    for channel in room.channels.values()
+                },
+            )
+            for room in self.rooms.values()
+        }
+
+    @classmethod
+    def from_dict(cls, rooms_dict):
+        rooms = {}
+        for room_id, room_dict in rooms_dict.items():
+            room = Room(int(room_id), room_dict['title'])
+            for channel_id, channel_dict in room_dict['channels'].items():
+                room.channels[int(channel_id)] = Channel(
+                    int(channel_id), channel_dict['name'], tuple(channel_dict['levels'])
+                )
+            rooms[room.room_id] = room
+        return cls(rooms)
+
+
+class TopologyCache:
+    def __init__(self, path=None, ttl=TOPOLOGY_CACHE_TTL):
+        self.path = os.environ.get('RAKOMQTT_TOPOLOGY_CACHE', DEFAULT_TOPOLOGY_CACHE) if path is None else path
+        self.ttl = ttl
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached if isinstance(cached, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, host, ttl=None):
+        """:return the cached Topology of the host if there is one younger than the ttl"""
+        if not self.path:
+            return None
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            cached = self._read()[host]
+            if time.time() - cached['fetched_at'] < ttl:
+                return Topology.from_dict(cached['rooms'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def save(self, host, topology):
+        """Cache the host's topology, alongside those of any other bridges"""
+        if not self.path:
+            return
+        cached = self._read()
+        cached[host] = dict(fetched_at=time.time(), rooms=topology.to_dict())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            _LOGGER.warning(f"Couldn't write the topology cache {self.path}: {ex}")
+
+
+def fetch_topology(host, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+    """:return the Topology from the bridge's rako.xml, or None if it can't be read"""
+    import requests
+
+    try:
+        response = requests.get(f'http://{host}/rako.xml', timeout=timeout)
+        response.raise_for_status()
+        return Topology.from_xml(response.content)
+    except requests.exceptions.RequestException as ex:
+        _LOGGER.warning(f"Couldn't fetch rako.xml from {host}: {ex}")
+    except (SyntaxError, ValueError, TypeError) as ex:
+        # ElementTree.ParseError is a SyntaxError
+        _LOGGER.warning(f"Couldn't parse rako.xml from {host}: {ex}")
+    return None
+
+
+def load_topology(host, cache=None):
+    """The cached topology of the bridge, or fetch it and cache it. Falls
+    back to an expired cached copy if the bridge can't be reached.
+
+    :return the Topology, or None if it's unknown, in which case nothing
+    should be filtered or derived from it
+    """
+    cache = cache if cache is not None else TopologyCache()
+    topology = cache.load(host)
+    if topology is None:
+        topology = fetch_topology(host)
+        if topology:
+            cache.save(host, topology)
+        else:
+            topology = cache.load(host, ttl=float('inf'))
+
+    if not topology:
+        # rako.xml is empty until the installation is uploaded from Rasoft
+        _LOGGER.info(f"No rooms known for rako bridge {host}, commands won't be checked")
+        return None
+    _LOGGER.info(f"Loaded {len(topology)} rooms from rako bridge {host}")
+    return topology
+
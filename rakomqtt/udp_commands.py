@@ -0,0 +1,78 @@
+"""Sending commands to the bridge as binary UDP frames on port 9761, as an
+alternative to http rako.cgi. See "Sending Commands" in
+accessing-the-rako-bridge.pdf for the frame format.
+"""
+import logging
+import socket
+import time
+
+from rakomqtt.RakoBridge import RakoBridge, RakoCommandType
+
+
+_LOGGER = logging.getLogger(__name__)
+USE_DEFAULT_RATE = 0x01
+
+
+def command_checksum(frame):
+    # unlike status frames, the command CRC includes the bytes-to-follow byte
+    return (256 - sum(frame[1:])) % 256
+
+
+def encode_command(rako_command):
+    """
+    :return bytes of an 'R' frame setting the scene or level of the RakoCommand
+    """
+    if rako_command.scene is not None:
+        command, value = RakoCommandType.SET_SCENE, rako_command.scene
+    else:
+        command, value = RakoCommandType.SET_LEVEL, rako_command.brightness
+
+    room = rako_command.room
+    body = [room >> 8, room & 0xFF, rako_command.channel, command.value, USE_DEFAULT_RATE, value]
+    frame = [ord('R'), len(body) + 1] + body
+    return bytes(frame + [command_checksum(frame)])
+
+
+class UdpCommandTransport:
+    """Sends each command as `repeat` copies of its frame, `spacing`
+    seconds apart. Sending is fire and forget, the bridge's AOK/AERROR
+    replies aren't waited for.
+    """
+
+    def __init__(self, host, port=RakoBridge.port, repeat=1, spacing=0.0):
+        self.address = (host, port)
+        self.repeat = repeat
+        self.spacing = spacing
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _frames(self, rako_commands):
+        frames = [encode_command(rako_command) for rako_command in rako_commands]
+        return [frame for frame in frames for _ in range(self.repeat)]
+
+    def send(self, *rako_commands):
+        """Send the commands back to back.
+
+        :return True if every frame was handed to the network
+        """
+        try:
+            for i, frame in enumerate(self._frames(rako_commands)):
+                if i and self.spacing:
+                    time.sleep(self.spacing)
+                self._sock.sendto(frame, self.address)
+        except OSError as ex:
+            _LOGGER.error(f"Can't send udp command to {self.address}: {ex}")
+            return False
+        return True
+
+    async def send_async(self, *rako_commands):
+        import asyncio
+
+        try:
+            for i, frame in enumerate(self._frames(rako_commands)):
+                if i and self.spacing:
+                    await asyncio.sleep(self.spacing)
+                self._sock.sendto(frame, self.address)
+        except OSError as ex:
+            _LOGGER.error(f"Can't send udp command to {self.address}: {ex}")
+            return False
+        return True
@@ -1,43 +1,277 @@
-import json
 import logging
+import os
+import select
 import socket
+import time
 
-from rakomqtt.MQTTClient import MQTTClient
-from rakomqtt.RakoBridge import RakoBridge
+from rakomqtt.const import DEFAULT_UDP_BATCH_SIZE, DEFAULT_UDP_RCVBUF
+from rakomqtt.metrics import (
+    FRAMES_DECODED,
+    FRAMES_PUBLISHED,
+    FRAMES_RECEIVED,
+    FRAMES_REJECTED,
+    FRAMES_SUPPRESSED,
+    UDP_TO_PUBLISH_SECONDS,
+)
+from rakomqtt.MQTTClient import (
+    DEFAULT_MAX_INFLIGHT,
+    DEFAULT_MAX_PENDING,
+    DEFAULT_QOS,
+    DEFAULT_RECONNECT_MAX_DELAY,
+    DEFAULT_RECONNECT_MIN_DELAY,
+    MQTTClient,
+)
+from rakomqtt.RakoBridge import RakoBridge, RakoStatusDecoder
+from rakomqtt.state import StateStore
 
 
 _LOGGER = logging.getLogger(__name__)
+MAX_DATAGRAM_SIZE = 256
+DROP_CHECK_INTERVAL = 10
 
 
-def run_watcher(mqtt_host, mqtt_user, mqtt_password):
-    udp_sock = _connect_udp_socket(RakoBridge.port)
-    mqtt_client = _connect_mqtt(mqtt_host, mqtt_user, mqtt_password)
+def run_watcher(
+    mqtt_host,
+    mqtt_user,
+    mqtt_password,
+    udp_rcvbuf=DEFAULT_UDP_RCVBUF,
+    udp_batch_size=DEFAULT_UDP_BATCH_SIZE,
+    rako_bridge_host=None,
+    use_topology=True,
+    bridges=None,
+    recorder=None,
+    mqtt_qos=DEFAULT_QOS,
+    mqtt_max_inflight=DEFAULT_MAX_INFLIGHT,
+    mqtt_max_pending=DEFAULT_MAX_PENDING,
+    mqtt_reconnect_min_delay=DEFAULT_RECONNECT_MIN_DELAY,
+    mqtt_reconnect_max_delay=DEFAULT_RECONNECT_MAX_DELAY,
+    scene_map=None,
+):
+    """
+    :param rako_bridge_host: only needed to fetch the topology, the cached
+    discovered bridge is used if not given
+    :param use_topology: publish the channel levels implied by room scenes
+    :param bridges: BridgeSpecs of several bridges, whose frames are told
+    apart by their source address and published under their topic prefix
+    :param recorder: recorder.FrameRecorder to record every frame received to
+    :param mqtt_qos, mqtt_max_inflight, mqtt_max_pending: see MQTTClient
+    :param mqtt_reconnect_min_delay, mqtt_reconnect_max_delay: see MQTTClient.ReconnectPolicy
+    :param scene_map: scenes.SceneMap of the brightness of each room's scenes
+    """
+    if bridges:
+        from rakomqtt.bridges import status_demultiplexer
 
-    _listen(udp_sock, mqtt_client)
+        topology = None
+        demultiplexer = status_demultiplexer(bridges, use_topology, scene_map)
+    else:
+        topology = _load_topology(rako_bridge_host) if use_topology else None
+        demultiplexer = None
+        if scene_map:
+            scene_map = scene_map.for_topology(topology)
+    udp_sock = _connect_udp_socket(RakoBridge.port, udp_rcvbuf)
+    # every state is republished on reconnect, so none changed while disconnected is lost
+    state_store = StateStore()
+    mqtt_client = _connect_mqtt(
+        mqtt_host,
+        mqtt_user,
+        mqtt_password,
+        qos=mqtt_qos,
+        max_inflight=mqtt_max_inflight,
+        max_pending=mqtt_max_pending,
+        reconnect_min_delay=mqtt_reconnect_min_delay,
+        reconnect_max_delay=mqtt_reconnect_max_delay,
+        resync=state_store.snapshot,
+    )
 
+    _listen(
+        udp_sock,
+        mqtt_client,
+        udp_batch_size,
+        state_store,
+        topology=topology,
+        demultiplexer=demultiplexer,
+        recorder=recorder,
+        scene_map=scene_map,
+    )
 
-def _connect_mqtt(mqtt_host, mqtt_user, mqtt_password):
-    mqttc = MQTTClient(mqtt_host, mqtt_user, mqtt_password)
+
+def _load_topology(rako_bridge_host):
+    from rakomqtt.discovery import DiscoveryCache
+    from rakomqtt.topology import load_topology
+
+    # the watcher only listens, so don't hold it up broadcasting for a bridge
+    host = rako_bridge_host or DiscoveryCache().load()
+    if not host:
+        _LOGGER.info("No rako bridge host known, room scenes won't be published per channel")
+        return None
+    return load_topology(host)
+
+
+def _connect_mqtt(mqtt_host, mqtt_user, mqtt_password, **mqtt_client_options):
+    mqttc = MQTTClient(mqtt_host, mqtt_user, mqtt_password, **mqtt_client_options)
     mqttc.connect()
     mqttc.mqttc.loop_start()
     return mqttc
 
 
-def _connect_udp_socket(rako_bridge_port):
+def _connect_udp_socket(rako_bridge_port, rcvbuf=None):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    _LOGGER.info(f"Listening on udp port: {rako_bridge_port}")
+    if rcvbuf:
+        # the kernel caps this at net.core.rmem_max
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    _LOGGER.info(
+        f"Listening on udp port: {rako_bridge_port} "
+        f"(receive buffer {s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes)"
+    )
     s.bind(("", rako_bridge_port))
+    s.setblocking(False)
     return s
 
 
-def _listen(udp_sock, mqtt_client):
+def _listen(
+    udp_sock,
+    mqtt_client,
+    batch_size=DEFAULT_UDP_BATCH_SIZE,
+    state_store=None,
+    topology=None,
+    demultiplexer=None,
+    recorder=None,
+    scene_map=None,
+):
+    decoder = RakoStatusDecoder(topology=topology, scene_map=scene_map)
+    receiver = BatchReceiver(udp_sock, batch_size)
+    state_store = state_store if state_store is not None else StateStore()
     while True:
-        resp = udp_sock.recvfrom(256)
-        if resp:
-            byte_list = list(resp[0])
-            processed_bytes = RakoBridge.process_udp_bytes(byte_list)
-            if not processed_bytes:
-                continue
-            topic, mqtt_payload = processed_bytes
-            mqtt_client.publish(topic, json.dumps(mqtt_payload))
+        batch = receiver.receive()
+        received_at = time.monotonic()
+        if recorder:
+            for frame, address in zip(batch, receiver.addresses):
+                recorder.record_status(frame, address, received_at)
+        if demultiplexer:
+            _process_demultiplexed_batch(batch, receiver.addresses, demultiplexer, state_store, mqtt_client, received_at)
+        else:
+            _process_batch(batch, decoder, state_store, mqtt_client, received_at)
+
+
+def _process_batch(batch, decoder, state_store, mqtt_client, received_at=None):
+    FRAMES_RECEIVED.inc(len(batch))
+    for frame in batch:
+        process_frame(frame, decoder, state_store, mqtt_client, received_at)
+
+
+def _process_demultiplexed_batch(batch, addresses, demultiplexer, state_store, mqtt_client, received_at=None):
+    FRAMES_RECEIVED.inc(len(batch))
+    for frame, address in zip(batch, addresses):
+        decoder = demultiplexer.decoder(address)
+        if decoder is None:
+            FRAMES_REJECTED.inc()
+            continue
+        process_frame(frame, decoder, state_store, mqtt_client, received_at)
+
+
+def process_frame(frame, decoder, state_store, mqtt_client, received_at=None):
+    states = decoder.decode_states(frame)
+    if not states:
+        FRAMES_REJECTED.inc()
+        return
+    FRAMES_DECODED.inc()
+    published = False
+    for topic, mqtt_payload in states:
+        published |= publish_state(mqtt_client, state_store, topic, mqtt_payload)
+    if published and received_at is not None:
+        UDP_TO_PUBLISH_SECONDS.observe(time.monotonic() - received_at)
+
+
+def publish_state(mqtt_client, state_store, topic, mqtt_payload):
+    """Publish the state retained, but only if it has changed. The bridge
+    repeats frames and there's no need to wake home assistant for each one.
+
+    :return True if the state was published
+    """
+    if not state_store.update(topic, mqtt_payload):
+        FRAMES_SUPPRESSED.inc()
+        return False
+    mqtt_client.publish(topic, mqtt_payload, retain=True)
+    FRAMES_PUBLISHED.inc()
+    return True
+
+
+class BatchReceiver:
+    """Waits for the udp socket to become readable then drains every pending
+    datagram into preallocated buffers, so a burst of status frames (e.g. a
+    house wide 'all off') is read in one wakeup rather than left to overflow
+    the kernel receive buffer.
+    """
+
+    def __init__(self, udp_sock, batch_size=DEFAULT_UDP_BATCH_SIZE):
+        self._sock = udp_sock
+        self._buffers = [bytearray(MAX_DATAGRAM_SIZE) for _ in range(batch_size)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        # the source address of each frame in the last batch
+        self.addresses = []
+        self.frames = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.kernel_drops = udp_drops(udp_sock)
+        self._next_drop_check = time.monotonic() + DROP_CHECK_INTERVAL
+
+    def receive(self, timeout=None):
+        """Block until datagrams arrive (or timeout) and return them all.
+
+        The returned memoryviews are only valid until the next call.
+        """
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        batch = self.drain() if readable else []
+        self._check_drops()
+        return batch
+
+    def drain(self):
+        batch = []
+        addresses = self.addresses = []
+        for view in self._views:
+            try:
+                nbytes, address = self._sock.recvfrom_into(view)
+            except BlockingIOError:
+                break
+            batch.append(view[:nbytes])
+            addresses.append(address)
+
+        if batch:
+            self.frames += len(batch)
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch))
+        return batch
+
+    def _check_drops(self):
+        now = time.monotonic()
+        if now < self._next_drop_check:
+            return
+        self._next_drop_check = now + DROP_CHECK_INTERVAL
+
+        drops = udp_drops(self._sock)
+        if drops is not None and self.kernel_drops is not None and drops > self.kernel_drops:
+            _LOGGER.warning(
+                f"Kernel dropped {drops - self.kernel_drops} udp status frames. "
+                f"Consider a larger --udp-rcvbuf (received {self.frames} frames in {self.batches} batches, "
+                f"largest batch {self.largest_batch})"
+            )
+        self.kernel_drops = drops
+
+
+def udp_drops(sock, proc_files=('/proc/net/udp', '/proc/net/udp6')):
+    """Number of datagrams the kernel dropped for this socket, read from the
+    `drops` column of /proc/net/udp. None where that isn't available.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for proc_file in proc_files:
+        try:
+            with open(proc_file) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+        except (OSError, StopIteration, IndexError, ValueError):
+            continue
+    return None
@@ -1,6 +1,6 @@
 #!/bin/bash
 set -e
-RAKO_BRIDGE_IP=`python -m rakomqtt.RakoBridge`
+RAKO_BRIDGE_IP=`python -m rakomqtt.discovery`
 set +e
 
 set -m
@@ -0,0 +1,109 @@
+import json
+import unittest
+
+from rakomqtt.bridges import Bridge, Bridges, BridgeSpec, StatusDemultiplexer, parse_bridge_spec, status_demultiplexer
+from rakomqtt.RakoBridge import CommandTopicRouter, RakoBridge, RakoCommand, RakoStatusDecoder
+from rakomqtt.simulator import status_frame
+from rakomqtt.state import StateStore
+from rakomqtt.watcher import _process_demultiplexed_batch
+
+
+class _StubMQTTClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+class TestBridges(unittest.TestCase):
+    """
+    Testing several bridges are kept apart by topic prefix and source address
+    """
+
+    def setUp(self):
+        self.bridges = Bridges([
+            Bridge(BridgeSpec('127.0.0.1', 'rako/house'), RakoBridge('127.0.0.1')),
+            Bridge(BridgeSpec('127.0.0.2', 'rako/garage'), RakoBridge('127.0.0.2')),
+        ])
+
+    parse_bridge_spec_cases = [
+        # name, in, expected
+        ("host", '192.168.1.20', BridgeSpec('192.168.1.20', 'rako')),
+        ("prefix", 'rako/garage=192.168.1.20', BridgeSpec('192.168.1.20', 'rako/garage')),
+        ("trailing slash", 'garage/=bridge.local', BridgeSpec('bridge.local', 'garage')),
+    ]
+
+    def test_parse_bridge_spec(self):
+        for test_name, in_value, expected in self.parse_bridge_spec_cases:
+            with self.subTest(test_name):
+                self.assertEqual(parse_bridge_spec(in_value), expected)
+
+    def test_parse_bridge_spec_invalid(self):
+        for in_value in ('rako=', 'rako/room/x=192.168.1.20', 'rako/+=192.168.1.20'):
+            with self.subTest(in_value):
+                self.assertRaises(ValueError, parse_bridge_spec, in_value)
+
+    def test_prefixes_must_differ(self):
+        self.assertRaises(ValueError, Bridges, [
+            Bridge(BridgeSpec('127.0.0.1'), RakoBridge('127.0.0.1')),
+            Bridge(BridgeSpec('127.0.0.2'), RakoBridge('127.0.0.2')),
+        ])
+
+    def test_subscriptions(self):
+        self.assertEqual(self.bridges.subscriptions(), [
+            ('rako/house/room/+/set', 1),
+            ('rako/house/room/+/channel/+/set', 1),
+            ('rako/garage/room/+/set', 1),
+            ('rako/garage/room/+/channel/+/set', 1),
+        ])
+
+    def test_command_routing(self):
+        payload = json.dumps({"state": "ON", "brightness": 255})
+        garage = self.bridges.for_topic('rako/garage/room/5/channel/1/set')
+        self.assertEqual(garage.topic_prefix, 'rako/garage')
+        self.assertEqual(
+            RakoCommand.from_mqtt('rako/garage/room/5/channel/1/set', payload, router=garage.router),
+            RakoCommand(5, 1, None, 255),
+        )
+        self.assertIsNone(RakoCommand.from_mqtt('rako/house/room/5/set', payload, router=garage.router))
+        self.assertIsNone(self.bridges.for_topic('rako/room/5/set'))
+
+    def test_multi_level_prefix_router(self):
+        router = CommandTopicRouter('site/rako/garage')
+        self.assertEqual(router.route('site/rako/garage/room/5/set'), (5, None))
+        self.assertEqual(router.route('site/rako/garage/room/5/channel/2/set'), (5, 2))
+        self.assertIsNone(router.route('site/rako/house/room/5/set'))
+        self.assertIsNone(router.route('site/rako'))
+
+    def test_demultiplex_status(self):
+        mqtt_client = _StubMQTTClient()
+        frame = status_frame(5, 1, 52, 1, 255)
+        addresses = [('127.0.0.1', 9761), ('127.0.0.2', 9761), ('127.0.0.3', 9761)]
+        _process_demultiplexed_batch(
+            [frame, frame, frame], addresses, self.bridges.status_demultiplexer(), StateStore(), mqtt_client
+        )
+        self.assertEqual([topic for topic, _ in mqtt_client.published], [
+            'rako/house/room/5/channel/1',
+            'rako/garage/room/5/channel/1',
+        ])
+
+    def test_host_and_port(self):
+        # e.g. the simulator, --rako-bridge-host 127.0.0.1:8080
+        bridges = Bridges([
+            Bridge(BridgeSpec('127.0.0.1:8080', 'rako/house'), RakoBridge('127.0.0.1:8080')),
+            Bridge(BridgeSpec('127.0.0.2:8081', 'rako/garage'), RakoBridge('127.0.0.2:8081')),
+        ])
+        self.assertEqual(bridges.for_address(('127.0.0.2', 9761)).topic_prefix, 'rako/garage')
+        self.assertIsNotNone(bridges.status_demultiplexer().decoder(('127.0.0.1', 9761)))
+        demultiplexer = status_demultiplexer([BridgeSpec('127.0.0.1:8080', 'rako/house')], use_topology=False)
+        self.assertIsNotNone(demultiplexer.decoder(('127.0.0.1', 9761)))
+
+    def test_single_bridge_takes_every_frame(self):
+        decoder = RakoStatusDecoder()
+        demultiplexer = StatusDemultiplexer({'127.0.0.1': decoder})
+        self.assertIs(demultiplexer.decoder(('192.168.1.20', 9761)), decoder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+import asyncio
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+from rakomqtt.command_queue import AsyncCommandQueue, CommandCompactor, CommandQueue, RoomScheduler
+from rakomqtt.metrics import ROOM_QUEUE_WAIT
+from rakomqtt.RakoBridge import RakoCommand
+from rakomqtt.topology import Channel, Room, Topology
+
+
+class TestCommandQueue(unittest.TestCase):
+    """
+    Testing commands are coalesced per (room, channel) and paced
+    """
+
+    def test_latest_command_wins(self):
+        sent = []
+        first_sent = threading.Event()
+        release = threading.Event()
+
+        def send(rako_command):
+            sent.append(rako_command)
+            first_sent.set()
+            release.wait(1)
+
+        queue = CommandQueue(send, rate=0)
+        queue.start()
+        queue.put(RakoCommand(5, 1, None, 10))
+        self.assertTrue(first_sent.wait(1))
+
+        # the worker is busy with the first command, so these pile up
+        for brightness in (20, 30, 40):
+            queue.put(RakoCommand(5, 1, None, brightness))
+        queue.put(RakoCommand(6, 0, 2, None))
+        queue.put(RakoCommand(5, 1, None, 50))
+        release.set()
+
+        deadline = time.monotonic() + 1
+        while len(sent) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        queue.stop()
+
+        self.assertEqual(sent, [
+            RakoCommand(5, 1, None, 10),
+            RakoCommand(6, 0, 2, None),
+            RakoCommand(5, 1, None, 50),
+        ])
+        self.assertEqual(queue.superseded, 3)
+
+    def test_sends_are_paced(self):
+        sent_at = []
+        done = threading.Event()
+
+        def send(rako_command):
+            sent_at.append(time.monotonic())
+            if len(sent_at) == 3:
+                done.set()
+
+        queue = CommandQueue(send, rate=20)
+        for room in (1, 2, 3):
+            queue.put(RakoCommand(room, 0, 1, None))
+        queue.start()
+        self.assertTrue(done.wait(1))
+        queue.stop()
+
+        self.assertGreaterEqual(sent_at[2] - sent_at[0], 0.09)
+
+    def test_async_latest_command_wins(self):
+        sent = []
+
+        async def send(rako_command):
+            sent.append(rako_command)
+
+        async def run_queue():
+            queue = AsyncCommandQueue(send, rate=0)
+            for brightness in (10, 20, 30):
+                queue.put(RakoCommand(5, 1, None, brightness))
+            queue.put(RakoCommand(6, 0, 2, None))
+            worker = asyncio.ensure_future(queue.run())
+            await asyncio.sleep(0.05)
+            worker.cancel()
+            return queue
+
+        queue = asyncio.run(run_queue())
+        self.assertEqual(sent, [RakoCommand(6, 0, 2, None), RakoCommand(5, 1, None, 30)])
+        self.assertEqual(queue.superseded, 2)
+
+
+class TestRoomScheduler(unittest.TestCase):
+    """
+    Testing rooms take turns and room scenes go first
+    """
+
+    def _drain(self, scheduler, commands):
+        pending = OrderedDict(((c.room, c.channel), c) for c in commands)
+        order = []
+        while pending:
+            order.append(pending.pop(scheduler.pick(pending)))
+        return order
+
+    def test_rooms_take_turns(self):
+        busy_room = [RakoCommand(5, channel, None, 10) for channel in range(1, 7)]
+        order = self._drain(RoomScheduler(), busy_room + [RakoCommand(6, 1, None, 10), RakoCommand(7, 2, None, 10)])
+        self.assertEqual([(c.room, c.channel) for c in order[:4]], [(5, 1), (6, 1), (7, 2), (5, 2)])
+
+    def test_scenes_first(self):
+        order = self._drain(RoomScheduler(), [
+            RakoCommand(5, 1, None, 10), RakoCommand(6, 1, None, 10), RakoCommand(7, 0, 1, None), RakoCommand(8, 0, 0, None)
+        ])
+        self.assertEqual([c.room for c in order], [7, 8, 5, 6])
+
+    def test_scenes_take_turns(self):
+        scheduler = RoomScheduler()
+        self.assertEqual(scheduler.pick({(7, 0): RakoCommand(7, 0, 1, None), (5, 1): RakoCommand(5, 1, None, 10)}), (7, 0))
+        pending = OrderedDict([((7, 0), RakoCommand(7, 0, 2, None)), ((8, 0), RakoCommand(8, 0, 1, None))])
+        self.assertEqual(scheduler.pick(pending), (8, 0))
+
+    def test_levels_take_turns_after_scenes(self):
+        order = self._drain(RoomScheduler(), [
+            RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10), RakoCommand(6, 1, None, 10), RakoCommand(7, 0, 1, None)
+        ])
+        self.assertEqual([(c.room, c.channel) for c in order], [(7, 0), (5, 1), (6, 1), (5, 2)])
+
+    def test_in_order_when_not_busy(self):
+        scheduler = RoomScheduler()
+        self._drain(scheduler, [RakoCommand(5, 1, None, 10)])
+        order = self._drain(scheduler, [RakoCommand(5, 2, None, 10), RakoCommand(6, 1, None, 10)])
+        self.assertEqual([c.room for c in order], [5, 6])
+
+    def test_scene_drops_earlier_levels(self):
+        queue = CommandQueue(lambda rako_command: None, rate=0)
+        for rako_command in (RakoCommand(5, 1, None, 10), RakoCommand(6, 1, None, 10), RakoCommand(5, 0, 2, None),
+                             RakoCommand(5, 2, None, 10)):
+            queue.put(rako_command)
+        order = []
+        while queue.depth:
+            order.append(queue._take())
+        self.assertEqual(order, [RakoCommand(5, 0, 2, None), RakoCommand(6, 1, None, 10), RakoCommand(5, 2, None, 10)])
+        self.assertEqual((queue.depth, queue.superseded), (0, 1))
+
+    def test_queue_wait_by_room(self):
+        waits = ROOM_QUEUE_WAIT.labels(99)
+        count = waits.count
+        queue = CommandQueue(lambda rako_command: None, rate=0)
+        queue.put(RakoCommand(99, 1, None, 10))
+        queue.put(RakoCommand(99, 1, None, 20))
+        queue._take()
+        self.assertEqual(waits.count, count + 1)
+
+
+class TestCommandCompactor(unittest.TestCase):
+    """
+    Testing bursts of channel commands are compacted into room commands
+    """
+
+    def setUp(self):
+        self.compactor = CommandCompactor(Topology({
+            5: Room(5, channels={1: Channel(1), 2: Channel(2), 3: Channel(3)}),
+            6: Room(6, channels={1: Channel(1)}),
+        }))
+
+    compact_cases = [
+        # name, in, expected
+        ("room level", [RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10), RakoCommand(5, 3, None, 10)],
+         [RakoCommand(5, 0, None, 10)]),
+        ("room scene", [RakoCommand(5, 1, None, 192), RakoCommand(5, 2, None, 192), RakoCommand(5, 3, None, 192)],
+         [RakoCommand(5, 0, 2, None)]),
+        ("room off", [RakoCommand(5, 1, None, 0), RakoCommand(5, 2, None, 0), RakoCommand(5, 3, None, 0)],
+         [RakoCommand(5, 0, 0, None)]),
+        ("keeps position", [RakoCommand(7, 0, 1, None), RakoCommand(5, 1, None, 10), RakoCommand(6, 1, None, 10),
+                            RakoCommand(5, 2, None, 10), RakoCommand(5, 3, None, 10)],
+         [RakoCommand(7, 0, 1, None), RakoCommand(5, 0, None, 10), RakoCommand(6, 1, None, 10)]),
+        ("replaces room command", [RakoCommand(5, 0, 1, None), RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10),
+                                   RakoCommand(5, 3, None, 10)],
+         [RakoCommand(5, 0, None, 10)]),
+        ("superseded by room command", [RakoCommand(5, 1, None, 40), RakoCommand(5, 2, None, 40),
+                                        RakoCommand(5, 3, None, 40), RakoCommand(5, 0, 0, None)],
+         [RakoCommand(5, 0, 0, None)]),
+        ("partly superseded", [RakoCommand(5, 1, None, 40), RakoCommand(5, 0, 0, None), RakoCommand(5, 2, None, 40),
+                               RakoCommand(5, 3, None, 40)],
+         [RakoCommand(5, 0, 0, None), RakoCommand(5, 2, None, 40), RakoCommand(5, 3, None, 40)]),
+        ("missing channel", [RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10)],
+         [RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10)]),
+        ("different levels", [RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10), RakoCommand(5, 3, None, 11)],
+         [RakoCommand(5, 1, None, 10), RakoCommand(5, 2, None, 10), RakoCommand(5, 3, None, 11)]),
+        ("single channel room", [RakoCommand(6, 1, None, 10)], [RakoCommand(6, 1, None, 10)]),
+        ("unknown room", [RakoCommand(8, 1, None, 10)], [RakoCommand(8, 1, None, 10)]),
+    ]
+
+    def test_compact(self):
+        for test_name, in_commands, expected in self.compact_cases:
+            with self.subTest(test_name):
+                pending = OrderedDict(((c.room, c.channel), c) for c in in_commands)
+                self.compactor.compact(pending)
+                self.assertEqual(list(pending.values()), expected)
+                self.assertEqual(list(pending), [(c.room, c.channel) for c in expected])
+
+    def test_replaced_command_goes_behind_room_command(self):
+        for test_name, compactor in (("compacted", self.compactor), ("not compacted", None)):
+            with self.subTest(test_name):
+                queue = CommandQueue(lambda rako_command: None, rate=0, compactor=compactor)
+                for rako_command in (RakoCommand(5, 1, None, 10), RakoCommand(5, 0, 0, None), RakoCommand(5, 1, None, 200)):
+                    queue.put(rako_command)
+                self.assertEqual([queue._take(), queue._take()], [RakoCommand(5, 0, 0, None), RakoCommand(5, 1, None, 200)])
+
+    def test_queue_holds_burst_for_compaction(self):
+        sent = []
+        done = threading.Event()
+
+        def send(rako_command):
+            sent.append(rako_command)
+            done.set()
+
+        queue = CommandQueue(send, rate=0, compactor=self.compactor, compaction_window=0.05)
+        queue.start()
+        for channel in (1, 2, 3):
+            queue.put(RakoCommand(5, channel, None, 255))
+        self.assertTrue(done.wait(1))
+        time.sleep(0.05)
+        queue.stop()
+
+        self.assertEqual(sent, [RakoCommand(5, 0, 1, None)])
+        self.assertEqual(self.compactor.compacted, 2)
@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+
+from rakomqtt.command_queue import CommandQueue
+from rakomqtt.confirmation import CommandConfirmations
+from rakomqtt.RakoBridge import RakoCommand
+from rakomqtt.simulator import status_frame
+
+
+class TestCommandConfirmations(unittest.TestCase):
+    """
+    Testing status frames confirm commands and unconfirmed ones are retried
+    """
+
+    def setUp(self):
+        self.confirmations = CommandConfirmations(timeout=1, retries=2)
+
+    matches_cases = [
+        # name, command, frame, expected
+        ("level", RakoCommand(5, 1, None, 100), status_frame(5, 1, 52, 1, 100), True),
+        ("other level", RakoCommand(5, 1, None, 100), status_frame(5, 1, 52, 1, 99), False),
+        ("scene", RakoCommand(5, 0, 2, None), status_frame(5, 0, 49, 0, 2), True),
+        ("legacy scene", RakoCommand(5, 0, 2, None), status_frame(5, 0, 4), True),
+        ("other scene", RakoCommand(5, 0, 2, None), status_frame(5, 0, 49, 0, 1), False),
+        ("scene brightness isn't a level", RakoCommand(5, 0, None, 192), status_frame(5, 0, 49, 0, 2), False),
+        ("off by level", RakoCommand(5, 0, 0, None), status_frame(5, 0, 52, 1, 0), True),
+        ("level 0 by off", RakoCommand(5, 1, None, 0), status_frame(5, 1, 0), True),
+        ("other channel", RakoCommand(5, 1, None, 100), status_frame(5, 2, 52, 1, 100), False),
+        ("other room", RakoCommand(5, 1, None, 100), status_frame(6, 1, 52, 1, 100), False),
+        ("bad checksum", RakoCommand(5, 1, None, 100), status_frame(5, 1, 52, 1, 100)[:-1] + b'\x00', False),
+    ]
+
+    def test_observe(self):
+        for test_name, rako_command, frame, expected in self.matches_cases:
+            with self.subTest(test_name):
+                confirmations = CommandConfirmations()
+                confirmations.sent(rako_command, now=10)
+                self.assertEqual(confirmations.observe(frame, now=10.2), expected)
+                self.assertEqual(len(confirmations), 0 if expected else 1)
+
+    def test_retry_with_backoff(self):
+        rako_command = RakoCommand(5, 1, None, 100)
+        self.confirmations.sent(rako_command, now=10)
+        self.assertEqual(self.confirmations.next_deadline(), 11)
+        self.assertEqual(self.confirmations.expired(now=10.9), [])
+        self.assertEqual(self.confirmations.expired(now=11), [rako_command])
+        # waiting for the queue to send it again
+        self.assertIsNone(self.confirmations.next_deadline())
+
+        self.confirmations.sent(rako_command, now=11.1)
+        self.assertEqual(self.confirmations.next_deadline(), 13.1)
+        self.assertEqual(self.confirmations.expired(now=13.1), [rako_command])
+        self.confirmations.sent(rako_command, now=13.2)
+        self.assertEqual(self.confirmations.next_deadline(), 17.2)
+
+        self.assertEqual(self.confirmations.expired(now=17.2), [])
+        self.assertEqual((self.confirmations.retried, self.confirmations.unconfirmed, len(self.confirmations)), (2, 1, 0))
+
+    def test_newer_command_replaces(self):
+        self.confirmations.sent(RakoCommand(5, 1, None, 100), now=10)
+        self.confirmations.sent(RakoCommand(5, 1, None, 50), now=10.5)
+        self.assertFalse(self.confirmations.observe(status_frame(5, 1, 52, 1, 100)))
+        self.assertEqual(self.confirmations.next_deadline(), 11.5)
+
+    def test_room_command_replaces_channels(self):
+        self.confirmations.sent(RakoCommand(5, 1, None, 200), now=10)
+        self.confirmations.sent(RakoCommand(6, 1, None, 200), now=10)
+        self.confirmations.sent(RakoCommand(5, 0, 0, None), now=10.5)
+        self.assertTrue(self.confirmations.observe(status_frame(5, 0, 49, 0, 0), now=10.6))
+        self.assertEqual(self.confirmations.expired(now=12), [RakoCommand(6, 1, None, 200)])
+        self.assertEqual(len(self.confirmations), 1)
+
+    def test_forget(self):
+        self.confirmations.sent(RakoCommand(5, 1, None, 100), now=10)
+        self.confirmations.forget(RakoCommand(5, 1, None, 50))
+        self.assertEqual(len(self.confirmations), 1)
+        self.confirmations.forget(RakoCommand(5, 1, None, 100))
+        self.assertEqual(len(self.confirmations), 0)
+
+    def test_queue_skips_overtaken_retries(self):
+        retry_cases = [
+            # name, unconfirmed command, pending command, expected retried
+            ("same channel", RakoCommand(5, 1, None, 100), RakoCommand(5, 1, None, 50), False),
+            ("room command", RakoCommand(5, 1, None, 100), RakoCommand(5, 0, 0, None), False),
+            ("channel after room", RakoCommand(5, 0, 2, None), RakoCommand(5, 1, None, 50), False),
+            ("other channel", RakoCommand(5, 1, None, 100), RakoCommand(5, 2, None, 50), True),
+            ("other room", RakoCommand(5, 0, 2, None), RakoCommand(6, 0, 0, None), True),
+        ]
+        for test_name, unconfirmed, pending, expected in retry_cases:
+            with self.subTest(test_name):
+                confirmations = CommandConfirmations(timeout=1, retries=1)
+                queue = CommandQueue(lambda rako_command: None, rate=0, confirmations=confirmations)
+                confirmations.sent(unconfirmed, now=time.monotonic() - 2)
+                queue.put(pending)
+                queue._requeue_unconfirmed()
+                self.assertEqual(unconfirmed in queue._pending.values(), expected)
+                self.assertEqual(len(confirmations), 1 if expected else 0)
+
+    def test_queue_resends_unconfirmed(self):
+        sent = []
+        resent = threading.Event()
+
+        def send(rako_command):
+            sent.append(rako_command)
+            if len(sent) == 2:
+                resent.set()
+
+        queue = CommandQueue(send, rate=0, confirmations=CommandConfirmations(timeout=0.05, retries=1))
+        queue.start()
+        queue.put(RakoCommand(5, 1, None, 100))
+        self.assertTrue(resent.wait(1))
+        time.sleep(0.15)
+        queue.stop()
+        self.assertEqual(sent, [RakoCommand(5, 1, None, 100)] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
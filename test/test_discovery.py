@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from rakomqtt.discovery import DiscoveryCache, find_bridge_host, verify_in_background
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    """
+    Testing the discovered bridge is cached between restarts
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'rakomqtt', 'bridge.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        cache = DiscoveryCache(self.path)
+        self.assertIsNone(cache.load())
+        cache.save('192.168.0.10')
+        self.assertEqual(cache.load(), '192.168.0.10')
+
+    def test_expired(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump(dict(host='192.168.0.10', discovered_at=time.time() - 100), f)
+        self.assertIsNone(DiscoveryCache(self.path, ttl=10).load())
+        self.assertEqual(DiscoveryCache(self.path, ttl=1000).load(), '192.168.0.10')
+
+    def test_disabled(self):
+        cache = DiscoveryCache('')
+        cache.save('192.168.0.10')
+        self.assertIsNone(cache.load())
+
+    def test_find_bridge_host_uses_cache(self):
+        cache = DiscoveryCache(self.path)
+        with mock.patch('rakomqtt.RakoBridge.RakoBridge.find_bridge', return_value='192.168.0.10') as find_bridge:
+            self.assertEqual(find_bridge_host(cache), '192.168.0.10')
+            self.assertEqual(find_bridge_host(cache), '192.168.0.10')
+        self.assertEqual(find_bridge.call_count, 1)
+
+    def test_verify_only_cached_host(self):
+        cache = DiscoveryCache(self.path)
+        cache.save('192.168.0.10')
+        self.assertIsNone(verify_in_background(mock.Mock(host='192.168.0.99'), cache))
+
+    def test_verified_host_is_cached_again(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump(dict(host='192.168.0.10', discovered_at=time.time() - 100), f)
+        cache = DiscoveryCache(self.path, ttl=150)
+        with mock.patch('rakomqtt.discovery.bridge_answers', return_value=True):
+            verify_in_background(mock.Mock(host='192.168.0.10'), cache).join(1)
+
+        self.assertEqual(DiscoveryCache(self.path, ttl=50).load(), '192.168.0.10')
+
+    def test_rediscover_when_cached_host_is_gone(self):
+        cache = DiscoveryCache(self.path)
+        cache.save('192.168.0.10')
+        rako_bridge = mock.Mock(host='192.168.0.10')
+        with mock.patch('rakomqtt.discovery.bridge_answers', return_value=False), \
+                mock.patch('rakomqtt.RakoBridge.RakoBridge.discover', return_value='192.168.0.11'):
+            verify_in_background(rako_bridge, cache).join(1)
+
+        rako_bridge.set_host.assert_called_once_with('192.168.0.11')
+        self.assertEqual(cache.load(), '192.168.0.11')
@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from rakomqtt.bridges import Bridge, Bridges, BridgeSpec
+from rakomqtt.command_queue import AsyncCommandQueue, CommandQueue, RoomScheduler
+from rakomqtt.commander import create_command_queues
+from rakomqtt.dispatch import AIMDLimit, CommandDispatcher, Throughput
+from rakomqtt.RakoBridge import RakoBridge, RakoCommand
+
+
+class TestAIMDLimit(unittest.TestCase):
+    """
+    Testing the concurrency limit grows while the bridge keeps up and halves when it doesn't
+    """
+
+    def setUp(self):
+        self.limit = AIMDLimit(8)
+
+    def grow(self, commands):
+        for _ in range(commands):
+            self.limit.succeeded(0.1, started=0, in_flight=self.limit.current)
+
+    def test_additive_increase(self):
+        self.assertEqual(self.limit.current, 1)
+        self.grow(1)
+        self.assertEqual(self.limit.current, 2)
+        self.grow(3)
+        self.assertEqual(self.limit.current, 3)
+        self.grow(100)
+        self.assertEqual(self.limit.current, 8)
+
+    def test_no_increase_unless_saturated(self):
+        self.grow(4)
+        for _ in range(10):
+            self.limit.succeeded(0.1, started=0, in_flight=1)
+        self.assertEqual(self.limit.current, 3)
+
+    def test_multiplicative_decrease(self):
+        decrease_cases = [
+            # name, signal, expected limit
+            ("failed", lambda limit: limit.failed(started=10, now=11), 4),
+            ("slow", lambda limit: limit.succeeded(0.5, started=10, in_flight=8), 4),
+            ("a little slower", lambda limit: limit.succeeded(0.2, started=10, in_flight=8), 8),
+            ("congested", lambda limit: limit.congested(now=11), 4),
+        ]
+        for test_name, signal, expected in decrease_cases:
+            with self.subTest(test_name):
+                self.limit = AIMDLimit(8)
+                self.grow(100)
+                signal(self.limit)
+                self.assertEqual(self.limit.current, expected)
+
+    def test_decreases_once_per_window(self):
+        self.grow(100)
+        self.limit.failed(started=10, now=11)
+        # already in flight when the limit was cut
+        self.limit.failed(started=10.5, now=11.5)
+        self.assertEqual(self.limit.current, 4)
+        self.limit.failed(started=12, now=13)
+        self.assertEqual(self.limit.current, 2)
+        self.limit.failed(started=14, now=15)
+        self.limit.failed(started=16, now=17)
+        self.assertEqual(self.limit.current, 1)
+
+    def test_invalid_limits(self):
+        for args in ((0,), (2, 3), (4, 1, 1), (4, 1, 0)):
+            with self.subTest(args):
+                self.assertRaises(ValueError, AIMDLimit, *args)
+
+
+class TestCommandDispatcher(unittest.TestCase):
+    """
+    Testing commands are sent several at once, never two for one room
+    """
+
+    def test_throughput(self):
+        throughput = Throughput(window=10)
+        for now in (1, 2, 11, 12):
+            throughput.add(now)
+        self.assertEqual(throughput.rate(now=12), 0.2)
+        self.assertEqual(throughput.rate(now=30), 0)
+
+    def test_tracks_in_flight(self):
+        dispatcher = CommandDispatcher(4, limit=AIMDLimit(4, min_limit=2))
+        started = dispatcher.started(RakoCommand(5, 1, None, 100))
+        dispatcher.started(RakoCommand(6, 1, None, 100))
+        self.assertEqual((dispatcher.in_flight, dispatcher.busy_rooms, dispatcher.can_send()), (2, {5, 6}, False))
+        dispatcher.finished(RakoCommand(5, 1, None, 100), started, ok=True, now=started + 0.1)
+        self.assertEqual((dispatcher.in_flight, dispatcher.busy_rooms), (1, {6}))
+        self.assertEqual(dispatcher.limit.current, 2)
+
+    def test_scheduler_passes_over_busy_rooms(self):
+        scheduler = RoomScheduler()
+        pending = {(5, 0): RakoCommand(5, 0, 1, None), (6, 1): RakoCommand(6, 1, None, 10)}
+        self.assertEqual(scheduler.pick(pending, busy_rooms={5}), (6, 1))
+        self.assertIsNone(scheduler.pick(pending, busy_rooms={5, 6}))
+
+    def test_queue_sends_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=1)
+        sent = []
+        done = threading.Event()
+
+        def send(rako_command):
+            sent.append(rako_command)
+            if rako_command.room != 7:
+                # only returns once both rooms' commands are in flight
+                barrier.wait()
+            if len(sent) == 3:
+                done.set()
+            return True
+
+        dispatcher = CommandDispatcher(4, limit=AIMDLimit(4, min_limit=2))
+        queue = CommandQueue(send, rate=0, dispatcher=dispatcher)
+        for room in (5, 6, 7):
+            queue.put(RakoCommand(room, 1, None, 100))
+        queue.start()
+        self.assertTrue(done.wait(1))
+        queue.stop()
+        self.assertEqual([c.room for c in sent], [5, 6, 7])
+        self.assertEqual(dispatcher.in_flight, 0)
+
+    def test_queue_sends_a_room_in_order(self):
+        in_flight = []
+        most_in_flight = []
+        done = threading.Event()
+
+        def send(rako_command):
+            in_flight.append(rako_command)
+            most_in_flight.append(len(in_flight))
+            time.sleep(0.02)
+            in_flight.remove(rako_command)
+            if len(most_in_flight) == 3:
+                done.set()
+            return True
+
+        queue = CommandQueue(send, rate=0, dispatcher=CommandDispatcher(4, limit=AIMDLimit(4, min_limit=4)))
+        for channel in (1, 2, 3):
+            queue.put(RakoCommand(5, channel, None, 100))
+        queue.start()
+        self.assertTrue(done.wait(1))
+        queue.stop()
+        self.assertEqual(most_in_flight, [1, 1, 1])
+
+    def test_async_queue_sends_in_parallel(self):
+        async def run_queue():
+            both_in_flight = asyncio.Event()
+            sent = []
+
+            async def send(rako_command):
+                sent.append(rako_command)
+                if len(sent) == 2:
+                    both_in_flight.set()
+                await asyncio.wait_for(both_in_flight.wait(), 1)
+                return rako_command.room != 6
+
+            dispatcher = CommandDispatcher(4, limit=AIMDLimit(4, min_limit=2))
+            queue = AsyncCommandQueue(send, rate=0, dispatcher=dispatcher)
+            queue.put(RakoCommand(5, 1, None, 100))
+            queue.put(RakoCommand(6, 1, None, 100))
+            worker = asyncio.ensure_future(queue.run())
+            await asyncio.sleep(0.05)
+            worker.cancel()
+            return sent, dispatcher
+
+        sent, dispatcher = asyncio.run(run_queue())
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(dispatcher.in_flight, 0)
+        # room 6's command failed
+        self.assertEqual(dispatcher.limit.current, 2)
+
+    def test_create_command_queues(self):
+        queue_cases = [
+            # name, asynchronous, expected queue class
+            ("commander", False, CommandQueue),
+            ("combined", True, AsyncCommandQueue),
+        ]
+        for test_name, asynchronous, expected in queue_cases:
+            with self.subTest(test_name):
+                bridge = Bridge(BridgeSpec('127.0.0.1'), RakoBridge('127.0.0.1'))
+
+                async def create():
+                    create_command_queues(Bridges([bridge]), asynchronous, confirm_timeout=0, adaptive_concurrency=4)
+
+                asyncio.run(create())
+                self.assertIs(type(bridge.command_queue), expected)
+                self.assertIs(bridge.command_queue._dispatcher, bridge.dispatcher)
+                self.assertEqual(bridge.dispatcher.max_in_flight, 4)
+                self.assertIsNone(bridge.confirmations)
+                self.assertIsNotNone(bridge.states)
+
+    def test_adaptive_concurrency_isnt_rate_limited(self):
+        rate_cases = [
+            # name, command_rate, expected send interval
+            ("default", None, 0),
+            ("explicit rate", 5, 0.2),
+        ]
+        for test_name, command_rate, expected in rate_cases:
+            with self.subTest(test_name):
+                bridge = Bridge(BridgeSpec('127.0.0.1'), RakoBridge('127.0.0.1'))
+                create_command_queues(Bridges([bridge]), command_rate=command_rate, confirm_timeout=0, adaptive_concurrency=2)
+                self.assertEqual(bridge.command_queue._interval, expected)
+
+    def test_limit_bounds_throughput(self):
+        in_flight = []
+        most_in_flight = []
+        done = threading.Event()
+
+        def send(rako_command):
+            in_flight.append(rako_command)
+            most_in_flight.append(len(in_flight))
+            time.sleep(0.01)
+            in_flight.remove(rako_command)
+            if len(most_in_flight) == 20:
+                done.set()
+            return True
+
+        bridge = Bridge(BridgeSpec('127.0.0.1'), RakoBridge('127.0.0.1'))
+        bridge.rako_bridge.post_command = send
+        create_command_queues(Bridges([bridge]), confirm_timeout=0, skip_redundant=False, adaptive_concurrency=2)
+        for room in range(1, 21):
+            bridge.command_queue.put(RakoCommand(room, 1, None, 100))
+        started = time.monotonic()
+        bridge.command_queue.start()
+        # at the default 10 commands a second it'd take 2s
+        self.assertTrue(done.wait(1))
+        bridge.command_queue.stop()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertLessEqual(max(most_in_flight), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
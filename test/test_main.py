@@ -0,0 +1,23 @@
+import subprocess
+import sys
+import unittest
+
+
+class TestMain(unittest.TestCase):
+    """
+    Testing the command line only imports the mode it runs
+    """
+
+    def test_imports_only_selected_mode(self):
+        loaded = subprocess.run(
+            [sys.executable, '-c', (
+                "import sys, rakomqtt.__main__ as main; main.load_mode('replay'); "
+                "print(' '.join(sorted(m for m in sys.modules if m.startswith(('rakomqtt', 'paho')))))"
+            )],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout.split()
+        self.assertEqual(loaded, ['rakomqtt', 'rakomqtt.__main__', 'rakomqtt.const', 'rakomqtt.recorder'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from urllib.request import urlopen
+
+from rakomqtt.metrics import Registry, start_metrics_server
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Testing metrics render in the prometheus text format
+    """
+
+    def test_render(self):
+        registry = Registry()
+        frames = registry.counter('frames_total', 'Frames')
+        depth = registry.gauge('queue_depth', 'Depth')
+        latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        waits = registry.counter('room_waits_total', 'Waits', labelnames=('room',))
+
+        frames.inc()
+        frames.inc(2)
+        depth.set_function(lambda: 7)
+        for seconds in (0.05, 0.5, 5):
+            latency.observe(seconds)
+        waits.labels(5).inc()
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP frames_total Frames',
+            '# TYPE frames_total counter',
+            'frames_total 3',
+            '# HELP queue_depth Depth',
+            '# TYPE queue_depth gauge',
+            'queue_depth 7',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+            '# HELP room_waits_total Waits',
+            '# TYPE room_waits_total counter',
+            'room_waits_total{room="5"} 1',
+        ])
+
+    def test_metrics_server(self):
+        registry = Registry()
+        registry.counter('frames_total', 'Frames').inc()
+        httpd = start_metrics_server(0, '127.0.0.1', registry)
+        try:
+            with urlopen('http://127.0.0.1:{}/metrics'.format(httpd.server_address[1])) as response:
+                self.assertIn('frames_total 1', response.read().decode())
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
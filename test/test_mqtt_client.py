@@ -0,0 +1,160 @@
+import unittest
+
+import paho.mqtt.client as mqtt
+
+from rakomqtt.MQTTClient import MQTTClient, ReconnectPolicy
+
+
+class _StubPahoClient:
+    """Records publishes; on_publish is called by the test, like paho does
+    once a message has gone
+    """
+
+    def __init__(self, mqtt_client):
+        self.published = []
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self.reconnect_delays = []
+        self._on_publish = mqtt_client.mqttc.on_publish
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.published.append((topic, payload, qos, retain))
+        return self.rc, len(self.published)
+
+    def acknowledge(self):
+        self._on_publish(self, None, len(self.published))
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        self.reconnect_delays.append((min_delay, max_delay))
+
+
+class TestMQTTClientPublishing(unittest.TestCase):
+    """
+    Testing publishes are bounded, one pending message per topic
+    """
+
+    def _client(self, **kwargs):
+        mqtt_client = MQTTClient('localhost', 'user', 'pwd', **kwargs)
+        on_connect = mqtt_client.mqttc.on_connect
+        paho_client = _StubPahoClient(mqtt_client)
+        self.on_disconnect = mqtt_client.mqttc.on_disconnect
+        self.on_connect_fail = mqtt_client.mqttc.on_connect_fail
+        mqtt_client.mqttc = paho_client
+        return mqtt_client, paho_client, lambda: on_connect(paho_client, None, {}, 0)
+
+    def test_latest_state_sent_on_connect(self):
+        mqtt_client, paho_client, connect = self._client()
+        for payload in (b'1', b'2', b'3'):
+            mqtt_client.publish('rako/room/5', payload, retain=True)
+        mqtt_client.publish('rako/room/6', b'1', retain=True)
+        self.assertEqual(paho_client.published, [])
+
+        connect()
+        self.assertEqual(paho_client.published, [
+            ('rako/room/5', b'3', 0, True),
+            ('rako/room/6', b'1', 0, True),
+        ])
+        self.assertEqual((mqtt_client.superseded, mqtt_client.pending), (2, 0))
+
+    def test_inflight_limit(self):
+        mqtt_client, paho_client, connect = self._client(max_inflight=2, qos=1)
+        connect()
+        for room in range(1, 5):
+            mqtt_client.publish(f'rako/room/{room}', b'1')
+        self.assertEqual([topic for topic, *_ in paho_client.published], ['rako/room/1', 'rako/room/2'])
+        self.assertEqual(mqtt_client.pending, 2)
+
+        paho_client.acknowledge()
+        self.assertEqual(len(paho_client.published), 3)
+        self.assertEqual(paho_client.published[-1], ('rako/room/3', b'1', 1, False))
+
+    def test_oldest_dropped_beyond_max_pending(self):
+        mqtt_client, paho_client, connect = self._client(max_pending=2)
+        for room in range(1, 5):
+            mqtt_client.publish(f'rako/room/{room}', b'1')
+        connect()
+        self.assertEqual([topic for topic, *_ in paho_client.published], ['rako/room/3', 'rako/room/4'])
+        self.assertEqual(mqtt_client.dropped, 2)
+
+    def test_failed_publish_is_retried(self):
+        mqtt_client, paho_client, connect = self._client()
+        connect()
+        paho_client.rc = mqtt.MQTT_ERR_NO_CONN
+        mqtt_client.publish('rako/room/5', b'1')
+        mqtt_client.publish('rako/room/6', b'1')
+        self.assertEqual(mqtt_client.pending, 2)
+
+        paho_client.rc = mqtt.MQTT_ERR_SUCCESS
+        connect()
+        self.assertEqual([topic for topic, *_ in paho_client.published], ['rako/room/5', 'rako/room/6'])
+
+    def test_resync_on_reconnect(self):
+        states = {'rako/room/5': b'1', 'rako/room/6': b'2'}
+        mqtt_client, paho_client, connect = self._client(resync=lambda: dict(states))
+        connect()
+        self.assertEqual(len(paho_client.published), 2)
+
+        self.on_disconnect(paho_client, None, 1)
+        # changed while disconnected
+        states['rako/room/5'] = b'3'
+        mqtt_client.publish('rako/room/5', b'3', retain=True)
+        connect()
+        self.assertEqual(paho_client.published[2:], [
+            ('rako/room/5', b'3', 0, True),
+            ('rako/room/6', b'2', 0, True),
+        ])
+        self.assertEqual(mqtt_client.superseded, 0)
+
+    def test_reconnect_backoff(self):
+        mqtt_client, paho_client, connect = self._client(reconnect_min_delay=1, reconnect_max_delay=4)
+        mqtt_client.reconnect_policy = ReconnectPolicy(1, 4, rng=lambda: 1.0)
+        connect()
+        self.assertIsNone(mqtt_client.outage)
+
+        self.on_disconnect(paho_client, None, 1)
+        for _ in range(3):
+            self.on_connect_fail(paho_client, None)
+        self.assertEqual(paho_client.reconnect_delays, [(1, 1), (2, 2), (4, 4), (4, 4)])
+
+        connect()
+        self.assertGreaterEqual(mqtt_client.outage, 0)
+        self.on_disconnect(paho_client, None, 1)
+        self.assertEqual(paho_client.reconnect_delays[-1], (1, 1))
+
+    def test_clean_disconnect_doesnt_reconnect(self):
+        mqtt_client, paho_client, connect = self._client()
+        connect()
+        self.on_disconnect(paho_client, None, 0)
+        self.assertEqual(paho_client.reconnect_delays, [])
+        self.assertFalse(mqtt_client.connected)
+
+
+class TestReconnectPolicy(unittest.TestCase):
+    """
+    Testing reconnect delays back off with jitter
+    """
+
+    def test_jitter_bounds(self):
+        for test_name, rng, expected in [
+            ("no jitter", lambda: 0.0, [0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5]),
+            ("full jitter", lambda: 1.0, [0.5, 1, 2, 4, 8, 10, 10]),
+            ("half", lambda: 0.5, [0.5, 0.75, 1.25, 2.25, 4.25, 5.25, 5.25]),
+        ]:
+            with self.subTest(test_name):
+                policy = ReconnectPolicy(0.5, 10, rng=rng)
+                self.assertEqual([policy.next_delay() for _ in range(7)], expected)
+
+    def test_reset(self):
+        policy = ReconnectPolicy(1, 30, rng=lambda: 1.0)
+        policy.next_delay()
+        policy.next_delay()
+        policy.reset()
+        self.assertEqual(policy.next_delay(), 1)
+
+    def test_invalid_delays(self):
+        self.assertRaises(ValueError, ReconnectPolicy, 0, 1)
+        self.assertRaises(ValueError, ReconnectPolicy, 5, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import unittest
+
+from marshmallow import ValidationError
+
+from rakomqtt.model import mqtt_payload_schema
+from rakomqtt.payload import PayloadValidationError, load_mqtt_payload
+
+
+class TestLoadMqttPayload(unittest.TestCase):
+    """
+    Testing the fast payload validator agrees with the marshmallow schema
+    """
+
+    payload_cases = [
+        # name, in str
+        ("standard", json.dumps({"state": "OFF", "brightness": 25})),
+        ("missing_brightness_off", json.dumps({"state": "OFF"})),
+        ("missing_brightness_on", json.dumps({"state": "ON"})),
+        ("missing_state", json.dumps({"brightness": 90})),
+        ("brightness_str", json.dumps({"state": "ON", "brightness": "90"})),
+        ("brightness_float", json.dumps({"state": "ON", "brightness": 90.7})),
+        ("brightness_bool", json.dumps({"state": "ON", "brightness": True})),
+        ("brightness_null", json.dumps({"state": "ON", "brightness": None})),
+        ("brightness_too_high", json.dumps({"state": "ON", "brightness": 256})),
+        ("brightness_negative", json.dumps({"state": "ON", "brightness": -1})),
+        ("brightness_not_a_number", json.dumps({"state": "ON", "brightness": "bright"})),
+        ("state_lowercase", json.dumps({"state": "on"})),
+        ("state_null", json.dumps({"state": None, "brightness": 25})),
+        ("state_not_str", json.dumps({"state": 1, "brightness": 25})),
+        ("unknown_field", json.dumps({"state": "ON", "transition": 2})),
+        ("force", json.dumps({"state": "ON", "force": True})),
+        ("force_false", json.dumps({"state": "ON", "brightness": 25, "force": False})),
+        ("force_int", json.dumps({"state": "ON", "force": 1})),
+        ("force_str", json.dumps({"state": "ON", "force": "true"})),
+        ("force_null", json.dumps({"state": "ON", "force": None})),
+        ("force_list", json.dumps({"state": "ON", "force": []})),
+        ("not_an_object", json.dumps(["ON"])),
+    ]
+
+    def test_matches_marshmallow(self):
+        for test_name, in_str in self.payload_cases:
+            with self.subTest(test_name):
+                try:
+                    expected = mqtt_payload_schema.loads(in_str)
+                except ValidationError as ex:
+                    with self.assertRaises(PayloadValidationError) as ctx:
+                        load_mqtt_payload(in_str)
+                    self.assertEqual(ctx.exception.messages, ex.messages)
+                else:
+                    self.assertEqual(load_mqtt_payload(in_str), expected)
+
+    def test_missing_state_and_brightness(self):
+        with self.assertRaises(PayloadValidationError):
+            load_mqtt_payload('{}')
@@ -0,0 +1,111 @@
+import asyncio
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rakomqtt.RakoBridge import RakoBridge, RakoCommand
+
+
+class _RakoCgiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.requests.append((self.path, self.client_address))
+        body = b'Success!'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.close_after_response:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRakoBridgeTransport(unittest.TestCase):
+    """
+    Testing commands are sent to the bridge over a pooled keep-alive connection
+    """
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _RakoCgiHandler)
+        self.server.requests = []
+        self.server.close_after_response = False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = '{}:{}'.format(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        bridge = RakoBridge(self.host)
+        for brightness in (10, 20, 30):
+            self.assertTrue(bridge.post_command(RakoCommand(5, 1, None, brightness)))
+
+        self.assertEqual(self.server.requests[0][0], '/rako.cgi?room=5&ch=1&lev=10')
+        client_ports = {client_address for _, client_address in self.server.requests}
+        self.assertEqual(len(client_ports), 1)
+        self.assertEqual(bridge.command_latency.count, 3)
+
+    def test_reconnects_when_bridge_drops_socket(self):
+        self.server.close_after_response = True
+        bridge = RakoBridge(self.host)
+        for scene in (1, 2):
+            self.assertTrue(bridge.post_command(RakoCommand(5, 0, scene, None)))
+
+        self.assertEqual([path for path, _ in self.server.requests], [
+            '/rako.cgi?room=5&ch=0&sc=1',
+            '/rako.cgi?room=5&ch=0&sc=2',
+        ])
+
+    def test_unreachable_bridge(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            host = '{}:{}'.format(*sock.getsockname())
+
+        bridge = RakoBridge(host, connect_timeout=0.5, read_timeout=0.5)
+        self.assertFalse(bridge.post_command(RakoCommand(5, 0, 1, None)))
+        self.assertEqual(bridge.command_latency.count, 0)
+
+    def test_async_connection_is_reused(self):
+        bridge = RakoBridge(self.host)
+
+        async def send_commands():
+            return [await bridge.post_command_async(RakoCommand(5, 1, None, brightness)) for brightness in (10, 20)]
+
+        self.assertEqual(asyncio.run(send_commands()), [True, True])
+        self.assertEqual([path for path, _ in self.server.requests], [
+            '/rako.cgi?room=5&ch=1&lev=10',
+            '/rako.cgi?room=5&ch=1&lev=20',
+        ])
+        client_ports = {client_address for _, client_address in self.server.requests}
+        self.assertEqual(len(client_ports), 1)
+
+    def test_async_parallel_commands_are_pooled(self):
+        bridge = RakoBridge(self.host, pool_size=2)
+
+        async def send_commands():
+            sent = await asyncio.gather(*(
+                bridge.post_command_async(RakoCommand(room, 0, 1, None)) for room in (5, 6, 7)
+            ))
+            return list(sent) + [await bridge.post_command_async(RakoCommand(8, 0, 1, None))]
+
+        self.assertEqual(asyncio.run(send_commands()), [True] * 4)
+        client_ports = [client_address for _, client_address in self.server.requests]
+        self.assertEqual(len(set(client_ports[:3])), 3)
+        self.assertIn(client_ports[3], client_ports[:3])
+        self.assertEqual(len(bridge._async_connections), 2)
+
+    def test_async_reconnects_when_bridge_drops_socket(self):
+        self.server.close_after_response = True
+        bridge = RakoBridge(self.host)
+
+        async def send_commands():
+            return [await bridge.post_command_async(RakoCommand(5, 0, scene, None)) for scene in (1, 2)]
+
+        self.assertEqual(asyncio.run(send_commands()), [True, True])
+        self.assertEqual(len(self.server.requests), 2)
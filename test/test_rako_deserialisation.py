@@ -2,7 +2,7 @@
 import json
 import unittest
 
-from rakomqtt.RakoBridge import RakoStatusMessage, RakoCommandType, RakoBridge, RakoCommand
+from rakomqtt.RakoBridge import RakoStatusMessage, RakoCommandType, RakoBridge, RakoCommand, RakoStatusDecoder
 
 
 class TestRakoWatching(unittest.TestCase):
@@ -50,6 +50,58 @@ class TestRakoWatching(unittest.TestCase):
                 self.assertEqual(payload_result, exp_payload)
 
 
+class TestRakoStatusDecoder(unittest.TestCase):
+    """
+    Testing raw status frames decode straight to publishable topic/payload
+    """
+
+    decode_frame_cases = [
+        # name, in, exp_topic, exp_payload
+        ("base level legacy", bytes([83, 7, 0, 13, 1, 12, 42, 42, 146]), 'rako/room/13/channel/1', b'{"state": "ON", "brightness": 42}'),
+        ("base level", bytes([83, 7, 0, 5, 1, 52, 1, 255, 198]), 'rako/room/5/channel/1', b'{"state": "ON", "brightness": 255}'),
+        ("level off", bytes([83, 7, 0, 5, 1, 52, 1, 0, 197]), 'rako/room/5/channel/1', b'{"state": "OFF", "brightness": 0}'),
+        ("scene base legacy", bytes([83, 5, 0, 13, 0, 6, 237]), 'rako/room/13', b'{"state": "ON", "brightness": 64}'),
+        ("base scene", bytes([83, 7, 0, 17, 0, 49, 0, 2, 188]), 'rako/room/17', b'{"state": "ON", "brightness": 192}'),
+        ("room off", bytes([83, 5, 0, 21, 0, 0, 235]), 'rako/room/21', b'{"state": "OFF", "brightness": 0}'),
+        ("memoryview", memoryview(bytearray([83, 5, 0, 21, 0, 0, 235])), 'rako/room/21', b'{"state": "OFF", "brightness": 0}'),
+    ]
+
+    def test_decode_frame(self):
+        decoder = RakoStatusDecoder()
+        for test_name, in_frame, exp_topic, exp_payload in self.decode_frame_cases:
+            with self.subTest(test_name):
+                self.assertEqual(decoder.decode(in_frame), (exp_topic, exp_payload))
+                # and again from the cache
+                self.assertEqual(decoder.decode(in_frame), (exp_topic, exp_payload))
+
+    def test_decode_matches_process_udp_bytes(self):
+        decoder = RakoStatusDecoder()
+        for test_name, in_frame, _, _ in self.decode_frame_cases:
+            with self.subTest(test_name):
+                topic, payload = RakoBridge.process_udp_bytes(list(in_frame))
+                self.assertEqual(decoder.decode(in_frame), (topic, json.dumps(payload).encode()))
+
+    invalid_frame_cases = [
+        # name, in
+        ("bad checksum", bytes([83, 7, 0, 13, 1, 12, 42, 42, 136])),
+        ("truncated", bytes([83, 7, 0, 5, 1, 52, 1, 255])),
+        ("not a status", bytes([82, 5, 0, 21, 0, 0, 235])),
+        ("unknown command", bytes([83, 5, 0, 21, 0, 13, 222])),
+    ]
+
+    def test_reject_invalid_frame(self):
+        decoder = RakoStatusDecoder()
+        for test_name, in_frame in self.invalid_frame_cases:
+            with self.subTest(test_name):
+                self.assertIsNone(decoder.decode(in_frame))
+
+    def test_cache_is_bounded(self):
+        decoder = RakoStatusDecoder(cache_size=2)
+        for _, in_frame, _, _ in self.decode_frame_cases:
+            decoder.decode(in_frame)
+        self.assertEqual(len(decoder._cache), 2)
+
+
 class TestRakoCommanding(unittest.TestCase):
     """
     Testing commands from mqtt are properly interpreted
@@ -69,3 +121,31 @@ class TestRakoCommanding(unittest.TestCase):
             with self.subTest(name):
                 cmd_result = RakoCommand.from_mqtt(in_topic, in_payload)
                 self.assertEqual(cmd_result, expected)
+
+    def test_deserialise_topic_payload_strict(self):
+        for name, in_topic, in_payload, expected in self.deserialise_topic_payload:
+            with self.subTest(name):
+                cmd_result = RakoCommand.from_mqtt(in_topic, in_payload, strict=True)
+                self.assertEqual(cmd_result, expected)
+
+    unrecognised_topics = [
+        'rako/room/5',
+        'rako/room/5/channel/1',
+        'rako/room/x/set',
+        'rako/room/5/channel/x/set',
+        'rako/room/5/scene/1/set',
+        'rako/room/5/channel/1/2/set',
+        'other/room/5/set',
+        'rako/room/\u00b2/set',
+    ]
+
+    def test_unrecognised_topic(self):
+        for in_topic in self.unrecognised_topics:
+            with self.subTest(in_topic):
+                self.assertIsNone(RakoCommand.from_mqtt(in_topic, json.dumps({"state": "ON"})))
+
+    def test_brightness_to_scene(self):
+        expected = {0: 0, 1: 4, 64: 4, 95: 4, 96: 3, 128: 3, 159: 3, 160: 2, 192: 2, 223: 2, 224: 1, 255: 1}
+        for brightness, scene in expected.items():
+            with self.subTest(brightness):
+                self.assertEqual(RakoCommand._rako_command(brightness), scene)
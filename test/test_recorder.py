@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import unittest
+
+from rakomqtt.recorder import (
+    KIND_COMMAND, KIND_STATUS, FrameRecorder, decode_command, decode_status, read_records, replay
+)
+from rakomqtt.simulator import status_frame
+
+
+class TestFrameRecorder(unittest.TestCase):
+    """
+    Testing status frames and commands are recorded and replayed
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'capture.rec')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _record(self):
+        recorder = FrameRecorder(self.path)
+        recorder.record_status(status_frame(5, 1, 52, 1, 255), ('192.168.1.20', 9761), timestamp=10.0)
+        recorder.record_status(memoryview(status_frame(5, 1, 52, 1, 255)), timestamp=10.05)
+        recorder.record_command(
+            'rako/room/5/channel/1/set', json.dumps({"state": "ON", "brightness": 25}).encode(), timestamp=10.1
+        )
+        recorder.record_command('rako/room/5/set', b'not json', timestamp=10.2)
+        recorder.close()
+
+    def test_round_trip(self):
+        self._record()
+        records = list(read_records(self.path))
+
+        self.assertEqual([(timestamp, kind) for timestamp, kind, _ in records], [
+            (10.0, KIND_STATUS), (10.05, KIND_STATUS), (10.1, KIND_COMMAND), (10.2, KIND_COMMAND),
+        ])
+        self.assertEqual(decode_status(records[0][2]), (('192.168.1.20', 0), status_frame(5, 1, 52, 1, 255)))
+        self.assertEqual(decode_status(records[1][2]), (None, status_frame(5, 1, 52, 1, 255)))
+        self.assertEqual(decode_command(records[3][2]), ('rako/room/5/set', b'not json'))
+
+    def test_appends(self):
+        self._record()
+        self._record()
+        self.assertEqual(len(list(read_records(self.path))), 8)
+
+    def test_truncated_record_ends_log(self):
+        self._record()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        self.assertEqual(len(list(read_records(self.path))), 3)
+
+    def test_not_a_recording(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'something else')
+        self.assertRaises(ValueError, lambda: list(read_records(self.path)))
+
+    def test_replay(self):
+        self._record()
+        stats = replay(self.path, speed=0)
+        self.assertEqual(
+            {k: v for k, v in stats.items() if k != 'seconds'},
+            dict(status_frames=2, commands=2, commands_parsed=1, states_published=1),
+        )
+
+    def test_replay_at_recorded_speed(self):
+        self._record()
+        self.assertGreaterEqual(replay(self.path, speed=1)['seconds'], 0.2)
+        self.assertLess(replay(self.path, speed=4)['seconds'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import json
+import unittest
+
+from rakomqtt.RakoBridge import RakoCommand, RakoStatusDecoder
+from rakomqtt.scenes import DEFAULT_SCENE_MAP, SceneLadder, SceneMap
+from rakomqtt.simulator import status_frame
+from rakomqtt.topology import Channel, Room, Topology
+
+
+class TestSceneMap(unittest.TestCase):
+    """
+    Testing room scenes map to and from brightnesses, per room
+    """
+
+    def setUp(self):
+        self.scene_map = SceneMap(rooms={42: [255, 170, 85]})
+
+    def test_default_ladder(self):
+        windows = {0: range(0, 1), 4: range(1, 96), 3: range(96, 160), 2: range(160, 224), 1: range(224, 256)}
+        for scene, brightnesses in windows.items():
+            with self.subTest(scene=scene):
+                self.assertEqual({DEFAULT_SCENE_MAP.scene(5, brightness) for brightness in brightnesses}, {scene})
+        self.assertEqual([DEFAULT_SCENE_MAP.brightness(5, scene) for scene in range(6)], [0, 255, 192, 128, 64, None])
+
+    def test_room_ladder(self):
+        scene_cases = [
+            # name, brightness, expected scene
+            ("off", 0, 0),
+            ("dimmest is the floor", 1, 3),
+            ("tie goes brighter", 128, 2),
+            ("nearest", 200, 2),
+            ("full", 255, 1),
+        ]
+        for test_name, brightness, expected in scene_cases:
+            with self.subTest(test_name):
+                self.assertEqual(self.scene_map.scene(42, brightness), expected)
+        self.assertEqual(self.scene_map.brightness(42, 3), 85)
+        self.assertIsNone(self.scene_map.brightness(42, 4))
+        self.assertEqual(self.scene_map.scene(5, 200), 2)
+
+    def test_invalid_ladders(self):
+        for brightnesses in ([], [0, 0], [256], [-1], ['255']):
+            with self.subTest(brightnesses):
+                self.assertRaises(ValueError, SceneLadder, brightnesses)
+
+    def test_from_dict(self):
+        scene_map = SceneMap.from_dict(json.loads('{"default": [255, 128], "rooms": {"42": [200]}, "rako_xml": true}'))
+        self.assertEqual(scene_map.default, SceneLadder([255, 128]))
+        self.assertEqual(scene_map.rooms, {42: SceneLadder([200])})
+        self.assertTrue(scene_map.from_topology)
+
+    def test_for_topology(self):
+        topology = Topology({
+            7: Room(7, 'Kitchen', {
+                1: Channel(1, 'Spots', (255, 100, 0)),
+                2: Channel(2, 'Pendant', (155, 0, 0)),
+            }),
+            42: Room(42, 'Hallway', {1: Channel(1, 'Downlights', (255,))}),
+        })
+        self.assertIs(self.scene_map.for_topology(topology), self.scene_map)
+
+        scene_map = SceneMap(rooms={42: [255, 170, 85]}, from_topology=True).for_topology(topology)
+        self.assertEqual(scene_map.rooms, {7: SceneLadder([205, 50, 0]), 42: SceneLadder([255, 170, 85])})
+
+    def test_decode_and_command(self):
+        decoder = RakoStatusDecoder(scene_map=self.scene_map)
+        self.assertEqual(decoder.decode(status_frame(42, 0, 49, 0, 3)), ('rako/room/42', b'{"state": "ON", "brightness": 85}'))
+        self.assertEqual(decoder.decode(status_frame(42, 0, 49, 0, 4)), None)
+        self.assertEqual(decoder.decode(status_frame(5, 0, 49, 0, 4)), ('rako/room/5', b'{"state": "ON", "brightness": 64}'))
+
+        payload = json.dumps({"state": "ON", "brightness": 90})
+        self.assertEqual(
+            RakoCommand.from_mqtt('rako/room/42/set', payload, scene_map=self.scene_map), RakoCommand(42, 0, 3, None)
+        )
+        self.assertEqual(
+            RakoCommand.from_mqtt('rako/room/5/set', payload, scene_map=self.scene_map), RakoCommand(5, 0, 4, None)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import socket
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+from rakomqtt.RakoBridge import RakoBridge, RakoCommand, RakoCommandType, RakoStatusMessage, status_checksum_ok
+from rakomqtt.simulator import BridgeSimulator, _SimulatorRequestHandler, status_frame
+
+
+class TestBridgeSimulator(unittest.TestCase):
+    """
+    Testing the simulated bridge speaks the same protocol as the real one
+    """
+
+    def setUp(self):
+        self.status_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.status_sock.bind(('127.0.0.1', 0))
+        self.status_sock.settimeout(1)
+
+    def tearDown(self):
+        self.status_sock.close()
+
+    def _simulator(self, **kwargs):
+        return BridgeSimulator(rooms=3, channels=2, status_target=self.status_sock.getsockname(), seed=1, **kwargs)
+
+    status_frame_cases = [
+        # name, in, expected
+        ("level", (5, 1, 52, 1, 255), [83, 7, 0, 5, 1, 52, 1, 255, 198]),
+        ("scene", (17, 0, 49, 0, 2), [83, 7, 0, 17, 0, 49, 0, 2, 188]),
+        ("scene legacy", (13, 0, 6), [83, 5, 0, 13, 0, 6, 237]),
+    ]
+
+    def test_status_frame(self):
+        for test_name, in_args, expected in self.status_frame_cases:
+            with self.subTest(test_name):
+                self.assertEqual(list(status_frame(*in_args)), expected)
+
+    def test_command_is_broadcast_as_status(self):
+        simulator = self._simulator()
+        self.assertTrue(simulator.handle_command({'room': '2', 'ch': '0', 'sc': '3'}))
+
+        frame = self.status_sock.recv(256)
+        self.assertTrue(status_checksum_ok(frame))
+        self.assertEqual(RakoStatusMessage.from_byte_list(frame), RakoStatusMessage(2, 0, RakoCommandType.SET_SCENE, 3, 128))
+        self.assertEqual(simulator.levels[(2, 1)], 128)
+        self.assertEqual(simulator.levels[(1, 1)], 0)
+
+    def test_dropped_command(self):
+        simulator = self._simulator(drop_rate=1)
+        self.assertTrue(simulator.handle_command({'room': '2', 'ch': '1', 'lev': '40'}))
+        self.assertEqual(simulator.stats(), dict(received=1, applied=0, dropped=1, frames_sent=0))
+
+    def test_serves_rako_cgi(self):
+        simulator = self._simulator()
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), _SimulatorRequestHandler)
+        httpd.simulator = simulator
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            bridge = RakoBridge('{}:{}'.format(*httpd.server_address))
+            self.assertTrue(bridge.post_command(RakoCommand(3, 2, None, 99)))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+        self.assertEqual(simulator.levels[(3, 2)], 99)
+        self.assertEqual(RakoStatusMessage.from_byte_list(self.status_sock.recv(256)).brightness, 99)
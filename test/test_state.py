@@ -0,0 +1,133 @@
+import json
+import threading
+import unittest
+
+from rakomqtt.bridges import command_subscriptions
+from rakomqtt.command_queue import CommandQueue
+from rakomqtt.RakoBridge import RakoCommand, RakoCommandType, RakoStatusDecoder
+from rakomqtt.simulator import status_frame
+from rakomqtt.state import ConfirmedStates
+from rakomqtt.topology import Channel, Room, Topology
+
+# scenes 1-4 set channel 1 to these levels
+TOPOLOGY = Topology({5: Room(5, channels={1: Channel(1, levels=(255, 100, 50, 20))})})
+
+
+class TestConfirmedStates(unittest.TestCase):
+    """
+    Testing commands which wouldn't change a light are skipped
+    """
+
+    def setUp(self):
+        self.states = ConfirmedStates(topology=TOPOLOGY)
+        # scene 2, and the level the watcher derives from it
+        self.states.update('rako/room/5', json.dumps({"state": "ON", "brightness": 192}).encode())
+        self.states.update('rako/room/5/channel/1', json.dumps({"state": "ON", "brightness": 100}).encode())
+        self.states.update('rako/room/6/channel/0', json.dumps({"state": "OFF", "brightness": 0}).encode())
+
+    redundant_cases = [
+        # name, command, expected
+        ("same scene", RakoCommand(5, 0, 2, None), True),
+        ("other scene", RakoCommand(5, 0, 1, None), False),
+        ("same level", RakoCommand(5, 1, None, 100), True),
+        ("other level", RakoCommand(5, 1, None, 101), False),
+        ("unknown channel", RakoCommand(5, 2, None, 100), False),
+        ("room level", RakoCommand(6, 0, None, 0), True),
+        ("unknown room", RakoCommand(7, 0, 2, None), False),
+        ("forced", RakoCommand(5, 0, 2, None, force=True), False),
+    ]
+
+    def test_redundant(self):
+        for test_name, rako_command, expected in self.redundant_cases:
+            with self.subTest(test_name):
+                self.assertEqual(self.states.redundant(rako_command), expected)
+
+    def test_sending_forgets_room(self):
+        self.states.sent(RakoCommand(5, 1, None, 50))
+        self.assertFalse(self.states.redundant(RakoCommand(5, 0, 2, None)))
+        self.assertFalse(self.states.redundant(RakoCommand(5, 1, None, 100)))
+        self.assertTrue(self.states.redundant(RakoCommand(6, 0, None, 0)))
+
+    def test_channel_change_forgets_room_scene(self):
+        self.states.update('rako/room/5/channel/1', json.dumps({"state": "ON", "brightness": 100}).encode())
+        self.assertTrue(self.states.redundant(RakoCommand(5, 0, 2, None)))
+        # e.g. from a keypad
+        self.states.update('rako/room/5/channel/1', json.dumps({"state": "ON", "brightness": 30}).encode())
+        self.assertFalse(self.states.redundant(RakoCommand(5, 0, 2, None)))
+        self.assertTrue(self.states.redundant(RakoCommand(5, 1, None, 30)))
+
+    def test_first_channel_state_forgets_room_scene(self):
+        for test_name, topology in (("without topology", None), ("with topology", TOPOLOGY)):
+            with self.subTest(test_name):
+                states = ConfirmedStates(topology=topology)
+                states.update('rako/room/5', json.dumps({"state": "ON", "brightness": 192}).encode())
+                states.update('rako/room/5/channel/1', json.dumps({"state": "ON", "brightness": 10}).encode())
+                self.assertFalse(states.redundant(RakoCommand(5, 0, 2, None)))
+                self.assertTrue(states.redundant(RakoCommand(5, 1, None, 10)))
+
+    def test_room_state_replaces_channel_states(self):
+        room_cases = [
+            # name, topology, room topic, room brightness, expected channel 1 level
+            ("room off", None, 'rako/room/5', 0, None),
+            ("room off, topology", TOPOLOGY, 'rako/room/5', 0, 0),
+            ("scene 3, topology", TOPOLOGY, 'rako/room/5', 128, 50),
+            ("room level", None, 'rako/room/5/channel/0', 30, None),
+            ("room level, topology", TOPOLOGY, 'rako/room/5/channel/0', 30, 30),
+        ]
+        for test_name, topology, topic, brightness, expected in room_cases:
+            with self.subTest(test_name):
+                states = ConfirmedStates(topology=topology)
+                states.update('rako/room/5/channel/1', json.dumps({"state": "ON", "brightness": 200}).encode())
+                states.update(topic, json.dumps({"state": "ON", "brightness": brightness}).encode())
+                self.assertFalse(states.redundant(RakoCommand(5, 1, None, 200)))
+                if expected is not None:
+                    self.assertTrue(states.redundant(RakoCommand(5, 1, None, expected)))
+
+    def test_derived_channel_states_keep_room_scene(self):
+        decoder = RakoStatusDecoder(topology=TOPOLOGY)
+        states = ConfirmedStates(topology=TOPOLOGY)
+        for scene in (3, 1):
+            for topic, payload in decoder.decode_states(status_frame(5, 0, RakoCommandType.SET_SCENE.value, 0, scene)):
+                states.update(topic, payload)
+        self.assertTrue(states.redundant(RakoCommand(5, 0, 1, None)))
+        self.assertTrue(states.redundant(RakoCommand(5, 1, None, 255)))
+
+    def test_ignores_bad_state(self):
+        for payload in (b'', b'not json', b'{"state": "ON"}', b'[]', b'{"brightness": 300}', b'{"brightness": 1.5}'):
+            with self.subTest(payload):
+                self.states.update('rako/room/8', payload)
+                self.assertFalse(self.states.redundant(RakoCommand(8, 0, 1, None)))
+
+    def test_prefix(self):
+        states = ConfirmedStates('rako/garage')
+        states.update('rako/garage/room/5', b'{"state": "ON", "brightness": 255}')
+        self.assertTrue(states.redundant(RakoCommand(5, 0, 1, None)))
+
+    def test_state_subscriptions(self):
+        self.assertEqual(command_subscriptions(['rako'], states=True)[2:], [
+            ('rako/room/+', 0),
+            ('rako/room/+/channel/+', 0),
+        ])
+
+    def test_queue_skips_redundant(self):
+        sent = []
+        done = threading.Event()
+
+        def send(rako_command):
+            sent.append(rako_command)
+            if len(sent) == 2:
+                done.set()
+
+        queue = CommandQueue(send, rate=0, states=self.states)
+        queue.put(RakoCommand(5, 1, None, 100))
+        queue.put(RakoCommand(6, 0, None, 0, force=True))
+        queue.put(RakoCommand(7, 0, 1, None))
+        queue.start()
+        self.assertTrue(done.wait(1))
+        queue.stop()
+        self.assertEqual([(c.room, c.channel) for c in sent], [(7, 0), (6, 0)])
+        self.assertEqual(self.states.skipped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
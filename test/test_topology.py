@@ -0,0 +1,178 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from paho.mqtt.client import MQTTMessage
+
+from rakomqtt.commander import parse_command
+from rakomqtt.RakoBridge import RakoCommand, RakoStatusDecoder
+from rakomqtt.simulator import BridgeSimulator, status_frame
+from rakomqtt.topology import Channel, Topology, TopologyCache, load_topology
+
+
+# the example from "XML" in accessing-the-rako-bridge.pdf
+RAKO_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<rako>
+   <info>
+      <version>2.3.2 RA</version>
+      <hostName>RAKOBRIDGE</hostName>
+   </info>
+   <rooms>
+      <Room id="9">
+         <Type>Lights</Type>
+         <Title>Kitchen</Title>
+         <mode>4+OFF</mode>
+         <Scene id="1">
+            <Name>Cooking</Name>
+         </Scene>
+         <Channel id="1">
+            <type>Default</type>
+            <Name>Downlights</Name>
+            <Levels>FFBF7F3F000000000000000000000000</Levels>
+         </Channel>
+         <Channel id="2">
+            <type>Default</type>
+            <Name>Under cabinet</Name>
+            <Levels>80FF00C0000000000000000000000000</Levels>
+         </Channel>
+      </Room>
+   </rooms>
+</rako>
+'''
+
+
+class TestTopology(unittest.TestCase):
+    """
+    Testing the rooms and channels index built from rako.xml
+    """
+
+    def setUp(self):
+        self.topology = Topology.from_xml(RAKO_XML)
+
+    def test_from_xml(self):
+        room = self.topology.rooms[9]
+        self.assertEqual(room.title, 'Kitchen')
+        self.assertEqual(sorted(room.channels), [1, 2])
+        self.assertEqual(room.channels[2].name, 'Under cabinet')
+        self.assertEqual(room.channels[1].levels[:4], (255, 191, 127, 63))
+
+    def test_simulator_xml(self):
+        topology = Topology.from_xml(BridgeSimulator(rooms=3, channels=2).rako_xml())
+        self.assertEqual(len(topology), 3)
+        self.assertEqual(sorted(topology.rooms[3].channels), [1, 2])
+
+    has_channel_cases = [
+        # name, in, expected
+        ("channel", (9, 2), True),
+        ("whole room", (9, 0), True),
+        ("unknown channel", (9, 3), False),
+        ("unknown room", (10, 0), False),
+        ("whole house", (0, 0), True),
+    ]
+
+    def test_has_channel(self):
+        for test_name, in_args, expected in self.has_channel_cases:
+            with self.subTest(test_name):
+                self.assertEqual(self.topology.has_channel(*in_args), expected)
+
+    scene_levels_cases = [
+        # name, in, expected
+        ("room scene", (9, 0, 2), [(1, 191), (2, 255)]),
+        ("room off", (9, 0, 0), [(1, 0), (2, 0)]),
+        ("channel scene", (9, 2, 1), [(2, 128)]),
+        ("scene out of range", (9, 0, 17), []),
+        ("unknown room", (10, 0, 1), []),
+    ]
+
+    def test_scene_levels(self):
+        for test_name, in_args, expected in self.scene_levels_cases:
+            with self.subTest(test_name):
+                self.assertEqual(self.topology.scene_levels(*in_args), expected)
+
+    def test_channel_level(self):
+        channel = Channel(1, levels=(255, 100))
+        self.assertEqual([channel.level(scene) for scene in range(4)], [0, 255, 100, None])
+
+    def test_dict_round_trip(self):
+        topology = Topology.from_dict(json.loads(json.dumps(self.topology.to_dict())))
+        self.assertEqual(topology.rooms, self.topology.rooms)
+
+    def test_decoder_derives_channel_states(self):
+        decoder = RakoStatusDecoder(topology=self.topology)
+        self.assertEqual(decoder.decode_states(status_frame(9, 0, 49, 0, 2)), (
+            ('rako/room/9', b'{"state": "ON", "brightness": 192}'),
+            ('rako/room/9/channel/1', b'{"state": "ON", "brightness": 191}'),
+            ('rako/room/9/channel/2', b'{"state": "ON", "brightness": 255}'),
+        ))
+        # levels aren't derived from anything but scenes
+        self.assertEqual(len(decoder.decode_states(status_frame(9, 1, 52, 1, 10))), 1)
+        self.assertEqual(len(RakoStatusDecoder().decode_states(status_frame(9, 0, 49, 0, 2))), 1)
+
+    def test_parse_command_rejects_unknown_channel(self):
+        def message(topic):
+            msg = MQTTMessage(topic=topic.encode())
+            msg.payload = b'{"state": "ON", "brightness": 255}'
+            return msg
+
+        self.assertEqual(
+            parse_command(message('rako/room/9/channel/2/set'), topology=self.topology),
+            RakoCommand(room=9, channel=2, brightness=255),
+        )
+        self.assertIsNone(parse_command(message('rako/room/9/channel/3/set'), topology=self.topology))
+        self.assertIsNone(parse_command(message('rako/room/10/set'), topology=self.topology))
+        self.assertIsNotNone(parse_command(message('rako/room/10/set')))
+
+
+class TestTopologyCache(unittest.TestCase):
+    """
+    Testing rako.xml is only fetched when there's no fresh cached copy
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'rakomqtt', 'topology.json')
+        self.topology = Topology.from_xml(RAKO_XML)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        cache = TopologyCache(self.path)
+        self.assertIsNone(cache.load('192.168.0.10'))
+        cache.save('192.168.0.10', self.topology)
+        self.assertEqual(cache.load('192.168.0.10').rooms, self.topology.rooms)
+        self.assertIsNone(cache.load('192.168.0.11'))
+        cache.save('192.168.0.11', Topology({}))
+        self.assertEqual(len(cache.load('192.168.0.10')), 1)
+        self.assertEqual(len(cache.load('192.168.0.11')), 0)
+
+    def test_load_topology_uses_cache(self):
+        cache = TopologyCache(self.path)
+        with mock.patch('rakomqtt.topology.fetch_topology', return_value=self.topology) as fetch_topology:
+            self.assertEqual(len(load_topology('192.168.0.10', cache)), 1)
+            self.assertEqual(len(load_topology('192.168.0.10', cache)), 1)
+        self.assertEqual(fetch_topology.call_count, 1)
+
+    def test_load_topology_falls_back_to_expired(self):
+        cache = TopologyCache(self.path, ttl=10)
+        cache.save('192.168.0.10', self.topology)
+        with open(self.path) as f:
+            cached = json.load(f)
+        cached['192.168.0.10']['fetched_at'] = time.time() - 100
+        with open(self.path, 'w') as f:
+            json.dump(cached, f)
+
+        with mock.patch('rakomqtt.topology.fetch_topology', return_value=None):
+            self.assertEqual(len(load_topology('192.168.0.10', cache)), 1)
+            self.assertIsNone(load_topology('192.168.0.11', cache))
+
+    def test_empty_topology_is_unknown(self):
+        with mock.patch('rakomqtt.topology.fetch_topology', return_value=Topology({})):
+            self.assertIsNone(load_topology('192.168.0.10', TopologyCache('')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import asyncio
+import socket
+import unittest
+
+from rakomqtt.RakoBridge import UDP_TRANSPORT, RakoBridge, RakoCommand
+from rakomqtt.simulator import udp_command_params
+from rakomqtt.udp_commands import UdpCommandTransport, encode_command
+
+
+class TestUdpCommands(unittest.TestCase):
+    """
+    Testing commands sent to the bridge as binary udp frames
+    """
+
+    def setUp(self):
+        self.bridge_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.bridge_sock.bind(('127.0.0.1', 0))
+        self.bridge_sock.settimeout(1)
+        self.port = self.bridge_sock.getsockname()[1]
+
+    def tearDown(self):
+        self.bridge_sock.close()
+
+    encode_cases = [
+        # name, in, expected
+        # the example from "Sending Commands" in accessing-the-rako-bridge.pdf
+        ("scene", RakoCommand(room=7, channel=0, scene=5), bytes.fromhex('52 07 00 07 00 31 01 05 bb')),
+        ("level", RakoCommand(room=5, channel=1, brightness=255), bytes.fromhex('52 07 00 05 01 34 01 ff bf')),
+        ("big room", RakoCommand(room=300, channel=2, scene=0), bytes.fromhex('52 07 01 2c 02 31 01 00 98')),
+    ]
+
+    def test_encode_command(self):
+        for test_name, in_command, expected in self.encode_cases:
+            with self.subTest(test_name):
+                self.assertEqual(encode_command(in_command), expected)
+
+    def test_simulator_decodes_command(self):
+        self.assertEqual(udp_command_params(encode_command(RakoCommand(300, 2, scene=3))), dict(room=300, ch=2, sc=3))
+        self.assertEqual(udp_command_params(encode_command(RakoCommand(5, 1, brightness=9))), dict(room=5, ch=1, lev=9))
+        corrupt = bytearray(encode_command(RakoCommand(5, 1, brightness=9)))
+        corrupt[-1] ^= 0xFF
+        self.assertIsNone(udp_command_params(bytes(corrupt)))
+
+    def test_send_repeats(self):
+        transport = UdpCommandTransport('127.0.0.1', self.port, repeat=2)
+        self.assertTrue(transport.send(RakoCommand(7, 0, scene=5), RakoCommand(5, 1, brightness=255)))
+        received = [self.bridge_sock.recv(256) for _ in range(4)]
+        self.assertEqual(received, [
+            encode_command(RakoCommand(7, 0, scene=5)),
+            encode_command(RakoCommand(7, 0, scene=5)),
+            encode_command(RakoCommand(5, 1, brightness=255)),
+            encode_command(RakoCommand(5, 1, brightness=255)),
+        ])
+
+    def test_rako_bridge_udp_transport(self):
+        rako_bridge = RakoBridge('127.0.0.1', transport=UDP_TRANSPORT)
+        rako_bridge.port = self.port
+        self.assertTrue(rako_bridge.post_command(RakoCommand(7, 0, scene=5)))
+        self.assertEqual(self.bridge_sock.recv(256), encode_command(RakoCommand(7, 0, scene=5)))
+
+        self.assertTrue(asyncio.run(rako_bridge.post_command_async(RakoCommand(5, 1, brightness=255))))
+        self.assertEqual(self.bridge_sock.recv(256), encode_command(RakoCommand(5, 1, brightness=255)))
+
+
+if __name__ == '__main__':
+    unittest.main()
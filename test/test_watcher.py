@@ -0,0 +1,84 @@
+import socket
+import unittest
+
+from rakomqtt.state import StateStore
+from rakomqtt.watcher import BatchReceiver, publish_state, udp_drops
+
+
+class TestBatchReceiver(unittest.TestCase):
+    """
+    Testing a burst of status frames is drained in one wakeup
+    """
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sock.close()
+        self.sender.close()
+
+    def test_drains_burst(self):
+        frames = [bytes([83, 5, 0, room, 0, 0, (256 - room) % 256]) for room in range(1, 11)]
+        for frame in frames:
+            self.sender.sendto(frame, self.sock.getsockname())
+
+        receiver = BatchReceiver(self.sock, batch_size=64)
+        batch = receiver.receive(timeout=1)
+
+        self.assertEqual([bytes(frame) for frame in batch], frames)
+        self.assertEqual((receiver.frames, receiver.batches, receiver.largest_batch), (10, 1, 10))
+        self.assertEqual(receiver.addresses, [('127.0.0.1', self.sender.getsockname()[1])] * 10)
+
+    def test_batch_size_limits_one_drain(self):
+        for room in range(1, 6):
+            self.sender.sendto(bytes([83, 5, 0, room, 0, 0, 0]), self.sock.getsockname())
+
+        receiver = BatchReceiver(self.sock, batch_size=3)
+        self.assertEqual(len(receiver.receive(timeout=1)), 3)
+        self.assertEqual(len(receiver.receive(timeout=1)), 2)
+        self.assertEqual(receiver.receive(timeout=0), [])
+
+    def test_udp_drops(self):
+        drops = udp_drops(self.sock)
+        if drops is None:
+            self.skipTest('/proc/net/udp not available')
+        self.assertEqual(drops, 0)
+
+
+class _StubMQTTClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, retain))
+
+
+class TestPublishState(unittest.TestCase):
+    """
+    Testing only state changes are published, retained
+    """
+
+    def test_repeated_state_is_suppressed(self):
+        mqtt_client = _StubMQTTClient()
+        state_store = StateStore()
+        on = b'{"state": "ON", "brightness": 64}'
+        off = b'{"state": "OFF", "brightness": 0}'
+        for topic, payload in [
+            ('rako/room/5', on),
+            ('rako/room/5', on),
+            ('rako/room/6', on),
+            ('rako/room/5', off),
+            ('rako/room/5', off),
+        ]:
+            publish_state(mqtt_client, state_store, topic, payload)
+
+        self.assertEqual(mqtt_client.published, [
+            ('rako/room/5', on, True),
+            ('rako/room/6', on, True),
+            ('rako/room/5', off, True),
+        ])
+        self.assertEqual(state_store.suppressed, 2)
+        self.assertEqual(state_store.snapshot(), {'rako/room/5': off, 'rako/room/6': on})